@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Persistent index of the ASINs searches resolved titles and authors to.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import weakref
+
+from amazonbookquery.normalize import query_key
+
+__all__ = ['AsinIndex', 'trigrams', 'similarity']
+
+
+def trigrams(text):
+    """
+    Returns the set of three character substrings of ``text``, padded so
+    that short words and word boundaries count too.
+    """
+    text = '  ' + text + ' '
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def similarity(a, b):
+    """
+    Returns the Jaccard similarity of the trigrams of ``a`` and ``b``,
+    between 0 and 1.
+    """
+    a, b = trigrams(a), trigrams(b)
+    if not a or not b:
+        return 0.0
+    return len(a & b) / float(len(a | b))
+
+
+class AsinIndex(object):
+    """
+    SQLite backed map of normalized title and author keys, as made by
+    :func:`query_key`, to the ASIN their search found and the confidence
+    of that match: the :func:`similarity` of the query to the title and
+    author of the item found.
+
+    An exact hit stands for the search it was recorded from, if its
+    confidence reaches ``min_confidence``. With ``fuzzy`` set, the keys
+    closest to the query are tried too, and the best one is taken if its
+    similarity to the query times its confidence reaches ``fuzzy``.
+    """
+
+    # most promising keys compared with the query in fuzzy matching
+    CANDIDATES = 200
+
+    def __init__(self, path, fuzzy=None, min_confidence=0.5):
+        self.path = path
+        self.fuzzy = fuzzy
+        self.min_confidence = min_confidence
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # writes go through one connection, every thread reads through its
+        # own so that lookups do not wait for each other
+        self._lock = threading.Lock()
+        # a thread's reader is closed when the thread ends
+        self._local = threading.local()
+        self._readers = weakref.WeakSet()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS asins ('
+                ' key TEXT PRIMARY KEY,'
+                ' asin TEXT NOT NULL,'
+                ' confidence REAL NOT NULL,'
+                ' grams INTEGER NOT NULL,'
+                ' updated REAL NOT NULL)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS grams ('
+                ' gram TEXT NOT NULL,'
+                ' key TEXT NOT NULL)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS grams_gram ON grams (gram)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS grams_key ON grams (key)')
+            # number of keys per trigram, to match on the rarest ones
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS gram_counts ('
+                ' gram TEXT PRIMARY KEY,'
+                ' count INTEGER NOT NULL)')
+            if self._db.execute('SELECT 1 FROM gram_counts LIMIT 1').fetchone() is None:
+                # an index made before the counts were kept
+                self._db.execute(
+                    'INSERT INTO gram_counts SELECT gram, COUNT(*) FROM grams GROUP BY gram')
+
+    def _reader(self):
+        reader = getattr(self._local, 'reader', None)
+        if reader is None:
+            reader = self._local.reader = _Reader(self.path)
+            with self._lock:
+                self._readers.add(reader)
+        return reader.db
+
+    def get(self, title, author):
+        """
+        Returns ``(asin, score)`` for ``title`` by ``author``, the score of
+        an exact hit being 1 and that of a fuzzy one its similarity to the
+        query times its confidence, or ``None`` when nothing close enough
+        was recorded.
+        """
+        key = query_key(title, author)
+        db = self._reader()
+        row = db.execute('SELECT asin, confidence FROM asins WHERE key = ?', (key,)).fetchone()
+        if row is not None and row[1] >= self.min_confidence:
+            return row[0], 1.0
+        if self.fuzzy:
+            return self._match(db, key)
+        return None
+
+    def _match(self, db, key):
+        grams = trigrams(key)
+        counts = dict(db.execute(
+            'SELECT gram, count FROM gram_counts WHERE gram IN ({})'.format(
+                ','.join('?' * len(grams))),
+            list(grams)).fetchall())
+        # a key at least ``fuzzy`` similar to the query lacks at most
+        # (1 - fuzzy) of its trigrams, so it has one of any (1 - fuzzy)
+        # of them plus one: only the keys having one of the rarest are
+        # candidates
+        rarest = sorted(grams, key=lambda gram: counts.get(gram, 0))
+        rarest = [gram for gram in rarest[:int((1 - self.fuzzy) * len(grams)) + 1]
+                  if gram in counts]
+        if not rarest:
+            return None
+        rows = db.execute(
+            'SELECT asins.key, asin, confidence FROM asins JOIN ('
+            ' SELECT key, COUNT(*) AS shared FROM grams WHERE gram IN ({})'
+            ' GROUP BY key ORDER BY shared DESC LIMIT ?) AS candidates'
+            ' ON asins.key = candidates.key'.format(','.join('?' * len(rarest))),
+            rarest + [self.CANDIDATES]).fetchall()
+
+        best = None
+        best_score = 0
+        for other, asin, confidence in rows:
+            if other == key:
+                # an exact hit not trusted enough
+                continue
+            score = similarity(key, other) * confidence
+            if score >= max(self.fuzzy, best_score):
+                best = asin, score
+                best_score = score
+        return best
+
+    def record(self, title, author, asin, confidence):
+        """
+        Maps ``title`` by ``author`` to ``asin``, replacing what was
+        recorded for them before.
+        """
+        key = query_key(title, author)
+        grams = trigrams(key)
+        with self._lock:
+            with self._db:
+                known = self._db.execute(
+                    'SELECT 1 FROM asins WHERE key = ?', (key,)).fetchone() is not None
+                self._db.execute(
+                    'INSERT OR REPLACE INTO asins VALUES (?, ?, ?, ?, ?)',
+                    (key, asin, confidence, len(grams), time.time()))
+                if not known:
+                    # the trigrams of a known key are there already
+                    self._db.executemany(
+                        'INSERT INTO grams VALUES (?, ?)', ((gram, key) for gram in grams))
+                    self._db.executemany(
+                        'INSERT OR IGNORE INTO gram_counts VALUES (?, 0)',
+                        ((gram,) for gram in grams))
+                    self._db.executemany(
+                        'UPDATE gram_counts SET count = count + 1 WHERE gram = ?',
+                        ((gram,) for gram in grams))
+
+    def discard(self, asin):
+        """
+        Forgets every key mapped to ``asin``, e.g. once it is no longer
+        valid.
+        """
+        with self._lock:
+            with self._db:
+                keys = [row[0] for row in self._db.execute(
+                    'SELECT key FROM asins WHERE asin = ?', (asin,))]
+                for key in keys:
+                    self._db.executemany(
+                        'UPDATE gram_counts SET count = count - 1 WHERE gram = ?',
+                        ((gram,) for gram in trigrams(key)))
+                    self._db.execute('DELETE FROM grams WHERE key = ?', (key,))
+                self._db.execute('DELETE FROM asins WHERE asin = ?', (asin,))
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM asins').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            for reader in list(self._readers):
+                reader.close()
+            self._readers.clear()
+            self._db.close()
+
+
+class _Reader(object):
+    """
+    Connection reading an index file for one thread, closed with it.
+    """
+
+    __slots__ = ('db', '__weakref__')
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+
+    def close(self):
+        self.db.close()
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Groups ItemLookup requests of concurrently processed rows.
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from amazonbookquery.errors import InvalidParameterValue
+
+
+class LookupBatcher(object):
+    """
+    Collects ASINs submitted by concurrent rows and resolves them with a
+    single ``lookup`` call per group of up to ``batch_size`` ASINs. A group
+    that does not fill up is flushed ``max_wait`` seconds after its first
+    ASIN arrived.
+
+    ``lookup`` takes a list of ASINs and returns a dict of results keyed by
+    ASIN, where a value may be an exception to raise for that ASIN only.
+    """
+
+    MAX_BATCH_SIZE = 10
+
+    def __init__(self, lookup, batch_size=MAX_BATCH_SIZE, max_wait=0.2):
+        self.lookup = lookup
+        self.batch_size = min(batch_size, self.MAX_BATCH_SIZE)
+        self.max_wait = max_wait
+
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._timer = None
+
+    def submit(self, asin):
+        """
+        Queues ``asin`` and returns a :class:`Future` of its result.
+        """
+        batch = None
+        with self._lock:
+            future = self._pending.get(asin)
+            if future is None:
+                future = self._pending[asin] = Future()
+
+            if len(self._pending) >= self.batch_size:
+                batch = self._take()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if batch:
+            self._run(batch)
+
+        return future
+
+    def get(self, asin):
+        return self.submit(asin).result()
+
+    def flush(self):
+        with self._lock:
+            batch = self._take()
+
+        if batch:
+            self._run(batch)
+
+    def _take(self):
+        batch = list(self._pending.items())
+        self._pending = OrderedDict()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _run(self, batch):
+        try:
+            results = self.lookup([asin for asin, future in batch])
+        except Exception as e:
+            for asin, future in batch:
+                future.set_exception(e)
+            return
+
+        for asin, future in batch:
+            result = results.get(asin)
+            if result is None:
+                future.set_exception(InvalidParameterValue(
+                    'ItemId', asin,
+                    code='AWS.InvalidParameterValue',
+                    msg='%s is not a valid value for ItemId. Please change this '
+                        'value and retry your request.' % asin))
+            elif isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
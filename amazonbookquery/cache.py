@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Persistent cache of Amazon API responses and scraped detail pages.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+__all__ = ['ResponseCache']
+
+DAY = 24 * 60 * 60
+
+
+class ResponseCache(object):
+    """
+    SQLite backed cache of response bodies. Bodies are stored compressed
+    and keyed by operation and canonical request parameters. Entries
+    expire after the TTL of their operation and the least recently used
+    ones are evicted once the bodies take more than ``max_size`` bytes.
+
+    Responses telling that nothing matched a search are stored under the
+    ``NoMatch`` operation, with a TTL of their own, so that reruns do not
+    pay for the same dead ends again.
+
+    With ``refresh=True`` stored entries are never returned but fresh
+    responses still replace them.
+
+    Access times, which only order the eviction, are written in batches of
+    ``ACCESS_BATCH``.
+    """
+
+    DEFAULT_TTLS = {
+        'ItemSearch': 30 * DAY,
+        'ItemLookup': DAY,
+        'Scrape': DAY,
+        'NoMatch': 7 * DAY,
+    }
+
+    # parameters that do not change the response, left out of the key so
+    # that runs with other credentials share the entries
+    UNKEYED_PARAMS = ('AWSAccessKeyId', 'AssociateTag', 'Signature', 'Timestamp')
+
+    ACCESS_BATCH = 100
+
+    def __init__(self, path, ttls=None, max_size=512 * 1024 * 1024, refresh=False):
+        self.path = path
+        self.ttls = dict(self.DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.max_size = max_size
+        self.refresh = refresh
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # readers do not wait for the writes of other processes
+        self._db.execute('PRAGMA journal_mode=WAL')
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                ' key TEXT PRIMARY KEY,'
+                ' operation TEXT NOT NULL,'
+                ' body BLOB NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' created REAL NOT NULL,'
+                ' accessed REAL NOT NULL)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._size = self._total_size()
+        # key -> time of its last get not written yet
+        self._accessed = {}
+
+    def key(self, operation, params):
+        """
+        Returns the cache key of a request made with ``params``.
+        """
+        params = sorted((name, value) for name, value in params.items()
+                        if name not in self.UNKEYED_PARAMS)
+        data = json.dumps([operation, params], default=str)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def get(self, operation, key):
+        """
+        Returns the stored body for ``key`` or ``None`` when it is missing,
+        expired or the cache is being refreshed. Entries expire after the
+        TTL of the operation they were stored under, ``operation`` unless
+        e.g. a negative answer was stored in its place.
+        """
+        if self.refresh:
+            return None
+
+        with self._lock:
+            row = self._db.execute(
+                'SELECT body, created, operation FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+
+            body, created, operation = row
+            now = time.time()
+            if created + self.ttls.get(operation, DAY) < now:
+                return None
+
+            self._accessed[key] = now
+            if len(self._accessed) >= self.ACCESS_BATCH:
+                self._write_accessed()
+
+        return zlib.decompress(body)
+
+    def set(self, operation, key, body):
+        body = zlib.compress(body)
+        now = time.time()
+
+        with self._lock:
+            with self._db:
+                replaced = self._db.execute(
+                    'SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+                self._db.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, operation, body, len(body), now, now))
+            self._accessed.pop(key, None)
+            self._size += len(body) - (replaced[0] if replaced else 0)
+
+            if self._size > self.max_size:
+                self._evict()
+
+    def _write_accessed(self):
+        with self._db:
+            self._db.executemany(
+                'UPDATE responses SET accessed = ? WHERE key = ?',
+                [(accessed, key) for key, accessed in self._accessed.items()])
+        self._accessed.clear()
+
+    def _total_size(self):
+        return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def _evict(self):
+        # leave some headroom so we don't evict on every insert
+        target = self.max_size * 0.9
+        self._write_accessed()
+        self._size = self._total_size()
+
+        with self._db:
+            cursor = self._db.execute('SELECT key, size FROM responses ORDER BY accessed')
+            keys = []
+            for key, size in cursor:
+                if self._size <= target:
+                    break
+                keys.append((key,))
+                self._size -= size
+            self._db.executemany('DELETE FROM responses WHERE key = ?', keys)
+
+    def prune(self):
+        """
+        Removes expired entries and enforces the size cap. Returns the
+        number of entries removed.
+        """
+        now = time.time()
+
+        with self._lock:
+            before = self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            with self._db:
+                for operation, ttl in self.ttls.items():
+                    self._db.execute(
+                        'DELETE FROM responses WHERE operation = ? AND created < ?',
+                        (operation, now - ttl))
+            self._size = self._total_size()
+            if self._size > self.max_size:
+                self._evict()
+            after = self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            self._db.execute('VACUUM')
+
+        return before - after
+
+    def close(self):
+        with self._lock:
+            self._write_accessed()
+            self._db.close()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Reuse of query results across rows asking for the same book.
+"""
+
+import threading
+
+from amazonbookquery.errors import CircuitOpen, RetriesExhausted
+from amazonbookquery.singleflight import SingleFlight
+
+__all__ = ['QueryDeduplicator']
+
+
+class QueryDeduplicator(object):
+    """
+    Runs each distinct query key once and hands its result, or its error,
+    to every row with that key while it is among the ``window`` keys
+    asked for last; older results are dropped, so memory stays bounded by
+    ``window`` whatever the size of the input. Errors that may go away on
+    a later try are not shared with later rows.
+    """
+
+    WINDOW = 10000
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.rows = 0
+        self.unique = 0
+
+        self._lock = threading.Lock()
+        self._flights = SingleFlight(window)
+
+    @property
+    def saved(self):
+        """
+        Number of queries avoided by sharing results.
+        """
+        return self.rows - self.unique
+
+    def execute(self, key, function):
+        with self._lock:
+            self.rows += 1
+
+        def run():
+            with self._lock:
+                self.unique += 1
+            return function()
+
+        try:
+            # rows must not share a result they may modify
+            return self._flights.do(key, run).copy()
+        except (RetriesExhausted, CircuitOpen):
+            self._flights.forget(key)
+            raise
@@ -7,7 +7,9 @@ import re
 import sys
 
 __all__ = [
-    'AccountLimitExceeded', 'AWSError', 'CartInfoMismatch', 'DEFAULT_ERROR_REGS',
+    'AccountLimitExceeded', 'AWSError', 'CaptchaRequired', 'CartInfoMismatch', 'CircuitOpen',
+    'DEFAULT_ERROR_REGS',
+    'HTTPStatusError', 'NetworkError', 'RetriesExhausted',
     'InvalidClientTokenId', 'InvalidSignature', 'InvalidAccount', 'MissingClientTokenId', 'MissingParameters',
     'ParameterOutOfRange', 'DeprecatedOperation', 'InternalError',
     'InvalidCartId', 'InvalidCartItem', 'InvalidListType', 'InvalidOperation',
@@ -28,19 +30,22 @@ class AWSError(Exception):
         ``msg``
             The original error message from Amazon
 
-        ``xml``
-            XML returned from Amazon as processed by the API's result processor
+        ``snippet``
+            The beginning of the XML of the error returned from Amazon, at
+            most ``SNIPPET_LENGTH`` characters
 
     You can (and should) still pass additional arguments to derived exceptions
     which (as with :class:`BaseException`) will be stored in ``args``.
     """
 
+    SNIPPET_LENGTH = 500
+
     def __init__(self, *args, **kwargs):
         Exception.__init__(self)
         self.args = args
         self.code = kwargs.pop('code', None)
         self.msg = kwargs.pop('msg', None)
-        self.xml = kwargs.pop('xml', None)
+        self.snippet = kwargs.pop('snippet', None)
 
     def __str__(self):  # pragma: no cover
         if self.code is not None:
@@ -223,6 +228,49 @@ class AccountLimitExceeded(AWSError):
     """
 
 
+class HTTPStatusError(AWSError):
+    """
+    The server answered with an HTTP status that carries no usable content.
+    The status code is kept as ``status``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.status = kwargs.pop('status', None)
+        AWSError.__init__(self, *args, **kwargs)
+
+
+class NetworkError(AWSError):
+    """
+    The request failed before an answer was received (connection refused,
+    reset or timed out).
+    """
+
+
+class CaptchaRequired(AWSError):
+    """
+    Amazon answered a detail page request with a captcha instead of the page.
+    """
+
+
+class CircuitOpen(AWSError):
+    """
+    Too many consecutive requests to this host failed and it has been down
+    for longer than requests wait for it, they are suspended until a trial
+    request succeeds.
+    """
+
+
+class RetriesExhausted(AWSError):
+    """
+    The request still failed after the maximum number of attempts. The last
+    error is kept as ``error``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.error = kwargs.pop('error', None)
+        AWSError.__init__(self, *args, **kwargs)
+
+
 DEFAULT_ERROR_REGS = {
     'invalid-value': re.compile(
         'The value you specified for (?P<parameter>\w+) is invalid.'),
@@ -248,17 +296,21 @@ DEFAULT_ERROR_REGS = {
     'missing-parameters': re.compile(
         'Your request is missing required parameters. Required parameters '
         'include (?P<parameter>\w+).'),
+
+    'access-key-id': re.compile(
+        r'AWS Access Key ID: \S+?\.\s*'),
 }
 
 def _e(error_class, *args, **kwargs):
     """
     Returns an exception of type ``error_class`` based on an instance of
-    :class:`AWSError`  all relevant information appended.
+    :class:`AWSError`  all relevant information appended. The instance is
+    the exception currently being handled unless passed as ``exc``.
     """
-    exc = sys.exc_info()[1]
+    exc = kwargs.pop('exc', None) or sys.exc_info()[1]
     error = error_class(*args)
     error.msg = exc.msg
     error.code = exc.code
-    error.xml = exc.xml
+    error.snippet = exc.snippet
     return error
 
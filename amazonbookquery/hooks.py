@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Hooks run around the hot spots of a query, for timing and profiling
+without patching the package.
+
+The points are named after the methods they wrap:
+
+    ``Query._call``                one signed API call, cached or not
+    ``Parser.parse_item_lookup``   parsing of an ItemLookup response
+    ``Parser.parse_item_lookups``  parsing of a batched ItemLookup response
+    ``Scrapy.scrape``              download and parsing of a detail page
+    ``Scrapy.parse``               parsing of a loaded detail page
+    ``BookQuery._process_row``     everything done for one source row
+    ``BookQuery.emit``             writing one row to the output
+
+    >>> def report(point, seconds):
+    ...     print(point, seconds)
+    >>> add_timing_hook('Scrapy.parse', report)
+"""
+
+import functools
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+__all__ = ['POINTS', 'add_hook', 'remove_hook', 'add_timing_hook', 'around', 'hooked']
+
+POINTS = (
+    'Query._call',
+    'Parser.parse_item_lookup',
+    'Parser.parse_item_lookups',
+    'Scrapy.scrape',
+    'Scrapy.parse',
+    'BookQuery._process_row',
+    'BookQuery.emit',
+)
+
+_lock = threading.Lock()
+# replaced, never modified, so readers need no lock
+_hooks = {}
+
+
+def add_hook(point, hook):
+    """
+    Registers ``hook``, called with the point name every time the point is
+    reached and returning a context manager entered around it.
+    """
+    global _hooks
+    if point not in POINTS:
+        raise ValueError('Unknown hook point: {}'.format(point))
+    with _lock:
+        hooks = dict(_hooks)
+        hooks[point] = hooks.get(point, ()) + (hook,)
+        _hooks = hooks
+
+
+def remove_hook(point, hook):
+    global _hooks
+    with _lock:
+        hooks = dict(_hooks)
+        hooks[point] = tuple(h for h in hooks.get(point, ()) if h is not hook)
+        if not hooks[point]:
+            del hooks[point]
+        _hooks = hooks
+
+
+def add_timing_hook(point, callback):
+    """
+    Calls ``callback(point, seconds)`` after every pass through ``point``,
+    whether it raised or not. Returns the hook for :func:`remove_hook`.
+    """
+    @contextmanager
+    def hook(point):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            callback(point, time.perf_counter() - start)
+
+    add_hook(point, hook)
+    return hook
+
+
+@contextmanager
+def around(point):
+    """
+    Runs the hooks of ``point`` around the ``with`` block.
+    """
+    hooks = _hooks.get(point)
+    if not hooks:
+        yield
+        return
+
+    with ExitStack() as stack:
+        for hook in hooks:
+            stack.enter_context(hook(point))
+        yield
+
+
+def hooked(point):
+    """
+    Decorates a method with the hooks of ``point``. Costs a dict lookup
+    when no hook is registered.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if point not in _hooks:
+                return function(*args, **kwargs)
+            with around(point):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Durable record of the rows a run has completed.
+"""
+
+import csv
+import os
+import time
+
+__all__ = ['Journal']
+
+
+class Journal(object):
+    """
+    Append-only TSV file holding one record per completed row: its
+    identifier, the time it completed, the number of output fields and the
+    output row itself. Records are flushed to disk every ``sync_every``
+    rows so a crashed run loses at most that many of them.
+    """
+
+    # written after every record by the csv module
+    TERMINATOR = b"\r\n"
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, path, sync_every=1):
+        self.path = path
+        self.sync_every = sync_every
+
+        self._fd = None
+        self._writer = None
+        self._unsynced = 0
+        # size of the file when it was opened, where the records of this
+        # run start
+        self.resumed_at = 0
+
+    def load(self):
+        """
+        Returns a dict of ``identifier -> (completed, row)`` for every
+        complete record. A record cut short by a crash is ignored.
+        """
+        return dict((identifier, (completed, row))
+                    for identifier, completed, row in self.records())
+
+    def records(self, offset=0):
+        """
+        Yields the ``(identifier, completed, row)`` of every complete
+        record, in the order they were recorded, from byte ``offset`` on.
+        A record cut short by a crash is ignored.
+        """
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, "r", encoding="utf-8", newline="") as fd:
+            # an offset between records is also a position of the utf-8 text
+            fd.seek(offset)
+            reader = csv.reader(fd, delimiter="\t")
+            while True:
+                try:
+                    record = next(reader)
+                except StopIteration:
+                    break
+                except csv.Error:
+                    continue
+
+                try:
+                    identifier, completed, length = record[0], float(record[1]), int(record[2])
+                except (IndexError, ValueError):
+                    continue
+                if len(record) - 3 != length:
+                    continue
+
+                yield identifier, completed, record[3:]
+
+    def open(self, resume=False):
+        if resume and os.path.isfile(self.path):
+            # a record cut short in a quoted field would swallow the next
+            # one, it goes before anything is appended
+            self._truncate_partial()
+            self.resumed_at = os.path.getsize(self.path)
+            self._fd = open(self.path, "a", encoding="utf-8", newline="")
+        else:
+            self.resumed_at = 0
+            self._fd = open(self.path, "w", encoding="utf-8", newline="")
+
+        self._writer = csv.writer(self._fd, delimiter="\t")
+
+    def _truncate_partial(self):
+        """
+        Cuts the file after the line terminator of its last record.
+        """
+        with open(self.path, "r+b") as fd:
+            size = fd.seek(0, os.SEEK_END)
+            keep = 0
+            end = size
+            while end > 0:
+                start = max(0, end - self.CHUNK_SIZE)
+                fd.seek(start)
+                # one byte more, the terminator may straddle two chunks
+                index = fd.read(min(size, end + 1) - start).rfind(self.TERMINATOR)
+                if index != -1:
+                    keep = start + index + len(self.TERMINATOR)
+                    break
+                end = start
+            if keep < size:
+                fd.truncate(keep)
+
+    def record(self, identifier, row, completed=None):
+        """
+        Records ``row``, as completed at ``completed`` or now.
+        """
+        if completed is None:
+            completed = time.time()
+        self._writer.writerow([identifier, completed, len(row)] + list(row))
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        if self._fd is not None:
+            self.sync()
+            self._fd.close()
+            self._fd = None
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""
+Latency histograms and counters of the stages of a run.
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+__all__ = ['STAGES', 'Histogram', 'Metrics']
+
+# sign, throttle, fetch and parse are API calls, row is all the work for a
+# row but its writing to the output file
+STAGES = ('sign', 'throttle', 'fetch', 'parse', 'scrape_fetch', 'scrape_parse', 'row', 'write')
+
+PREFIX = 'amazonbookquery'
+
+
+class Histogram(object):
+    """
+    Counts observations, in seconds, in buckets with the upper bounds
+    ``BUCKETS``, the last bucket taking everything above.
+    """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Estimates quantile ``q`` by linear interpolation within its bucket,
+        as Prometheus does, bounded by the smallest and largest observations.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        lower = self.min
+        for bound, count in zip(self.BUCKETS + (self.max,), self.counts):
+            if count and seen + count >= rank:
+                upper = min(max(bound, lower), self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = max(bound, self.min)
+        return self.max
+
+    def merge(self, summary):
+        """
+        Adds the observations of ``summary``, as made by :meth:`summary`.
+        """
+        if not summary['count']:
+            return
+        for i, count in enumerate(summary['buckets']):
+            self.counts[i] += count
+        self.count += summary['count']
+        self.sum += summary['sum']
+        for attr, pick in (('min', min), ('max', max)):
+            mine = getattr(self, attr)
+            setattr(self, attr, summary[attr] if mine is None else pick(mine, summary[attr]))
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': list(self.counts),
+        }
+
+
+class Metrics(object):
+    """
+    Thread safe store of one :class:`Histogram` per stage, of event
+    counters (cache hits, retries...) and of error counters keyed by
+    :class:`AWSError` subclass.
+
+    A run reports with :meth:`summary`, a JSON friendly dict, and with
+    :meth:`prometheus`, the Prometheus text format, which can be written
+    to a file or served over HTTP while the run goes on.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+
+        self._lock = threading.Lock()
+        self._histograms = dict((stage, Histogram()) for stage in STAGES)
+        self._events = {}
+        self._errors = {}
+        self._server = None
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self._histograms[stage].observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        """
+        Observes the time spent in the ``with`` block, exception or not.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, event, n=1):
+        with self._lock:
+            self._events[event] = self._events.get(event, 0) + n
+
+    def error(self, error):
+        """
+        Counts ``error`` under the name of its class.
+        """
+        name = type(error).__name__
+        with self._lock:
+            self._errors[name] = self._errors.get(name, 0) + 1
+
+    def merge(self, summary):
+        """
+        Adds a :meth:`summary` of another run, e.g. of a worker process.
+        """
+        with self._lock:
+            self.started = min(self.started, summary['started'])
+            for stage, histogram in summary['stages'].items():
+                self._histograms[stage].merge(histogram)
+            for counters, other in ((self._events, summary['events']),
+                                    (self._errors, summary['errors'])):
+                for name, n in other.items():
+                    counters[name] = counters.get(name, 0) + n
+
+    def summary(self):
+        with self._lock:
+            return {
+                'started': self.started,
+                'elapsed': time.time() - self.started,
+                'stages': dict((stage, h.summary()) for stage, h in self._histograms.items()),
+                'events': dict(self._events),
+                'errors': dict(self._errors),
+            }
+
+    def write_json(self, path):
+        _write_atomically(path, json.dumps(self.summary(), indent=2, sort_keys=True) + '\n')
+
+    def prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        summary = self.summary()
+        lines = [
+            '# TYPE {}_stage_seconds histogram'.format(PREFIX),
+        ]
+        for stage in STAGES:
+            histogram = summary['stages'][stage]
+            cumulative = 0
+            bounds = [repr(float(b)) for b in Histogram.BUCKETS] + ['+Inf']
+            for bound, count in zip(bounds, histogram['buckets']):
+                cumulative += count
+                lines.append('{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                    PREFIX, stage, bound, cumulative))
+            lines.append('{}_stage_seconds_sum{{stage="{}"}} {!r}'.format(
+                PREFIX, stage, histogram['sum']))
+            lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(
+                PREFIX, stage, histogram['count']))
+
+        lines.append('# TYPE {}_events_total counter'.format(PREFIX))
+        for event, n in sorted(summary['events'].items()):
+            lines.append('{}_events_total{{event="{}"}} {}'.format(PREFIX, event, n))
+
+        lines.append('# TYPE {}_errors_total counter'.format(PREFIX))
+        for error, n in sorted(summary['errors'].items()):
+            lines.append('{}_errors_total{{error="{}"}} {}'.format(PREFIX, error, n))
+
+        lines.append('# TYPE {}_elapsed_seconds gauge'.format(PREFIX))
+        lines.append('{}_elapsed_seconds {!r}'.format(PREFIX, summary['elapsed']))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        _write_atomically(path, self.prometheus())
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serves :meth:`prometheus` on ``http://host:port/metrics`` from a
+        daemon thread until :meth:`close`. Only local clients can connect
+        unless ``host`` is another address, ``''`` for all interfaces.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _write_atomically(path, text):
+    # scrapers and readers never see a half written file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as fd:
+        fd.write(text)
+    os.replace(tmp_path, path)
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+"""
+Normalization of titles and authors into lookup keys.
+"""
+
+import re
+import unicodedata
+
+__all__ = ['normalize_text', 'query_key']
+
+PUNCTUATION = re.compile(r'[^\w\s]', re.UNICODE)
+WHITESPACE = re.compile(r'\s+', re.UNICODE)
+
+
+def normalize_text(text):
+    """
+    Lowercases ``text`` and drops accents, punctuation and repeated
+    whitespace, so that spelling variants of a catalog entry compare equal.
+    """
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = PUNCTUATION.sub(' ', text.lower())
+    return WHITESPACE.sub(' ', text).strip()
+
+
+def query_key(title, author):
+    """
+    Returns the key under which queries for ``title`` by ``author`` are
+    considered identical.
+    """
+    return normalize_text(title) + '\t' + normalize_text(author)
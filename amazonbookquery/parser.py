@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 
 from lxml import etree, objectify
-from amazonbookquery.errors import AWSError
+from collections import OrderedDict
+from amazonbookquery.errors import AWSError, DEFAULT_ERROR_REGS
+from amazonbookquery.hooks import hooked
+from amazonbookquery.result import OFFER_FIELDS, BookResult
 
 class SelectiveClassLookup(etree.CustomElementClassLookup):
     """
@@ -23,46 +26,115 @@ class Parser:
         lookup.set_fallback(objectify.ObjectifyElementClassLookup())
         self._parser.set_element_class_lookup(lookup)
 
-    def _get_item(self, data):
+    def _get_root(self, data):
         tree = objectify.parse(data, self._parser)
-        root = tree.getroot()
+        return tree.getroot()
 
+    def _get_errors(self, root):
         try:
             nspace = root.nsmap[None]
             errors = root.xpath('//aws:Error', namespaces={'aws': nspace})
         except KeyError:
             errors = root.xpath('//Error')
 
-        for error in errors:
-            raise AWSError(
-                code = error.Code.text,
-                msg = error.Message.text,
-                xml = root
-            )
+        # a snippet of the error, not the tree, which would stay alive with it
+        return [AWSError(
+            code = error.Code.text,
+            msg = error.Message.text,
+            snippet = etree.tostring(error, encoding='unicode')[:AWSError.SNIPPET_LENGTH]
+        ) for error in errors]
+
+    def _get_item(self, data):
+        root = self._get_root(data)
+
+        for error in self._get_errors(root):
+            raise error
 
         item = root.Items.Item
         return item
 
+    def _get_items(self, root):
+        try:
+            return list(root.Items.Item)
+        except AttributeError:
+            return []
+
+    def _get_asin(self, item):
+        return item.ASIN.text
+
+    def _has_detail_page_url(self, item):
+        return hasattr(item, 'DetailPageURL')
+
     def parse_item_search(self, data):
         item = self._get_item(data)
-        asin = item.ASIN.text
+        asin = self._get_asin(item)
 
         return asin
 
+    def parse_item_search_item(self, data):
+        """
+        Parses an ItemSearch response asked for the groups of a lookup.
+        Returns the ASIN of the first item and what :meth:`parse_item_lookup`
+        returns for it, or ``None`` instead when the item has no
+        ``DetailPageURL``.
+        """
+        item = self._get_item(data)
+        asin = self._get_asin(item)
+
+        if not self._has_detail_page_url(item):
+            return asin, None
+
+        return asin, self._parse_lookup_item(item)
+
+    @hooked('Parser.parse_item_lookup')
     def parse_item_lookup(self, data):
         item = self._get_item(data)
+        return self._parse_lookup_item(item)
+
+    @hooked('Parser.parse_item_lookups')
+    def parse_item_lookups(self, data):
+        """
+        Parses an ItemLookup response for several comma separated ItemIds.
+        Returns a dict with one result per ``Item`` keyed by ASIN. ItemIds
+        Amazon rejected map to their :class:`AWSError` instead, the whole
+        response only raises when it holds no item at all.
+        """
+        root = self._get_root(data)
+        errors = self._get_errors(root)
+
+        items = self._get_items(root)
+
+        if not items:
+            for error in errors:
+                raise error
+
+        results = OrderedDict()
+        for item in items:
+            results[self._get_asin(item)] = self._parse_lookup_item(item)
+
+        for error in errors:
+            m = DEFAULT_ERROR_REGS['invalid-parameter-value'].search(error.msg or '')
+            if m is not None and m.group('parameter') == 'ItemId':
+                results.setdefault(m.group('value'), error)
+
+        return results
+
+    def _parse_lookup_item(self, item):
         nspace = item.nsmap[None]
         author = detail_page_url = title = None
         sold_by_amazon = False
         sold_by_amazon_as_new = False
 
         attributes = offers = []
+        offer_summary = None
 
         for child in item.getchildren():
             if child.tag == '{' + nspace + '}' + 'ItemAttributes':
                 attributes = item.ItemAttributes.getchildren()
             if child.tag == '{' + nspace + '}' + 'Offers':
                 offers = item.Offers.getchildren()
+            if child.tag == '{' + nspace + '}' + 'OfferSummary':
+                offer_summary = child
 
         for attribute in attributes:
             if attribute.tag == '{' + nspace + '}' + 'Author':
@@ -80,10 +152,266 @@ class Parser:
 
         detail_page_url = item.DetailPageURL.text
 
-        return {
-            'detail_page_url': detail_page_url,
-            'author': author,
-            'title': title,
-            'sold_by_amazon': sold_by_amazon,
-            'sold_by_amazon_as_new': sold_by_amazon_as_new,
-        }
\ No newline at end of file
+        return BookResult(
+            detail_page_url=detail_page_url,
+            author=author,
+            title=title,
+            sold_by_amazon=sold_by_amazon,
+            sold_by_amazon_as_new=sold_by_amazon_as_new,
+            **self._parse_offer_summary(offer_summary, nspace)
+        )
+
+    def _parse_offer_summary(self, offer_summary, nspace):
+        """
+        Returns the offer counts and lowest prices of an ``OfferSummary``
+        as keyword arguments of :class:`BookResult`, with the values
+        :meth:`Scrapy.parse` would give. Every value is ``None`` when the
+        response has no summary.
+        """
+        ret = {
+            'total_new': None,
+            'total_used': None,
+            'total_collectible': None,
+            'lowest_new_price': None,
+            'lowest_used_price': None,
+            'lowest_collectible_price': None,
+        }
+
+        if offer_summary is None:
+            return ret
+
+        totals = {
+            '{' + nspace + '}' + 'TotalNew': 'total_new',
+            '{' + nspace + '}' + 'TotalUsed': 'total_used',
+            '{' + nspace + '}' + 'TotalCollectible': 'total_collectible',
+        }
+        prices = {
+            '{' + nspace + '}' + 'LowestNewPrice': 'lowest_new_price',
+            '{' + nspace + '}' + 'LowestUsedPrice': 'lowest_used_price',
+            '{' + nspace + '}' + 'LowestCollectiblePrice': 'lowest_collectible_price',
+        }
+
+        for key in totals.values():
+            ret[key] = 0
+        for key in prices.values():
+            ret[key] = ""
+
+        for child in offer_summary.getchildren():
+            if child.tag in totals:
+                ret[totals[child.tag]] = int(child.text)
+            if child.tag in prices:
+                for price in child.getchildren():
+                    # amounts are given in cents
+                    if price.tag == '{' + nspace + '}' + 'Amount':
+                        ret[prices[child.tag]] = int(price.text) / 100.0
+
+        return ret
+
+class _Tags(object):
+    """
+    The qualified names of the tags read by :class:`EtreeParser` in one
+    namespace, computed once.
+    """
+
+    NAMES = ('Items', 'Item', 'ASIN', 'DetailPageURL', 'Error', 'Code', 'Message',
+             'ItemAttributes', 'Author', 'Title', 'Offers', 'Offer', 'Merchant', 'Name',
+             'OfferAttributes', 'Condition', 'OfferSummary', 'TotalNew', 'TotalUsed',
+             'TotalCollectible', 'LowestNewPrice', 'LowestUsedPrice', 'LowestCollectiblePrice',
+             'Amount')
+
+    def __init__(self, nspace):
+        prefix = '{' + nspace + '}' if nspace else ''
+        for name in self.NAMES:
+            setattr(self, name, prefix + name)
+
+        self.totals = {
+            self.TotalNew: 'total_new',
+            self.TotalUsed: 'total_used',
+            self.TotalCollectible: 'total_collectible',
+        }
+        self.prices = {
+            self.LowestNewPrice: 'lowest_new_price',
+            self.LowestUsedPrice: 'lowest_used_price',
+            self.LowestCollectiblePrice: 'lowest_collectible_price',
+        }
+
+
+def _child(element, tag):
+    """
+    Returns the first child ``tag`` of ``element``, raising
+    ``AttributeError`` like objectify when there is none.
+    """
+    child = element.find(tag)
+    if child is None:
+        raise AttributeError('no such child: ' + tag)
+    return child
+
+
+class EtreeParser(Parser):
+    """
+    Gives the same results and raises the same errors as :class:`Parser`
+    from a plain lxml tree: no objectify element classes are looked up or
+    instantiated, and the tags read are compared with qualified names
+    computed once per namespace, instead of being built for every child.
+    """
+
+    def __init__(self):
+        self._parser = etree.XMLParser()
+        self._tags = {}
+
+    def _get_tags(self, nspace):
+        tags = self._tags.get(nspace)
+        if tags is None:
+            tags = self._tags[nspace] = _Tags(nspace)
+        return tags
+
+    def _tags_of(self, element):
+        """
+        Returns the tags in the namespace of ``element``, where objectify
+        looks its children up.
+        """
+        return self._get_tags(etree.QName(element).namespace)
+
+    def _get_root(self, data):
+        return etree.parse(data, self._parser).getroot()
+
+    def _get_errors(self, root):
+        # like //aws:Error with the default namespace, or //Error without
+        tags = self._get_tags(root.nsmap.get(None))
+
+        errors = []
+        for error in root.iter(tags.Error):
+            errors.append(AWSError(
+                code=_child(error, tags.Code).text,
+                msg=_child(error, tags.Message).text,
+                snippet=etree.tostring(error, encoding='unicode')[:AWSError.SNIPPET_LENGTH]
+            ))
+        return errors
+
+    def _get_item(self, data):
+        root = self._get_root(data)
+
+        for error in self._get_errors(root):
+            raise error
+
+        tags = self._tags_of(root)
+        return _child(_child(root, tags.Items), tags.Item)
+
+    def _get_items(self, root):
+        tags = self._tags_of(root)
+        items = root.find(tags.Items)
+        if items is None:
+            return []
+        return items.findall(tags.Item)
+
+    def _get_asin(self, item):
+        return _child(item, self._tags_of(item).ASIN).text
+
+    def _has_detail_page_url(self, item):
+        return item.find(self._tags_of(item).DetailPageURL) is not None
+
+    def _parse_lookup_item(self, item):
+        tags = self._get_tags(item.nsmap[None])
+        author = title = None
+        sold_by_amazon = False
+        sold_by_amazon_as_new = False
+
+        attributes = offers = detail_page_url = offer_summary = None
+
+        for child in item:
+            tag = child.tag
+            # the first of each but the last OfferSummary, as objectify does
+            if tag == tags.ItemAttributes:
+                if attributes is None:
+                    attributes = child
+            elif tag == tags.Offers:
+                if offers is None:
+                    offers = child
+            elif tag == tags.OfferSummary:
+                offer_summary = child
+            elif tag == tags.DetailPageURL:
+                if detail_page_url is None:
+                    detail_page_url = child
+
+        if attributes is not None:
+            for attribute in attributes:
+                if attribute.tag == tags.Author:
+                    author = attribute.text
+                elif attribute.tag == tags.Title:
+                    title = attribute.text
+
+        if offers is not None:
+            for offer in offers:
+                if offer.tag != tags.Offer:
+                    continue
+                for child in offer:
+                    if child.tag == tags.Merchant:
+                        sold_by_amazon = (_child(child, tags.Name).text == 'Amazon.com')
+                    if sold_by_amazon and child.tag == tags.OfferAttributes:
+                        sold_by_amazon_as_new = (_child(child, tags.Condition).text == 'New')
+
+        if detail_page_url is None:
+            raise AttributeError('no such child: ' + tags.DetailPageURL)
+
+        return BookResult(
+            detail_page_url=detail_page_url.text,
+            author=author,
+            title=title,
+            sold_by_amazon=sold_by_amazon,
+            sold_by_amazon_as_new=sold_by_amazon_as_new,
+            **self._parse_offer_summary(offer_summary, tags)
+        )
+
+    def _parse_offer_summary(self, offer_summary, tags):
+        if offer_summary is None:
+            return dict.fromkeys(OFFER_FIELDS)
+
+        ret = dict.fromkeys(tags.totals.values(), 0)
+        ret.update(dict.fromkeys(tags.prices.values(), ""))
+
+        for child in offer_summary:
+            if child.tag in tags.totals:
+                ret[tags.totals[child.tag]] = int(child.text)
+            elif child.tag in tags.prices:
+                for price in child:
+                    # amounts are given in cents
+                    if price.tag == tags.Amount:
+                        ret[tags.prices[child.tag]] = int(price.text) / 100.0
+
+        return ret
+
+
+def split_item_lookups(data):
+    """
+    Returns the ItemLookup response ``data``, asked for several ItemIds,
+    as it would have been for each of its items alone: the bytes of a
+    response holding that item only, keyed by ASIN. The errors, which are
+    about other ItemIds, are left out.
+    """
+    root = etree.parse(data).getroot()
+    tags = _Tags(root.nsmap.get(None))
+
+    for error in list(root.iter(tags.Error)):
+        error.getparent().remove(error)
+
+    ret = OrderedDict()
+    items = root.find(tags.Items)
+    if items is None:
+        return ret
+
+    found = items.findall(tags.Item)
+    for item in found:
+        items.remove(item)
+    for item in found:
+        items.append(item)
+        ret[_child(item, tags.ASIN).text] = etree.tostring(
+            root, xml_declaration=True, encoding='utf-8')
+        items.remove(item)
+    return ret
+
+
+# parser classes by the name given to --parse-engine
+PARSE_ENGINES = {
+    'objectify': Parser,
+    'etree': EtreeParser,
+}
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Concurrent execution of per-row work for :class:`BookQuery`.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncPipeline(object):
+    """
+    Runs ``process`` over input rows on a thread pool driven by an asyncio
+    event loop. At most ``concurrency`` rows are in flight at any time and
+    results are handed to ``emit`` in input order through a reorder buffer.
+
+    ``process`` is expected to be the same blocking callable used by the
+    serial path, so throttling still happens inside :class:`Query`.
+
+    Every :meth:`run` has its own thread pool, unless the pipeline was
+    opened, as a context manager or with :meth:`open`: its threads then
+    serve every run until :meth:`close`.
+    """
+
+    def __init__(self, process, concurrency, window=None):
+        self.process = process
+        self.concurrency = concurrency
+        # upper bound of rows either running or waiting in the reorder buffer
+        self.window = window or concurrency * 4
+
+        self._loop = None
+        self._executor = None
+
+    def open(self):
+        if self._executor is None:
+            self._loop = asyncio.new_event_loop()
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        return self
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._loop.close()
+            self._executor = self._loop = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def run(self, datas, emit):
+        if self._executor is None:
+            with self:
+                return self.run(datas, emit)
+
+        self._loop.run_until_complete(self._run(self._loop, self._executor, datas, emit))
+
+    def _process(self, index, data):
+        return index, self.process(data)
+
+    async def _run(self, loop, executor, datas, emit):
+        in_flight = done = set()
+        buffer = {}
+        next_index = 0
+
+        try:
+            for index, data in enumerate(datas):
+                while in_flight and (len(in_flight) >= self.concurrency or
+                                     len(in_flight) + len(buffer) >= self.window):
+                    done, in_flight = await asyncio.wait(
+                        in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    next_index = self._drain(done, buffer, next_index, emit)
+
+                in_flight.add(loop.run_in_executor(executor, self._process, index, data))
+
+            while in_flight:
+                done, in_flight = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED)
+                next_index = self._drain(done, buffer, next_index, emit)
+        except BaseException:
+            # the rows still running end before the error is raised, the
+            # errors of the other rows are not reported
+            if in_flight:
+                await asyncio.wait(in_flight)
+            for future in done | in_flight:
+                if not future.cancelled():
+                    future.exception()
+            raise
+
+    def _drain(self, done, buffer, next_index, emit):
+        for future in done:
+            index, row = future.result()
+            buffer[index] = row
+
+        while next_index in buffer:
+            emit(buffer.pop(next_index))
+            next_index += 1
+
+        return next_index
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+cProfile dumps per stage of a run, for a sample of its rows.
+"""
+
+import cProfile
+import os
+import pstats
+import threading
+from contextlib import contextmanager
+from amazonbookquery.hooks import add_hook, remove_hook
+
+__all__ = ['Profiler']
+
+
+class Profiler(object):
+    """
+    Profiles the stages of the rows sampled out of a run and writes one
+    pstats file per stage to ``directory``, ``api.pstats`` for instance:
+
+        $ python -m pstats api.pstats
+
+    ``sample`` is the fraction of rows profiled, spread evenly over the
+    run. Profiles are per thread, so concurrent rows do not mix; their
+    stats are added up in the dumps. Use it as a context manager around
+    the run.
+    """
+
+    # hook point -> stage; stages must not nest within a thread
+    STAGES = {
+        'Query._call': 'api',
+        'Scrapy.scrape': 'scrape',
+        'BookQuery.emit': 'write',
+    }
+
+    def __init__(self, directory, sample=1.0):
+        self.directory = directory
+        self.sample = sample
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._rows = 0
+        self._writes = 0
+        self._profiles = dict((stage, []) for stage in self.STAGES.values())
+        self._hooks = []
+
+    def _sampled(self, counter):
+        """
+        Tells whether the next of the events counted by ``counter`` is
+        sampled, spreading ``sample`` evenly over them.
+        """
+        with self._lock:
+            n = getattr(self, counter) + 1
+            setattr(self, counter, n)
+        return int(n * self.sample) != int((n - 1) * self.sample)
+
+    @contextmanager
+    def _row(self, point):
+        self._local.sampled = self._sampled('_rows')
+        try:
+            yield
+        finally:
+            self._local.sampled = False
+
+    def _stage(self, stage):
+        @contextmanager
+        def hook(point):
+            if stage == 'write':
+                # rows are written from another thread than they are processed
+                sampled = self._sampled('_writes')
+            else:
+                sampled = getattr(self._local, 'sampled', False)
+            if not sampled:
+                yield
+                return
+
+            profile = self._profile(stage)
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+        return hook
+
+    def _profile(self, stage):
+        profiles = self._local.__dict__.setdefault('profiles', {})
+        if stage not in profiles:
+            profiles[stage] = cProfile.Profile()
+            with self._lock:
+                self._profiles[stage].append(profiles[stage])
+        return profiles[stage]
+
+    def install(self):
+        self._hooks = [('BookQuery._process_row', self._row)]
+        self._hooks.extend((point, self._stage(stage)) for point, stage in self.STAGES.items())
+        for point, hook in self._hooks:
+            add_hook(point, hook)
+
+    def uninstall(self):
+        for point, hook in self._hooks:
+            remove_hook(point, hook)
+        self._hooks = []
+
+    def dump(self):
+        """
+        Writes the stats of every stage that saw a sampled row and returns
+        the paths written.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        paths = []
+        with self._lock:
+            for stage, profiles in sorted(self._profiles.items()):
+                if not profiles:
+                    continue
+                stats = pstats.Stats(profiles[0])
+                for profile in profiles[1:]:
+                    stats.add(profile)
+                path = os.path.join(self.directory, stage + '.pstats')
+                stats.dump_stats(path)
+                paths.append(path)
+        return paths
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+        self.dump()
@@ -1,36 +1,103 @@
 #!/usr/bin/env python
 
 import os
+import re
 import sys
-import requests
 import hmac
-import functools
+from io import BytesIO
 from base64 import b64encode
 from hashlib import sha256
-from datetime import datetime, timedelta
-from time import strftime, gmtime, sleep
+from time import strftime, gmtime
 from urllib.parse import quote
-from urllib.request import HTTPError
+from amazonbookquery.asinindex import similarity
+from amazonbookquery.batch import LookupBatcher
 from amazonbookquery.errors import *
-from amazonbookquery.parser import Parser
-from amazonbookquery.scrapy import Scrapy
+from amazonbookquery.hooks import hooked
+from amazonbookquery.metrics import Metrics
+from amazonbookquery.normalize import query_key
+from amazonbookquery.parser import PARSE_ENGINES, split_item_lookups
+from amazonbookquery.ratelimit import TokenBucket
+from amazonbookquery.result import OFFER_FIELDS
+from amazonbookquery.retry import RetryPolicy
+from amazonbookquery.scrapy import SCRAPE_ENGINES
+from amazonbookquery.singleflight import SingleFlight
+from amazonbookquery.transport import Transport
 
-class Query(object):
+# the ASIN in the path of a detail page URL
+DETAIL_PAGE_ASIN = re.compile(r'/dp/([0-9A-Z]{10})(?:[/?%]|$)')
 
-    REQUESTS_PER_SECOND = 1
 
-    def __init__(self):
-        self.access_key = os.getenv('AMAZON_ACCESS_KEY')
-        self.secret_key = os.getenv('AMAZON_SECRET_KEY')
-        self.associate_tag = os.getenv('AMAZON_ASSOC_KEY')
-        self.host = 'webservices.amazon.com'
+class Query(object):
 
-        self.last_call = datetime(1970, 1, 1)
-        self.parser = Parser()
+    REQUESTS_PER_SECOND = 1
 
-    def _build_url(self, **qargs):
+    LOOKUP_RESPONSE_GROUPS = ['AlternateVersions', 'ItemAttributes', 'OfferFull', 'Offers',
+                              'OfferListings', 'OfferSummary']
+
+    # ItemSearch does not know AlternateVersions and OfferListings
+    SEARCH_RESPONSE_GROUPS = ['ItemAttributes', 'OfferFull', 'Offers', 'OfferSummary']
+
+    OFFERS_SOURCES = ('api', 'scrape', 'api-then-scrape')
+
+    OFFER_FIELDS = OFFER_FIELDS
+
+    # searches tried in turn, from the strictest to the most relaxed, until
+    # one finds the book
+    SEARCH_STEPS = ('title-author', 'title', 'keywords')
+
+    # cache operation of the responses of searches that found nothing
+    NO_MATCH = 'NoMatch'
+
+    # ASINs whose lookup and detail page are kept for later rows
+    SHARED_WINDOW = 10000
+
+    def __init__(self, rate_limiter=None, lookup_batch_size=1, lookup_max_wait=0.2, cache=None,
+                 offers_source='scrape', scrape_engine='bs4', scrape_stream=False,
+                 parse_engine='objectify', transport=None, retry_policy=None, single_call=False,
+                 metrics=None, asin_index=None, search_cascade=SEARCH_STEPS[:1],
+                 host='webservices.amazon.com', access_key=None, secret_key=None,
+                 associate_tag=None):
+        self.access_key = access_key or os.getenv('AMAZON_ACCESS_KEY')
+        self.secret_key = secret_key or os.getenv('AMAZON_SECRET_KEY')
+        self.associate_tag = associate_tag or os.getenv('AMAZON_ASSOC_KEY')
+        self.host = host
+
+        self.rate_limiter = rate_limiter or TokenBucket(self.REQUESTS_PER_SECOND)
+        self.parser = PARSE_ENGINES[parse_engine]()
+        self.cache = cache
+        # ask ItemSearch for the item itself and skip the ItemLookup
+        self.single_call = single_call
+        # ASINs found by earlier searches, looked up without searching again
+        self.asin_index = asin_index
+        # SEARCH_STEPS tried when the previous ones found nothing
+        self.search_cascade = search_cascade
+        # where offer counts and prices come from, see OFFERS_SOURCES
+        self.offers_source = offers_source
+        # one pool of keep-alive connections for API calls and detail pages
+        self.transport = transport or Transport()
+        self.retry_policy = retry_policy or RetryPolicy()
+        # time spent per stage of the requests, see amazonbookquery.metrics
+        self.metrics = metrics or Metrics()
+        self.scrapy = SCRAPE_ENGINES[scrape_engine](
+            cache=cache, stream=scrape_stream, transport=self.transport,
+            retry_policy=self.retry_policy, metrics=self.metrics)
+
+        # batching only pays off when several rows are processed at once
+        self.lookup_batcher = None
+        if lookup_batch_size > 1:
+            self.lookup_batcher = LookupBatcher(
+                self._lookup_items, lookup_batch_size, lookup_max_wait)
+
+        # different searches often end on the same ASIN, its lookup and
+        # detail page are requested once and shared while among the
+        # SHARED_WINDOW ASINs asked for last
+        self.lookups = SingleFlight(self.SHARED_WINDOW)
+        self.scrapes = SingleFlight(self.SHARED_WINDOW)
+
+    def _canonical_args(self, **qargs):
         """
-        Builds a signed URL for querying Amazon AWS.
+        Returns the request parameters as they are signed, without the
+        ``Timestamp`` and ``Signature`` that change on every call.
         """
 
         # remove empty (=None) parameters
@@ -49,6 +116,14 @@ class Query(object):
         if isinstance(qargs.get('ResponseGroup'), list):
             qargs['ResponseGroup'] = ','.join(qargs['ResponseGroup'])
 
+        return qargs
+
+    def _build_url(self, **qargs):
+        """
+        Builds a signed URL for querying Amazon AWS.
+        """
+        qargs = self._canonical_args(**qargs)
+
         # add timestamp (this is required when using a signature)
         qargs['Timestamp'] = strftime("%Y-%m-%dT%H:%M:%SZ", gmtime())
 
@@ -75,75 +150,94 @@ class Query(object):
     def _fetch(self, url):
         # Be nice and wait for some time
         # before submitting the next request
-        delta = datetime.now() - self.last_call
-        throttle = timedelta(seconds=1 / self.REQUESTS_PER_SECOND)
-        if delta < throttle:
-            wait = throttle - delta
-            sleep(wait.seconds + wait.microseconds / 1000000.0)  # pragma: no cover
-        self.last_call = datetime.now()
+        self.metrics.observe('throttle', self.rate_limiter.acquire() or 0)
 
-        response = requests.get(url, stream=True)
-        response.raw.read = functools.partial(response.raw.read, decode_content=True)
-        return response.raw
+        # reading the whole body hands the connection back to the pool
+        with self.metrics.time('fetch'):
+            response = self.transport.get(url)
+            content = response.content
+        self.metrics.count('api_requests')
 
-    def _parse(self, fp, operation):
+        # error answers of the API are XML documents parsed like the others
+        if response.status_code != 200 and b'<?xml' not in content[:100]:
+            raise HTTPStatusError(
+                code='HTTP.%d' % response.status_code,
+                msg=response.reason,
+                status=response.status_code)
+
+        return BytesIO(content)
+
+    def _parse(self, fp, parse):
         """
         Processes the AWS response (file like object). XML is fed in, some
-        usable output comes out. It will use a different result_processor if
-        you have defined one.
+        usable output comes out of ``parse``, one of the parser's methods.
         """
         try:
-            if operation == 'ItemSearch':
-                return self.parser.parse_item_search(fp)
-            else:
-                return self.parser.parse_item_lookup(fp)
+            with self.metrics.time('parse'):
+                return parse(fp)
         except AWSError:
             e = sys.exc_info()[1]  # Python 2/3 compatible
+            error = self._translate_error(e)
 
-            errors = {
-                'InternalError': InternalError,
-                'InvalidClientTokenId': InvalidClientTokenId,
-                'MissingClientTokenId': MissingClientTokenId,
-                'RequestThrottled': TooManyRequests,
-                'Deprecated': DeprecatedOperation,
-                'AWS.ECommerceService.NoExactMatches': NoExactMatchesFound,
-                'AccountLimitExceeded': AccountLimitExceeded,
-                'AWS.ECommerceService.ItemNotEligibleForCart': InvalidCartItem,
-                'AWS.ECommerceService.CartInfoMismatch': CartInfoMismatch,
-                'AWS.ParameterOutOfRange': ParameterOutOfRange,
-                'AWS.InvalidAccount': InvalidAccount,
-                'SignatureDoesNotMatch': InvalidSignature,
-            }
-
-            if e.code in errors:
-                raise _e(errors[e.code])
-
-            if e.code == 'AWS.MissingParameters':
-                m = self._reg('missing-parameters').search(e.msg)
-                raise _e(MissingParameters, m.group('parameter'))
-
-            if e.code == 'AWS.InvalidEnumeratedParameter':
-                m = self._reg('invalid-value').search(e.msg)
-                if m is not None:
-                    if m.group('parameter') == 'ResponseGroup':
-                        raise _e(InvalidResponseGroup)
-                    elif m.group('parameter') == 'SearchIndex':
-                        raise _e(InvalidSearchIndex)
-
-            if e.code == 'AWS.InvalidParameterValue':
-                m = self._reg('invalid-parameter-value').search(e.msg)
-                raise _e(InvalidParameterValue,
-                         m.group('parameter'), m.group('value'))
-
-            if e.code == 'AWS.RestrictedParameterValueCombination':
-                m = self._reg('invalid-parameter-combination').search(e.msg)
-                raise _e(InvalidParameterCombination, m.group('message'))
-
-            if e.code == 'AWS.ECommerceService.ItemAlreadyInCart':
-                item = self._reg('already-in-cart').search(e.msg).group('item')
-                raise _e(ItemAlreadyInCart, item)
+        # raised outside of the except block and without its traceback, so
+        # that neither keeps the frames of the parser alive
+        raise error.with_traceback(None)
 
-            raise
+    def _translate_error(self, e):
+        """
+        Returns the specific :class:`AWSError` subclass instance matching
+        the code of the generic error ``e``, or ``e`` itself.
+        """
+        # throttling messages name the access key, messages end up in the output
+        if e.msg:
+            e.msg = self._reg('access-key-id').sub('', e.msg)
+        if e.snippet:
+            e.snippet = self._reg('access-key-id').sub('', e.snippet)
+
+        errors = {
+            'InternalError': InternalError,
+            'InvalidClientTokenId': InvalidClientTokenId,
+            'MissingClientTokenId': MissingClientTokenId,
+            'RequestThrottled': TooManyRequests,
+            'Deprecated': DeprecatedOperation,
+            'AWS.ECommerceService.NoExactMatches': NoExactMatchesFound,
+            'AccountLimitExceeded': AccountLimitExceeded,
+            'AWS.ECommerceService.ItemNotEligibleForCart': InvalidCartItem,
+            'AWS.ECommerceService.CartInfoMismatch': CartInfoMismatch,
+            'AWS.ParameterOutOfRange': ParameterOutOfRange,
+            'AWS.InvalidAccount': InvalidAccount,
+            'SignatureDoesNotMatch': InvalidSignature,
+        }
+
+        if e.code in errors:
+            return _e(errors[e.code], exc=e)
+
+        if e.code == 'AWS.MissingParameters':
+            m = self._reg('missing-parameters').search(e.msg)
+            return _e(MissingParameters, m.group('parameter'), exc=e)
+
+        if e.code == 'AWS.InvalidEnumeratedParameter':
+            m = self._reg('invalid-value').search(e.msg)
+            if m is not None:
+                if m.group('parameter') == 'ResponseGroup':
+                    return _e(InvalidResponseGroup, exc=e)
+                elif m.group('parameter') == 'SearchIndex':
+                    return _e(InvalidSearchIndex, exc=e)
+
+        if e.code == 'AWS.InvalidParameterValue':
+            m = self._reg('invalid-parameter-value').search(e.msg)
+            return _e(InvalidParameterValue,
+                      m.group('parameter'), m.group('value'), exc=e)
+
+        if e.code == 'AWS.RestrictedParameterValueCombination':
+            m = self._reg('invalid-parameter-combination').search(e.msg)
+            return _e(InvalidParameterCombination, m.group('message'), exc=e)
+
+        if e.code == 'AWS.ECommerceService.ItemAlreadyInCart':
+            item = self._reg('already-in-cart').search(e.msg).group('item')
+            return _e(ItemAlreadyInCart, item, exc=e)
+
+        return e
 
     def _reg(self, key):
         """
@@ -152,45 +246,293 @@ class Query(object):
         """
         return DEFAULT_ERROR_REGS[key]
 
-    def _call(self, **qargs):
-        url = self._build_url(**qargs)
+    @hooked('Query._call')
+    def _call(self, parse, cache_as=None, **qargs):
+        """
+        Returns what ``parse`` makes of the response to the request. It is
+        cached with the TTL of ``cache_as``, the operation by default.
+        """
+        operation = cache_as or qargs['Operation']
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(operation, self._canonical_args(**qargs))
+            body = self.cache.get(operation, key)
+            if body is not None:
+                self.metrics.count('api_cache_hits')
+                return self._parse(BytesIO(body), parse)
+            self.metrics.count('api_cache_misses')
+
+        result, body = self._send(parse, key, **qargs)
+
+        # only responses that parsed without error are worth keeping
+        if self.cache is not None:
+            self.cache.set(operation, key, body)
+
+        return result
+
+    def _send(self, parse, key, **qargs):
+        """
+        Sends the request, again as long as the retry policy allows, and
+        returns what ``parse`` makes of the response with its body. A
+        search that found nothing is cached under ``key``, if any.
+        """
+        def attempt():
+            # signed again on every attempt, the timestamp must be recent
+            with self.metrics.time('sign'):
+                url = self._build_url(**qargs)
+            try:
+                fp = self._fetch(url)
+                body = fp.read()
+                try:
+                    result = self._parse(BytesIO(body), parse)
+                except NoExactMatchesFound:
+                    # kept as long as a negative answer deserves
+                    if key is not None:
+                        self.cache.set(self.NO_MATCH, key, body)
+                    raise
+                self.rate_limiter.succeeded()
+                return result, body
+            except TooManyRequests:
+                self.rate_limiter.throttled()
+                raise
+
+        return self.retry_policy.call(self.host, attempt)
+
+    def _lookup_args(self, item_id):
+        return dict(
+            Operation='ItemLookup',
+            ItemId=item_id,
+            ResponseGroup=self.LOOKUP_RESPONSE_GROUPS,
+            RelationshipType='AuthorityTitle'
+        )
+
+    def _lookup_items(self, asins):
+        results, body = self._send(
+            self.parser.parse_item_lookups, None, **self._lookup_args(','.join(asins)))
+
+        # every item is cached as if looked up alone, the same ASINs are
+        # seldom batched together again
+        if self.cache is not None:
+            for asin, item_body in split_item_lookups(BytesIO(body)).items():
+                self.cache.set('ItemLookup', self._lookup_key(asin), item_body)
+
+        for asin, result in results.items():
+            if isinstance(result, AWSError):
+                results[asin] = self._translate_error(result)
+
+        return results
+
+    def _lookup_key(self, asin):
+        return self.cache.key('ItemLookup', self._canonical_args(**self._lookup_args(asin)))
+
+    def _shared(self, flights, key, function):
+        """
+        Returns the result ``function()`` had or has for ``key`` in this run.
+        Errors that may go away on a later try are not kept.
+        """
         try:
-            fp = self._fetch(url)
-            return self._parse(fp, qargs['Operation'])
-        except HTTPError:
-            e = sys.exc_info()[1]
-            if e.code in (400, 403, 410, 503):
-                return self._parse(e.fp)
-            if e.code == 500:
-                raise InternalError
+            return flights.do(key, function)
+        except (RetriesExhausted, CircuitOpen):
+            flights.forget(key)
             raise
 
-    def execute_query(self, title, author):
+    def _lookup_item(self, asin):
+        # the same result may be handed to several rows
+        return self._shared(self.lookups, asin, lambda: self._request_item(asin)).copy()
+
+    def _request_item(self, asin):
+        if self.lookup_batcher is None:
+            return self._call(self.parser.parse_item_lookup, **self._lookup_args(asin))
+
+        # only the ASINs missing from the cache are batched
+        if self.cache is not None:
+            body = self.cache.get('ItemLookup', self._lookup_key(asin))
+            if body is not None:
+                self.metrics.count('api_cache_hits')
+                return self._parse(BytesIO(body), self.parser.parse_item_lookup)
+            self.metrics.count('api_cache_misses')
+        return self.lookup_batcher.get(asin)
+
+    def _needs_scrape(self, item):
+        """
+        Tells whether the detail page has to be scraped for the offers of
+        ``item``, which holds the OfferSummary of the API response.
+        """
+        if self.offers_source == 'scrape':
+            return True
+        if self.offers_source == 'api-then-scrape':
+            return item.total_new is None
+        return False
+
+    def _search_params(self, step, title, author):
+        """
+        Returns the parameters of the ItemSearch of ``step``, one of
+        ``SEARCH_STEPS``.
+        """
+        if step == 'title-author':
+            return {'Title': title, 'Author': author}
+        if step == 'title':
+            return {'Title': title}
+        return {'Keywords': ' '.join(word for word in (title, author) if word)}
+
+    def _search_asin(self, params):
+        return self._call(
+            self.parser.parse_item_search,
+            Operation='ItemSearch',
+            SearchIndex='Books',
+            **params
+        )
+
+    def _search_step(self, params):
+        """
+        Returns the ASIN of the first search result and its lookup result,
+        or ``None`` for the latter when the search response lacks some of it.
+        """
+        if not self.single_call:
+            return self._search_asin(params), None
+
         try:
-            asin = self._call(
+            asin, item = self._call(
+                self.parser.parse_item_search_item,
+                # the response holds offers, it gets old as fast as a lookup
+                cache_as='ItemLookup',
                 Operation='ItemSearch',
-                Title=title,
-                Author=author,
-                SearchIndex='Books'
+                SearchIndex='Books',
+                ResponseGroup=self.SEARCH_RESPONSE_GROUPS,
+                **params
             )
+        except InvalidResponseGroup:
+            # this locale does not offer the groups on searches
+            self.single_call = False
+            return self._search_asin(params), None
 
-            item = self._call(
-                Operation='ItemLookup',
-                ItemId=asin,
-                ResponseGroup=['AlternateVersions', 'ItemAttributes', 'OfferFull', 'Offers', 'OfferListings', 'OfferSummary'],
-                RelationshipType='AuthorityTitle'
-            )
+        if item is not None:
+            # rows ending on this ASIN later reuse it as their lookup
+            item = self._shared(self.lookups, asin, lambda: item).copy()
 
-            scrapy = Scrapy()
-            result = scrapy.scrape(item['detail_page_url'])
+        return asin, item
 
-            item['total_new'] = result['total_new']
-            item['total_used'] = result['total_used']
-            item['total_collectible'] = result['total_collectible']
-            item['lowest_new_price'] = result['lowest_new_price']
-            item['lowest_used_price'] = result['lowest_used_price']
-            item['lowest_collectible_price'] = result['lowest_collectible_price']
+    def _search_item(self, title, author):
+        """
+        Runs the searches of the cascade until one finds the book, see
+        :meth:`_search_step`, and raises the error of the last one when none
+        does.
+        """
+        error = None
+        tried = []
+        for step in self.search_cascade:
+            params = self._search_params(step, title, author)
+            # e.g. title after title-author for a book without author
+            searched = dict((name, value) for name, value in params.items() if value)
+            if searched in tried:
+                continue
+            tried.append(searched)
+
+            try:
+                found = self._search_step(params)
+            except NoExactMatchesFound as e:
+                error = e
+                continue
+
+            if step != self.search_cascade[0]:
+                self.metrics.count('relaxed_matches')
+            return found
+
+        raise error.with_traceback(None)
+
+    def _indexed_item(self, title, author):
+        """
+        Returns the ASIN the index maps ``title`` by ``author`` to and its
+        lookup result, or ``None`` when the index has to be searched.
+        """
+        hit = self.asin_index.get(title, author)
+        if hit is None:
+            self.metrics.count('index_misses')
+            return None
 
-            return item
+        asin, score = hit
+        try:
+            item = self._lookup_item(asin)
+        except InvalidParameterValue:
+            # the ASIN left the catalog since it was recorded, or was
+            # recorded by another locale; a search may find it again
+            self.metrics.count('index_stale')
+            self.asin_index.discard(asin)
+            self.lookups.forget(asin)
+            return None
+
+        if score == 1:
+            self.metrics.count('index_hits')
+        else:
+            # next time the query hits exactly, but trusted no more than
+            # the fuzzy match was
+            self.metrics.count('index_fuzzy_hits')
+            self._index_item(title, author, asin, item, score)
+        return asin, item
+
+    def _index_item(self, title, author, asin, item, score=1.0):
+        # the confidence is how much the item found looks like the query
+        confidence = similarity(query_key(title, author), query_key(item.title, item.author))
+        self.asin_index.record(title, author, asin, min(confidence, score))
+
+    def _resolve_item(self, title, author):
+        """
+        Returns the ASIN of the book and its lookup result, from the index
+        when it has the book, from a search otherwise.
+        """
+        if self.asin_index is not None:
+            found = self._indexed_item(title, author)
+            if found is not None:
+                return found
+
+        asin, item = self._search_item(title, author)
+        if item is None:
+            item = self._lookup_item(asin)
+
+        if self.asin_index is not None:
+            self._index_item(title, author, asin, item)
+
+        return asin, item
+
+    def _complete_offers(self, asin, item):
+        """
+        Fills the offer fields of ``item`` from its detail page, or with
+        "" where the API left them out.
+        """
+        if self._needs_scrape(item):
+            url = item.detail_page_url
+            result = self._shared(self.scrapes, asin, lambda: self.scrapy.scrape(url))
+
+            item.update(result, self.OFFER_FIELDS)
+        else:
+            for field in self.OFFER_FIELDS:
+                if getattr(item, field) is None:
+                    setattr(item, field, "")
+
+        return item
+
+    def execute_query(self, title, author):
+        try:
+            asin, item = self._resolve_item(title, author)
+            return self._complete_offers(asin, item)
         except:
-            raise
\ No newline at end of file
+            raise
+
+    def refresh_query(self, title, author, item):
+        """
+        Returns ``item``, the result of an earlier query for ``title`` by
+        ``author``, with fresh offers and without searching: only its detail
+        page is requested when the offers come from there, keeping who sells
+        the item as it was, the ItemLookup of its ASIN otherwise. Items whose
+        ASIN cannot be told from their URL are queried again.
+        """
+        match = DETAIL_PAGE_ASIN.search(item.detail_page_url or '')
+        if match is None:
+            return self.execute_query(title, author)
+
+        asin = match.group(1)
+        if self.offers_source == 'scrape':
+            item = item.copy()
+        else:
+            item = self._lookup_item(asin)
+        return self._complete_offers(asin, item)
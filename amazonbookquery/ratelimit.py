@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+Rate limiters used by :class:`Query` to pace its requests to Amazon.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+    import msvcrt
+
+__all__ = ['RateLimiter', 'TokenBucket', 'FileTokenBucket']
+
+
+class RateLimiter(object):
+    """
+    Interface of a rate limiter. ``acquire`` blocks until the next request
+    may be sent and returns the number of seconds it waited; ``throttled``
+    and ``succeeded`` report the outcome of that request.
+    """
+
+    def acquire(self):
+        raise NotImplementedError
+
+    def throttled(self):
+        pass
+
+    def succeeded(self):
+        pass
+
+
+class TokenBucket(RateLimiter):
+    """
+    Token bucket refilled at ``rate`` tokens per second and holding at most
+    ``capacity`` tokens, shared by all threads using the same instance.
+
+    The rate adapts with AIMD: a throttle error multiplies it by
+    ``decrease_factor`` (down to ``min_rate``), and every
+    ``success_threshold`` consecutive successes add ``increase_step`` to it
+    (up to ``max_rate``, which defaults to the initial rate). The throttle
+    errors received within a refill interval of the last decrease, i.e.
+    while the bucket fills up again at the decreased rate, answer requests
+    sent before it and do not decrease the rate again. The step defaults
+    to a tenth of ``max_rate``, so that recovering from a halving takes
+    the same number of requests at any rate.
+    """
+
+    def __init__(self, rate, capacity=1, min_rate=None, max_rate=None,
+                 decrease_factor=0.5, increase_step=None, success_threshold=10):
+        self.capacity = capacity
+        self.min_rate = min_rate or rate / 10.0
+        self.max_rate = max_rate or rate
+        self.decrease_factor = decrease_factor
+        self.increase_step = increase_step or self.max_rate / 10.0
+        self.success_threshold = success_threshold
+
+        self._lock = threading.Lock()
+        self._state = self._initial_state(rate)
+
+    def _initial_state(self, rate):
+        return {
+            'rate': rate,
+            'tokens': self.capacity,
+            'updated': time.time(),
+            'successes': 0,
+            'decreased': 0,
+        }
+
+    @contextmanager
+    def _locked(self):
+        """
+        Yields the bucket state while holding the lock. Changes made to the
+        yielded dict are kept.
+        """
+        with self._lock:
+            yield self._state
+
+    @property
+    def rate(self):
+        with self._locked() as state:
+            return state['rate']
+
+    def _refill(self, state):
+        now = time.time()
+        elapsed = max(0, now - state['updated'])
+        state['tokens'] = min(self.capacity, state['tokens'] + elapsed * state['rate'])
+        state['updated'] = now
+
+    def acquire(self):
+        waited = 0
+        while True:
+            with self._locked() as state:
+                self._refill(state)
+                if state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    return waited
+                wait = (1 - state['tokens']) / state['rate']
+            time.sleep(wait)
+            waited += wait
+
+    def throttled(self):
+        with self._locked() as state:
+            self._refill(state)
+            state['tokens'] = min(state['tokens'], 0)
+            state['successes'] = 0
+            if state['updated'] - state.get('decreased', 0) < self.capacity / state['rate']:
+                return
+            state['rate'] = max(self.min_rate, state['rate'] * self.decrease_factor)
+            state['decreased'] = state['updated']
+
+    def succeeded(self):
+        with self._locked() as state:
+            state['successes'] += 1
+            if state['successes'] >= self.success_threshold:
+                self._refill(state)
+                state['rate'] = min(self.max_rate, state['rate'] + self.increase_step)
+                state['successes'] = 0
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    :class:`TokenBucket` whose state lives in the file at ``path``, so that
+    every process pointing at the same file shares one bucket. Access is
+    serialized with an exclusive lock on the file.
+    """
+
+    def __init__(self, path, rate, **kwargs):
+        self.path = path
+        TokenBucket.__init__(self, rate, **kwargs)
+
+        # keep an existing bucket so late starters don't reset the shared rate
+        with self._locked():
+            pass
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                self._lock_file(fd)
+                data = os.read(fd, 4096)
+                try:
+                    state = json.loads(data.decode('utf-8'))
+                except ValueError:
+                    state = self._state
+                else:
+                    # the bucket may have been saved by a run with other
+                    # limits, this one's apply
+                    state['rate'] = min(self.max_rate, max(self.min_rate, state['rate']))
+                    state['tokens'] = min(self.capacity, state['tokens'])
+
+                yield state
+
+                data = json.dumps(state).encode('utf-8')
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, data)
+            finally:
+                self._unlock_file(fd)
+                os.close(fd)
+
+    def _lock_file(self, fd):
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:  # pragma: no cover
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+
+    def _unlock_file(self, fd):
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        else:  # pragma: no cover
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
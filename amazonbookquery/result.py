@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+The record of what was found for a book.
+"""
+
+__all__ = ['OFFER_FIELDS', 'BookResult']
+
+OFFER_FIELDS = ('total_new', 'total_used', 'total_collectible', 'lowest_new_price',
+                'lowest_used_price', 'lowest_collectible_price')
+
+
+class BookResult(object):
+    """
+    Attributes and offers of a book, as parsed from an API response or, for
+    the offer fields only, from a detail page. Fields not given are
+    ``None``.
+
+    Slots keep it about a quarter of the size of the equivalent dict, which
+    counts with thousands of rows in flight.
+    """
+
+    __slots__ = ('detail_page_url', 'author', 'title', 'sold_by_amazon',
+                 'sold_by_amazon_as_new') + OFFER_FIELDS
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError('Unknown BookResult fields: {}'.format(', '.join(sorted(fields))))
+
+    def copy(self):
+        result = BookResult.__new__(BookResult)
+        for name in self.__slots__:
+            setattr(result, name, getattr(self, name))
+        return result
+
+    def update(self, other, fields=__slots__):
+        """
+        Takes ``fields`` of ``other``, every field by default.
+        """
+        for name in fields:
+            setattr(self, name, getattr(other, name))
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if not isinstance(other, BookResult):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    # mutable
+    __hash__ = None
+
+    def __repr__(self):
+        return 'BookResult({})'.format(', '.join(
+            '{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__
+            if getattr(self, name) is not None))
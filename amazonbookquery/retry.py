@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+Retry policy and circuit breaker for requests to Amazon.
+"""
+
+import random
+import threading
+import time
+from amazonbookquery.errors import *
+
+__all__ = ['RETRY', 'COOL_DOWN', 'FAIL', 'CircuitBreaker', 'RetryPolicy']
+
+RETRY = 'retry'
+COOL_DOWN = 'cool-down'
+FAIL = 'fail'
+
+
+class CircuitBreaker(object):
+    """
+    Keeps track of consecutive failures per host. After ``threshold`` of
+    them the circuit opens and requests to the host wait in :meth:`before`
+    for ``reset_timeout`` seconds. A single trial request is let through
+    after that while the others wait for its outcome: the circuit closes
+    again once it succeeds and stays open for another ``reset_timeout``
+    when it fails.
+
+    Once the circuit has been open for ``max_wait`` seconds the requests
+    that are not a trial fail at once with :class:`CircuitOpen`, so that
+    their rows are recorded and skipped instead of stalling the run.
+    """
+
+    def __init__(self, threshold=10, reset_timeout=60, max_wait=300):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.max_wait = max_wait
+
+        self._cond = threading.Condition()
+        self._failures = {}
+        self._opened = {}
+        # host -> time the circuit opened, not moved by failed trials
+        self._down = {}
+        # host -> start of the trial request in flight
+        self._trials = {}
+
+    def before(self, host):
+        """
+        Returns once a request to ``host`` may be sent, raises
+        :class:`CircuitOpen` when the host has been down for too long.
+        """
+        with self._cond:
+            while True:
+                opened = self._opened.get(host)
+                if opened is None:
+                    return
+
+                now = time.time()
+                if now < opened + self.reset_timeout:
+                    until = opened + self.reset_timeout
+                else:
+                    # half open: this request is the trial, unless one is in
+                    # flight; one lost without outcome is replaced after a while
+                    trial = self._trials.get(host)
+                    if trial is None or now >= trial + self.reset_timeout:
+                        self._trials[host] = now
+                        return
+                    until = trial + self.reset_timeout
+
+                give_up = self._down[host] + self.max_wait
+                if now >= give_up:
+                    raise CircuitOpen(
+                        code='CircuitOpen',
+                        msg='requests to %s are suspended after %d consecutive failures' % (
+                            host, self._failures[host]))
+                self._cond.wait(min(until, give_up) - now)
+
+    def success(self, host):
+        with self._cond:
+            self._failures.pop(host, None)
+            self._opened.pop(host, None)
+            self._down.pop(host, None)
+            self._trials.pop(host, None)
+            self._cond.notify_all()
+
+    def failure(self, host):
+        with self._cond:
+            self._failures[host] = self._failures.get(host, 0) + 1
+            if self._trials.pop(host, None) is not None or self._failures[host] >= self.threshold:
+                self._opened[host] = time.time()
+                self._down.setdefault(host, self._opened[host])
+            self._cond.notify_all()
+
+
+class RetryPolicy(object):
+    """
+    Decides, per error class, whether a failed request is retried after an
+    exponential backoff with jitter (``RETRY``), retried after a longer
+    pause (``COOL_DOWN``) or given up at once (``FAIL``). A request is tried
+    at most ``max_attempts`` times, after which :class:`RetriesExhausted`
+    is raised.
+
+    Errors not listed in ``ACTIONS`` are valid answers (e.g. no match) and
+    fail right away.
+    """
+
+    ACTIONS = (
+        (TooManyRequests, COOL_DOWN),
+        (CaptchaRequired, COOL_DOWN),
+        (InternalError, RETRY),
+        (NetworkError, RETRY),
+    )
+
+    HTTP_ACTIONS = {
+        429: COOL_DOWN,
+        500: RETRY,
+        502: RETRY,
+        503: COOL_DOWN,
+        504: RETRY,
+    }
+
+    def __init__(self, max_attempts=5, base_delay=1, max_delay=60, cool_down=30, breaker=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cool_down = cool_down
+        self.breaker = breaker or CircuitBreaker()
+
+    def classify(self, error):
+        if isinstance(error, HTTPStatusError):
+            return self.HTTP_ACTIONS.get(error.status, FAIL)
+
+        for error_class, action in self.ACTIONS:
+            if isinstance(error, error_class):
+                return action
+
+        return FAIL
+
+    def delay(self, attempt, action):
+        """
+        Returns the seconds to wait before attempt number ``attempt + 1``.
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        if action == COOL_DOWN:
+            delay = max(delay, self.cool_down)
+        # keep half of the delay and randomize the rest
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def call(self, host, function):
+        """
+        Returns the result of ``function()``, calling it again as long as
+        the errors it raises and the number of attempts allow.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            self.breaker.before(host)
+            try:
+                result = function()
+            except AWSError as e:
+                error = e
+            else:
+                self.breaker.success(host)
+                return result
+
+            # errors may be kept until the end of the run, they must not keep
+            # the frames of the attempt (and e.g. a parsed page) alive
+            error.with_traceback(None)
+
+            action = self.classify(error)
+            if action == FAIL:
+                # the host answered, it is just not the answer we hoped for
+                self.breaker.success(host)
+                raise error
+
+            self.breaker.failure(host)
+            if attempt >= self.max_attempts:
+                raise RetriesExhausted(
+                    code='RetriesExhausted',
+                    msg='%s after %d attempts' % (error, attempt),
+                    error=error)
+
+            time.sleep(self.delay(attempt, action))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Output rows looked up by identifier without holding them in memory.
+"""
+
+import json
+import sqlite3
+import threading
+
+__all__ = ['RowStore']
+
+
+class RowStore(object):
+    """
+    Output rows by identifier, with the time they completed, kept in a
+    temporary SQLite database. Only the pages in use stay in memory, the
+    rest go to a file that is deleted when the store is closed.
+    """
+
+    def __init__(self, entries=()):
+        self._lock = threading.Lock()
+        # an empty path opens a private database on disk
+        self._db = sqlite3.connect('', check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE rows ('
+                ' identifier TEXT PRIMARY KEY,'
+                ' completed REAL,'
+                ' row TEXT NOT NULL)')
+        self.update(entries)
+
+    def update(self, entries):
+        """
+        Stores the ``(identifier, completed, row)`` of ``entries``, later
+        ones replacing earlier ones with the same identifier.
+        """
+        values = ((identifier, completed, json.dumps(row))
+                  for identifier, completed, row in entries)
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO rows (identifier, completed, row) VALUES (?, ?, ?)',
+                values)
+
+    def get(self, identifier, default=None):
+        """
+        Returns the ``(completed, row)`` stored for ``identifier``.
+        """
+        with self._lock:
+            found = self._db.execute(
+                'SELECT completed, row FROM rows WHERE identifier = ?', (identifier,)).fetchone()
+        if found is None:
+            return default
+        return found[0], json.loads(found[1])
+
+    def __contains__(self, identifier):
+        with self._lock:
+            return self._db.execute(
+                'SELECT 1 FROM rows WHERE identifier = ?', (identifier,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM rows').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
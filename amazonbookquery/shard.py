@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Splits a run over several processes, each bound to its own credentials.
+"""
+
+import configparser
+import csv
+import os
+import shutil
+from multiprocessing import Pool
+
+__all__ = ['load_credentials', 'split_source', 'merge_outputs', 'run_sharded']
+
+
+def load_credentials(path):
+    """
+    Reads credential sets from an INI file with one section per account:
+
+        [account-1]
+        access_key = ...
+        secret_key = ...
+        associate_tag = ...
+        requests_per_second = 1
+
+    ``requests_per_second`` is optional. Returns a list of dicts.
+    """
+    config = configparser.ConfigParser()
+    if not config.read(path, encoding='utf-8'):
+        raise ValueError('Cannot read credentials file: {}'.format(path))
+
+    ret = []
+    for name in config.sections():
+        section = config[name]
+        try:
+            credentials = {
+                'name': name,
+                'access_key': section['access_key'],
+                'secret_key': section['secret_key'],
+                'associate_tag': section['associate_tag'],
+            }
+        except KeyError as e:
+            raise ValueError('Missing {} in credentials [{}]'.format(e, name))
+        if 'requests_per_second' in section:
+            credentials['requests_per_second'] = section.getfloat('requests_per_second')
+        ret.append(credentials)
+
+    return ret
+
+
+def split_source(source_file_path, shard_dir, count):
+    """
+    Writes row ``i`` of the source to shard ``i % count``, each shard being
+    a tsv file with the source header. Returns the shard paths.
+    """
+    name = os.path.basename(source_file_path)[:-4]
+    paths = [os.path.join(shard_dir, '{}_shard{}.tsv'.format(name, i)) for i in range(count)]
+
+    fds = [open(path, "w", encoding="utf-8", newline="") for path in paths]
+    try:
+        writers = [csv.writer(fd, delimiter="\t") for fd in fds]
+        with open(source_file_path, "r", encoding="utf-8") as fd:
+            reader = csv.reader(fd, delimiter="\t")
+            header = next(reader, [])
+            for writer in writers:
+                writer.writerow(header)
+            for i, row in enumerate(reader):
+                writers[i % count].writerow(row)
+    finally:
+        for fd in fds:
+            fd.close()
+
+    return paths
+
+
+def merge_outputs(output_paths, output_path):
+    """
+    Interleaves the shard outputs back into the order of the source file,
+    which :func:`split_source` dealt out round robin.
+    """
+    fds = [open(path, "r", encoding="utf-8", newline="") for path in output_paths]
+    try:
+        readers = [csv.reader(fd, delimiter="\t") for fd in fds]
+        headers = [next(reader, None) for reader in readers]
+
+        with open(output_path, "w", encoding="utf-8", newline="") as fd:
+            writer = csv.writer(fd, delimiter="\t")
+            writer.writerow(headers[0])
+            i = 0
+            while True:
+                row = next(readers[i % len(readers)], None)
+                if row is None:
+                    break
+                writer.writerow(row)
+                i += 1
+    finally:
+        for fd in fds:
+            fd.close()
+
+
+def run_sharded(source_file_path, output_dir, run_shard, credentials):
+    """
+    Runs ``run_shard(shard_path, shard_dir, credentials)`` for one shard per
+    credential set in a process pool. Each returns the path of its output
+    and a report; the outputs are merged into one ordered tsv in
+    ``output_dir`` whose path is returned with the list of reports.
+
+    The shards are kept until the merge succeeded so a resumed run finds
+    the journals of every worker.
+    """
+    name = os.path.basename(source_file_path)[:-4]
+    shard_dir = os.path.join(output_dir, name + "_shards")
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+
+    paths = split_source(source_file_path, shard_dir, len(credentials))
+    with Pool(len(credentials)) as pool:
+        results = pool.starmap(
+            run_shard, [(path, shard_dir, creds) for path, creds in zip(paths, credentials)])
+    output_paths = [output_path for output_path, report in results]
+
+    output_path = os.path.join(output_dir, name + "_output.tsv")
+    merge_outputs(output_paths, output_path)
+    shutil.rmtree(shard_dir)
+
+    return output_path, [report for output_path, report in results]
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Sharing of in-flight and finished work between threads.
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+__all__ = ['SingleFlight']
+
+
+class SingleFlight(object):
+    """
+    Runs a function at most once per key. Callers asking for a key that is
+    being computed wait for it, later callers get the stored result, and
+    both share the exception if the function raised. Keys are kept until
+    :meth:`forget` is called or, with a ``window``, until ``window`` other
+    keys were asked for since, so memory stays bounded by ``window``.
+    """
+
+    def __init__(self, window=None):
+        self.window = window
+        self._lock = threading.Lock()
+        # keys in the order they were last asked for
+        self._futures = OrderedDict()
+
+    def do(self, key, function):
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+            else:
+                self._futures.move_to_end(key)
+            while self.window is not None and len(self._futures) > self.window:
+                # callers already waiting for it still get the result
+                self._futures.popitem(last=False)
+
+        if owner:
+            try:
+                future.set_result(function())
+            except BaseException as e:
+                future.set_exception(e)
+                if not isinstance(e, Exception):
+                    # interrupts are not a result to share, let them through
+                    self.forget(key)
+                    raise
+
+        return future.result()
+
+    def forget(self, key):
+        with self._lock:
+            self._futures.pop(key, None)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._futures
+
+    def __len__(self):
+        with self._lock:
+            return len(self._futures)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+HTTP transport shared by :class:`Query` and :class:`Scrapy`.
+"""
+
+import re
+import requests
+from requests.adapters import HTTPAdapter
+from amazonbookquery.errors import NetworkError
+
+__all__ = ['Transport']
+
+# query strings hold the access key and the signature of the request
+QUERY_STRING = re.compile(r'\?[^\s)\'"]*')
+
+
+class Transport(object):
+    """
+    A :class:`requests.Session` keeping a pool of up to ``pool_size``
+    keep-alive connections per host, so consecutive requests skip the TCP
+    and TLS handshakes. Responses are requested gzip or deflate encoded
+    and every request gets a connect and a read timeout, in seconds.
+
+    Requests that fail without an answer raise :class:`NetworkError`.
+    """
+
+    def __init__(self, pool_size=10, pool_hosts=10, connect_timeout=10, read_timeout=30,
+                 keep_alive=True):
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_hosts, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive' if keep_alive else 'close',
+        })
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            return self.session.get(url, **kwargs)
+        except requests.RequestException as e:
+            # the message ends up in the output, without the query string
+            msg = QUERY_STRING.sub('', '%s: %s' % (type(e).__name__, e))
+            raise NetworkError(code='NetworkError', msg=msg)
+
+    def close(self):
+        self.session.close()
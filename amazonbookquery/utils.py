@@ -1,25 +1,85 @@
 #!/usr/bin/env python
 
 import argparse
+import json
 import sys
 import os
 import csv
 import re
+import time
+from contextlib import ExitStack
+from functools import partial
+from amazonbookquery.asinindex import AsinIndex
+from amazonbookquery.cache import DAY, ResponseCache
+from amazonbookquery.dedupe import QueryDeduplicator
 from amazonbookquery.errors import *
+from amazonbookquery.hooks import around, hooked
+from amazonbookquery.journal import Journal
+from amazonbookquery.metrics import Metrics
+from amazonbookquery.normalize import query_key
+from amazonbookquery.parser import PARSE_ENGINES
+from amazonbookquery.pipeline import AsyncPipeline
+from amazonbookquery.profiling import Profiler
 from amazonbookquery.query import Query
+from amazonbookquery.result import BookResult
+from amazonbookquery.rowstore import RowStore
+from amazonbookquery.ratelimit import FileTokenBucket, TokenBucket
+from amazonbookquery.retry import RetryPolicy
+from amazonbookquery.scrapy import SCRAPE_ENGINES
+from amazonbookquery.shard import load_credentials, run_sharded
+from amazonbookquery.transport import Transport
+from amazonbookquery.workqueue import WorkQueue, worker_name
 
 class BookQuery:
 
+    HEADER = ['identifier', 'title', 'volume', 'creator', 'details', 'transformed_author',
+              'amzn-Author', 'amzn-Title', 'DetailPageURL', 'TotalNew', 'TotalUsed',
+              'TotalCollectible', 'LowestNewPrice', 'LowestUsedPrice', 'LowestCollectiblePrice',
+              'SoldByAmzn', 'SoldByAmznNew']
+
+    def __init__(self, prometheus_file=None, **query_options):
+        # forwarded to every Query built by generate_output
+        self.query_options = query_options
+        # rewritten with the metrics of the run on every flush of the output
+        self.prometheus_file = prometheus_file
+        self.deduplicator = None
+        self.metrics = None
+
+    # output columns taken from the query result, and its attributes
+    RESULT_COLUMNS = [
+        ('amzn-Author', 'author'), ('amzn-Title', 'title'), ('DetailPageURL', 'detail_page_url'),
+        ('TotalNew', 'total_new'), ('TotalUsed', 'total_used'),
+        ('TotalCollectible', 'total_collectible'),
+        ('LowestNewPrice', 'lowest_new_price'), ('LowestUsedPrice', 'lowest_used_price'),
+        ('LowestCollectiblePrice', 'lowest_collectible_price'), ('SoldByAmzn', 'sold_by_amazon'),
+        ('SoldByAmznNew', 'sold_by_amazon_as_new'),
+    ]
+
+    # output columns that change from one run to the next
+    VOLATILE_COLUMNS = ['TotalNew', 'TotalUsed', 'TotalCollectible', 'LowestNewPrice',
+                        'LowestUsedPrice', 'LowestCollectiblePrice', 'SoldByAmzn', 'SoldByAmznNew']
+
+    # volatile columns a refresh leaves as they were when the offers are
+    # scraped, only the ItemLookup tells who sells the book
+    API_ONLY_COLUMNS = ['SoldByAmzn', 'SoldByAmznNew']
+
+    CHANGES_HEADER = ['identifier', 'title', 'column', 'previous', 'current']
+
+    # output rows written between two flushes of the output file
+    FLUSH_EVERY = 100
+
+    # errors worth another try when a run is resumed
+    TRANSIENT_ERRORS = ('RetriesExhausted:', 'CircuitOpen:')
+
     def _get_data(self, filepath):
-        ret = []
+        """
+        Yields the rows of the source file one at a time, without its header.
+        """
         with open(filepath, "r", encoding="utf-8") as fd:
             reader = csv.reader(fd, delimiter="\t")
+            next(reader, None)
             for row in reader:
-                ret.append(row)
-
-        del ret[0]
-
-        return ret
+                yield row
 
     def _get_transformed_author(self, data):
         if "," not in data:
@@ -46,61 +106,346 @@ class BookQuery:
     def hasNumbers(self, data):
         return bool(re.search(r'\d', data))
 
-    def generate_output(self, source_file_path, output_dir):
+    def _execute_query(self, query, title, transformed_author):
+        if self.deduplicator is None:
+            return query.execute_query(title, transformed_author)
+
+        return self.deduplicator.execute(
+            query_key(title, transformed_author),
+            lambda: query.execute_query(title, transformed_author))
+
+    @hooked('BookQuery._process_row')
+    def _process_row(self, query, data):
+        row = []
+        identifier = data[0]
+        title = data[1]
+        creator = data[2]
+        volume = data[3]
+        details = data[4]
+
+        row.append(identifier)
+        row.append(title)
+        row.append(volume)
+        row.append(creator)
+        row.append(details)
+
+        try:
+            transformed_author = self._get_transformed_author(creator)
+            row.append(transformed_author)
+
+            aws_item = self._execute_query(query, title, transformed_author)
+
+            row.extend(getattr(aws_item, attr) for column, attr in self.RESULT_COLUMNS)
+        except AWSError:
+            e = sys.exc_info()[1]
+            query.metrics.error(e)
+            row.append(e.code + ": " + e.msg)
+
+        return row
+
+    def _load_previous(self, output_path):
+        """
+        Returns a :class:`RowStore` of the rows of an earlier output that
+        found their book. Their completion time is taken from the journal
+        of that output, ``None`` when it is gone.
+        """
+        url_index = self.HEADER.index('DetailPageURL')
+
+        with RowStore(Journal(output_path + ".journal").records()) as journaled:
+            def entries():
+                for row in self._get_data(output_path):
+                    if len(row) == len(self.HEADER) and row[url_index]:
+                        yield row[0], journaled.get(row[0], (None,))[0], row
+
+            return RowStore(entries())
+
+    def _refresh_row(self, query, data, previous):
+        """
+        Returns the output row of ``data`` with the offers of the item of
+        ``previous``, its row in an earlier output, refreshed without
+        searching the item again.
+        """
+        # the source columns as in the source, which may have been edited
+        row = [data[0], data[1], data[3], data[2], data[4], previous[5]]
+        item = BookResult(**dict(
+            (attr, previous[self.HEADER.index(column)]) for column, attr in self.RESULT_COLUMNS))
+        try:
+            item = query.refresh_query(data[1], previous[5], item)
+            row.extend(getattr(item, attr) for column, attr in self.RESULT_COLUMNS)
+        except AWSError:
+            e = sys.exc_info()[1]
+            query.metrics.error(e)
+            row.append(e.code + ": " + e.msg)
+
+        return row
+
+    def _changes(self, previous, row, columns=VOLATILE_COLUMNS):
+        """
+        Yields the change report lines of the ``columns`` ``row`` changed
+        since ``previous``.
+        """
+        if len(row) != len(self.HEADER):
+            return
+        for column in columns:
+            i = self.HEADER.index(column)
+            # compared as written to the output
+            current = '' if row[i] is None else str(row[i])
+            if current != previous[i]:
+                yield [row[0], row[1], column, previous[i], current]
+
+    def _pending_data(self, source_file_path, done):
+        """
+        Yields the source rows that still have to be processed, ``done``
+        holding the rows already completed.
+        """
+        for data in self._get_data(source_file_path):
+            entry = done.get(data[0])
+            if entry is None or entry[1][-1].startswith(self.TRANSIENT_ERRORS):
+                yield data
+
+    def _previous_entry(self, previous, data):
+        """
+        Returns the ``(completed, row)`` of ``data`` in ``previous`` when it
+        was made for the same title and creator, ``None`` otherwise.
+        """
+        entry = previous.get(data[0])
+        if entry is not None and entry[1][1] == data[1] and entry[1][3] == data[2]:
+            return entry
+        return None
+
+    def generate_output(self, source_file_path, output_dir, concurrency=1, resume=False, echo=None,
+                        dedupe=True, since=None, since_days=None,
+                        dedupe_window=QueryDeduplicator.WINDOW):
+        """
+        Runs the query for every row of the source file and writes the
+        results to a tsv file in ``output_dir``, returning its path. Rows
+        are streamed from the source as they are processed. ``echo`` is
+        called with every output row when given.
+
+        With ``dedupe`` rows asking for the same title and author as one of
+        the ``dedupe_window`` distinct queries before them share a single
+        query; ``self.deduplicator.saved`` tells how many were saved.
+        The timings and counters of the run are left in ``self.metrics``.
+
+        With ``since``, the path of an earlier output, the rows that found
+        their book there only get their offers refreshed, see
+        :meth:`Query.refresh_query`, or are copied as they were when they
+        completed less than ``since_days`` days ago. The volatile columns
+        that changed are reported in a ``_changes.tsv`` file next to the
+        output, but for the API_ONLY_COLUMNS when the offers are scraped.
+        """
         filename = os.path.basename(source_file_path)
         output_filename = filename[:-4] + "_output.tsv"
-        datas = self._get_data(source_file_path)
         output_path = os.path.join(output_dir, output_filename)
 
-        query = Query()
+        query = Query(**self.query_options)
+        self.metrics = query.metrics
+
+        # read before the output, which may be the same file, is rewritten
+        previous = self._load_previous(since) if since else {}
+        fresh_after = time.time() - since_days * DAY if since_days else None
+        changes = None
+        changed_columns = self.VOLATILE_COLUMNS
+        if query.offers_source == 'scrape':
+            changed_columns = [column for column in self.VOLATILE_COLUMNS
+                               if column not in self.API_ONLY_COLUMNS]
+
+        # every completed row is journaled so an interrupted run can resume
+        journal = Journal(output_path + ".journal")
+        resume = resume and os.path.isfile(output_path)
+        # kept on disk, a journal may hold more rows than fit in memory
+        done = RowStore(journal.records() if resume else ())
+        journal.open(resume)
+
+        datas = self._pending_data(source_file_path, done)
+        if dedupe:
+            self.deduplicator = QueryDeduplicator(dedupe_window)
+
+        try:
+            if since:
+                changes_path = output_path[:-4] + "_changes.tsv"
+                changes = open(changes_path, "a" if resume else "w", encoding="utf-8", newline="")
+                changes_writer = csv.writer(changes, delimiter="\t")
+                if not resume:
+                    changes_writer.writerow(self.CHANGES_HEADER)
+
+            with open(output_path, "a" if resume else "w", encoding="utf-8", newline="",
+                      buffering=1024 * 1024) as fd:
+                writer = csv.writer(fd, delimiter="\t")
+                if not resume:
+                    writer.writerow(self.HEADER)
+
+                written = 0
+
+                def emit(result):
+                    nonlocal written
+                    # entry is the row of the same book in previous, if any
+                    entry, row = result
+                    if echo is not None:
+                        echo(row)
+                    with self.metrics.time('write'), around('BookQuery.emit'):
+                        writer.writerow(row)
+                        if entry is not None and entry[1] is row:
+                            # kept as is, it gets no younger
+                            journal.record(row[0], row, entry[0])
+                        else:
+                            journal.record(row[0], row)
+                            if entry is not None:
+                                lines = list(self._changes(entry[1], row, changed_columns))
+                                changes_writer.writerows(lines)
+                                if lines:
+                                    self.metrics.count('rows_changed')
+                    self.metrics.count('rows')
+
+                    written += 1
+                    if written % self.FLUSH_EVERY == 0:
+                        fd.flush()
+                        if self.prometheus_file is not None:
+                            self.metrics.write_prometheus(self.prometheus_file)
+
+                def process(data):
+                    entry = self._previous_entry(previous, data)
+                    with self.metrics.time('row'):
+                        if entry is None:
+                            return None, self._process_row(query, data)
+                        if (fresh_after is not None and entry[0] is not None
+                                and entry[0] > fresh_after):
+                            self.metrics.count('rows_kept')
+                            return entry, entry[1]
+                        self.metrics.count('rows_refreshed')
+                        return entry, self._refresh_row(query, data, entry[1])
+
+                if concurrency > 1:
+                    pipeline = AsyncPipeline(process, concurrency)
+                    pipeline.run(datas, emit)
+                else:
+                    for data in datas:
+                        emit(process(data))
+        except BaseException:
+            done.close()
+            raise
+        finally:
+            journal.close()
+            if since:
+                previous.close()
+            if changes is not None:
+                changes.close()
+            if self.prometheus_file is not None:
+                self.metrics.write_prometheus(self.prometheus_file)
+
+        with done:
+            if resume:
+                # the rows of this run replace those of the runs before
+                done.update(journal.records(journal.resumed_at))
+                self._rebuild_output(source_file_path, output_path, done)
+
+        return output_path
+
+    def process_queue(self, queue, worker, batch_size=None, concurrency=1):
+        """
+        Processes the rows of ``queue``, a :class:`WorkQueue`, in batches
+        of ``batch_size`` claimed under the name ``worker`` until none is
+        left, storing every output row back in the queue. Rows that failed
+        with a transient error are queued again, and waited for. Returns
+        the number of rows done.
+        """
+        query = Query(**self.query_options)
+        self.metrics = query.metrics
+        batch_size = batch_size or concurrency * 4
+        processed = 0
+
+        def process(item):
+            position, data = item
+            with self.metrics.time('row'):
+                return position, self._process_row(query, data)
+
+        def emit(result):
+            nonlocal processed
+            position, row = result
+            retry = (len(row) < len(self.HEADER)
+                     and row[-1].startswith(self.TRANSIENT_ERRORS))
+            with self.metrics.time('write'), around('BookQuery.emit'):
+                done = queue.complete(worker, position, row, retry)
+            if done:
+                self.metrics.count('rows')
+                processed += 1
+            elif retry:
+                self.metrics.count('rows_retried')
+
+        # the same threads process every batch
+        pipeline = AsyncPipeline(process, concurrency).open() if concurrency > 1 else None
+        try:
+            while True:
+                batch = queue.claim(worker, batch_size)
+                if not batch:
+                    # retried rows come due and the leases of dead workers
+                    # expire, wait for them until every row is done
+                    wait = queue.wait_time()
+                    if wait is None:
+                        break
+                    time.sleep(min(max(wait, 1), 60))
+                    continue
+                if pipeline is not None:
+                    pipeline.run(batch, emit)
+                else:
+                    for item in batch:
+                        emit(process(item))
+                if self.prometheus_file is not None:
+                    self.metrics.write_prometheus(self.prometheus_file)
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+            # a stopped worker hands its rows over at once
+            queue.release(worker)
+
+        return processed
+
+    def export_queue(self, queue, output_dir, partial=False):
+        """
+        Writes the output rows of ``queue`` to a tsv file in ``output_dir``
+        in the order of the source file, and returns its path. Raises
+        ValueError when some rows are not done, unless ``partial``, in
+        which case they are left out.
+        """
+        output_path = os.path.join(output_dir, queue.name[:-4] + "_output.tsv")
+        if not partial:
+            status = queue.status()
+            missing = sum(status.values()) - status['done']
+            if missing:
+                raise ValueError('{} rows of the queue are not done'.format(missing))
 
-        with open(output_path, "w", encoding="utf-8", newline="") as fd:
+        tmp_path = output_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8", newline="") as fd:
             writer = csv.writer(fd, delimiter="\t")
-            header = ['identifier', 'title', 'volume', 'creator', 'details', 'transformed_author', 'amzn-Author',
-                      'amzn-Title', 'DetailPageURL', 'TotalNew', 'TotalUsed', 'TotalCollectible', 'LowestNewPrice',
-                      'LowestUsedPrice', 'LowestCollectiblePrice', 'SoldByAmzn', 'SoldByAmznNew']
-            writer.writerow(header)
-
-            for data in datas:
-                row = []
-                identifier = data[0]
-                title = data[1]
-                creator = data[2]
-                volume = data[3]
-                details = data[4]
-
-                row.append(identifier)
-                row.append(title)
-                row.append(volume)
-                row.append(creator)
-                row.append(details)
-
-                try:
-                    transformed_author = self._get_transformed_author(creator)
-                    row.append(transformed_author)
-
-                    aws_item = query.execute_query(title, transformed_author)
-
-                    row.append(aws_item['author'])
-                    row.append(aws_item['title'])
-                    row.append(aws_item['detail_page_url'])
-                    row.append(aws_item['total_new'])
-                    row.append(aws_item['total_used'])
-                    row.append(aws_item['total_collectible'])
-                    row.append(aws_item['lowest_new_price'])
-                    row.append(aws_item['lowest_used_price'])
-                    row.append(aws_item['lowest_collectible_price'])
-                    row.append(aws_item['sold_by_amazon'])
-                    row.append(aws_item['sold_by_amazon_as_new'])
-                except AWSError:
-                    e = sys.exc_info()[1]
-                    row.append(e.code + ": " + e.msg)
-
-                print(row)
-                writer.writerow(row)
+            writer.writerow(self.HEADER)
+            for row in queue.results():
+                if row is not None:
+                    writer.writerow(row)
 
+        os.replace(tmp_path, output_path)
         return output_path
 
+    def _rebuild_output(self, source_file_path, output_path, done):
+        """
+        Rewrites the output of a resumed run in the order of the source
+        file, taking every row from ``done``, the rows of the journal.
+        """
+        tmp_path = output_path + ".tmp"
+
+        with open(tmp_path, "w", encoding="utf-8", newline="") as fd:
+            writer = csv.writer(fd, delimiter="\t")
+            writer.writerow(self.HEADER)
+            for data in self._get_data(source_file_path):
+                completed, row = done.get(data[0])
+                writer.writerow(row)
+
+        os.replace(tmp_path, output_path)
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.amazonbookquery', 'cache.sqlite')
+DEFAULT_ASIN_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.amazonbookquery', 'asins.sqlite')
+
+
 def _parse_args(args=sys.argv[1:]):
     parser = argparse.ArgumentParser(description='Provide Amazon Book Query search result as a tsv file format')
 
@@ -117,55 +462,639 @@ def _parse_args(args=sys.argv[1:]):
         help='destination directory path to save output file as tsv format',
         required=True,
     )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='number of processes sharing the work, each with its own credentials (default: 1)',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--credentials',
+        help='INI file with one section of access_key, secret_key, associate_tag and optionally '
+             'requests_per_second per account, one account per worker',
+    )
+    parser.add_argument(
+        '--no-dedupe',
+        help='query every row, even when an earlier row asked for the same title and author',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--dedupe-window',
+        help='distinct titles and authors whose results are kept for the rows asking for them '
+             'again (default: {})'.format(QueryDeduplicator.WINDOW),
+        type=int,
+        default=QueryDeduplicator.WINDOW,
+    )
+    parser.add_argument(
+        '--echo',
+        help='print every output row to stdout',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--resume',
+        help='continue an interrupted run, skipping the rows it already completed',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--since',
+        help='earlier output of the same source: the rows that found their book there keep it and '
+             'only get their offers and prices refreshed, the changes being reported in a '
+             '_changes.tsv file',
+    )
+    parser.add_argument(
+        '--since-days',
+        help='with --since, copy the rows completed less than this many days ago as they are',
+        type=float,
+    )
+
+    _add_query_arguments(parser)
 
     return parser.parse_args(args)
 
 
+def _add_query_arguments(parser):
+    """
+    Adds the options of the queries and of their execution to ``parser``.
+    """
+    parser.add_argument(
+        '-c',
+        '--concurrency',
+        help='number of rows processed concurrently (default: 1)',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--rate',
+        help='API requests per second allowed by the account quota (default: 1)',
+        type=float,
+        default=Query.REQUESTS_PER_SECOND,
+    )
+    parser.add_argument(
+        '--burst',
+        help='number of API requests that may be sent back to back (default: 1)',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--rate-state',
+        help='file holding the rate limiter state shared by every process using the same keys',
+    )
+    parser.add_argument(
+        '--lookup-batch',
+        help='number of ASINs resolved by a single ItemLookup call, at most 10 (default: 1)',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--offers-source',
+        help='take offer counts and prices from the API OfferSummary, from the detail page, or '
+             'from the API and the detail page only when the summary is missing (default: scrape)',
+        choices=Query.OFFERS_SOURCES,
+        default='scrape',
+    )
+    parser.add_argument(
+        '--single-call',
+        help='ask ItemSearch for the attributes and offers too and skip the ItemLookup when it '
+             'has them',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--scrape-engine',
+        help='HTML parser used on detail pages, lxml is much faster (default: bs4)',
+        choices=sorted(SCRAPE_ENGINES),
+        default='bs4',
+    )
+    parser.add_argument(
+        '--parse-engine',
+        help='XML parser used on API responses, etree is faster (default: objectify)',
+        choices=sorted(PARSE_ENGINES),
+        default='objectify',
+    )
+    parser.add_argument(
+        '--stream-pages',
+        help='stop downloading detail pages once their offer sections have been read',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--pool-size',
+        help='keep-alive connections kept per host (default: the concurrency, at least 10)',
+        type=int,
+    )
+    parser.add_argument(
+        '--connect-timeout',
+        help='seconds to wait for a connection to be established (default: 10)',
+        type=float,
+        default=10,
+    )
+    parser.add_argument(
+        '--read-timeout',
+        help='seconds to wait for data from an established connection (default: 30)',
+        type=float,
+        default=30,
+    )
+    parser.add_argument(
+        '--max-attempts',
+        help='attempts made for a request before its row is recorded as failed (default: 5)',
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        '--backoff',
+        help='seconds waited before the first retry, doubled on every further retry (default: 1)',
+        type=float,
+        default=1,
+    )
+    parser.add_argument(
+        '--cool-down',
+        help='seconds waited at least before retrying a throttled or captcha request '
+             '(default: 30)',
+        type=float,
+        default=30,
+    )
+    parser.add_argument(
+        '--host',
+        help='Product Advertising API host, e.g. of another locale '
+             '(default: webservices.amazon.com)',
+        default='webservices.amazon.com',
+    )
+    parser.add_argument(
+        '--cache',
+        help='response cache file (default: {})'.format(DEFAULT_CACHE_PATH),
+        default=DEFAULT_CACHE_PATH,
+    )
+    parser.add_argument(
+        '--cache-size',
+        help='maximum size of the cached responses in megabytes (default: 512)',
+        type=int,
+        default=512,
+    )
+    cache_mode = parser.add_mutually_exclusive_group()
+    cache_mode.add_argument(
+        '--no-cache',
+        help='neither read nor write the response cache',
+        action='store_true',
+    )
+    cache_mode.add_argument(
+        '--refresh-cache',
+        help='ignore cached responses but store the fresh ones',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--prune-cache',
+        help='remove expired entries from the response cache before running',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--no-match-ttl',
+        help='days a search that found nothing is not tried again (default: 7)',
+        type=float,
+        default=ResponseCache.DEFAULT_TTLS[Query.NO_MATCH] / DAY,
+    )
+    parser.add_argument(
+        '--search-cascade',
+        help='comma separated searches tried in turn until one finds the book, from {} '
+             '(default: title-author)'.format(', '.join(Query.SEARCH_STEPS)),
+        type=lambda value: tuple(value.split(',')),
+        default=Query.SEARCH_STEPS[:1],
+    )
+    parser.add_argument(
+        '--asin-index',
+        help='file mapping the titles and authors found to their ASIN, so that they are looked up '
+             'without a search (default: {})'.format(DEFAULT_ASIN_INDEX_PATH),
+        default=DEFAULT_ASIN_INDEX_PATH,
+    )
+    parser.add_argument(
+        '--no-asin-index',
+        help='search every book, neither read nor update the ASIN index',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--fuzzy-index',
+        help='also take the closest indexed book when its similarity to the query reaches this '
+             'score, between 0 and 1 (default: exact matches only)',
+        type=float,
+    )
+    parser.add_argument(
+        '--index-confidence',
+        help='take an indexed book only when the item found looked at least that much like its '
+             'query, between 0 and 1 (default: 0.5)',
+        type=float,
+        default=0.5,
+    )
+    parser.add_argument(
+        '--report',
+        help='write a JSON summary of stage timings, events and errors to this file, - for stderr',
+    )
+    parser.add_argument(
+        '--prometheus-file',
+        help='keep the metrics of the run in this file, in the Prometheus text format',
+    )
+    parser.add_argument(
+        '--prometheus-port',
+        help='serve the metrics of the run on http://localhost:PORT/metrics',
+        type=int,
+    )
+    parser.add_argument(
+        '--prometheus-host',
+        help='address the metrics are served on, 0.0.0.0 to let other machines scrape them '
+             '(default: 127.0.0.1)',
+        default='127.0.0.1',
+    )
+    parser.add_argument(
+        '--profile',
+        help='write cProfile stats of the api, scrape and write stages to this directory',
+    )
+    parser.add_argument(
+        '--profile-sample',
+        help='fraction of the rows profiled with --profile (default: 1)',
+        type=float,
+        default=1.0,
+    )
+
+
+def _query_options(args, credentials=None):
+    """
+    Returns the Query options given on the command line, for the account
+    in ``credentials`` if any.
+    """
+    credentials = credentials or {}
+    rate = credentials.get('requests_per_second', args.rate)
+    rate_state = credentials.get('rate_state', args.rate_state)
+
+    if rate_state:
+        rate_limiter = FileTokenBucket(rate_state, rate, capacity=args.burst)
+    else:
+        rate_limiter = TokenBucket(rate, capacity=args.burst)
+
+    transport = Transport(
+        pool_size=args.pool_size or max(10, args.concurrency),
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout
+    )
+
+    retry_policy = RetryPolicy(max_attempts=args.max_attempts, base_delay=args.backoff,
+                               cool_down=args.cool_down)
+
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(
+            args.cache,
+            ttls=_cache_ttls(args),
+            max_size=args.cache_size * 1024 * 1024,
+            refresh=args.refresh_cache
+        )
+
+    asin_index = None
+    if not args.no_asin_index:
+        asin_index = AsinIndex(args.asin_index, fuzzy=args.fuzzy_index,
+                               min_confidence=args.index_confidence)
+
+    return {
+        'rate_limiter': rate_limiter,
+        'lookup_batch_size': args.lookup_batch,
+        'cache': cache,
+        'offers_source': args.offers_source,
+        'scrape_engine': args.scrape_engine,
+        'parse_engine': args.parse_engine,
+        'scrape_stream': args.stream_pages,
+        'transport': transport,
+        'retry_policy': retry_policy,
+        'single_call': args.single_call,
+        'asin_index': asin_index,
+        'search_cascade': args.search_cascade,
+        'host': args.host,
+        'access_key': credentials.get('access_key'),
+        'secret_key': credentials.get('secret_key'),
+        'associate_tag': credentials.get('associate_tag'),
+    }
+
+
+def _cache_ttls(args):
+    return {Query.NO_MATCH: args.no_match_ttl * DAY}
+
+
+def _run_shard(args, shard_path, shard_dir, credentials):
+    """
+    Processes one shard of a ``--workers`` run in a worker process. Returns
+    the path of its output and the summary of its metrics.
+    """
+    prometheus_file = None
+    if args.prometheus_file:
+        # one file per worker, named after its shard
+        prometheus_file = '{}.{}'.format(args.prometheus_file, os.path.basename(shard_path)[:-4])
+
+    profile_dir = None
+    if args.profile:
+        profile_dir = os.path.join(args.profile, os.path.basename(shard_path)[:-4])
+
+    book_status = BookQuery(prometheus_file=prometheus_file, **_query_options(args, credentials))
+    with _profiled(profile_dir, args.profile_sample):
+        output_path = book_status.generate_output(
+            shard_path,
+            shard_dir,
+            concurrency=args.concurrency,
+            resume=args.resume,
+            dedupe=not args.no_dedupe,
+            dedupe_window=args.dedupe_window
+        )
+    return output_path, book_status.metrics.summary()
+
+
+def _profiled(directory, sample):
+    """
+    Returns the context manager profiling a run into ``directory``, if any.
+    """
+    if directory is None:
+        return ExitStack()
+    return Profiler(directory, sample)
+
+
+def _write_report(metrics, path):
+    if path == '-':
+        json.dump(metrics.summary(), sys.stderr, indent=2, sort_keys=True)
+        sys.stderr.write('\n')
+    else:
+        metrics.write_json(path)
+
+
+def _check_environment():
+    if os.getenv('AMAZON_ACCESS_KEY') is None:
+        msg = 'AMAZON_ACCESS_KEY should be set as a environment variable'
+        sys.exit(msg)
+    if os.getenv('AMAZON_SECRET_KEY') is None:
+        msg = 'AMAZON_SECRET_KEY should be set as a environment variable'
+        sys.exit(msg)
+    if os.getenv('AMAZON_ASSOC_KEY') is None:
+        msg = 'AMAZON_ASSOC_KEY should be set as a environment variable'
+        sys.exit(msg)
+
+
+def _check_query_args(args):
+    """
+    Exits with a message when the options of _add_query_arguments are
+    out of range.
+    """
+    if args.concurrency < 1:
+        msg = 'Concurrency should be a positive integer'
+        sys.exit(msg)
+    if args.rate <= 0 or args.burst < 1:
+        msg = 'Rate and burst should be positive'
+        sys.exit(msg)
+    if not 1 <= args.lookup_batch <= 10:
+        msg = 'Lookup batch should be between 1 and 10'
+        sys.exit(msg)
+    if not 0 < args.profile_sample <= 1:
+        msg = 'Profile sample should be between 0 and 1'
+        sys.exit(msg)
+    unknown_steps = set(args.search_cascade) - set(Query.SEARCH_STEPS)
+    if unknown_steps:
+        msg = 'Unknown search cascade steps: {}'.format(', '.join(sorted(unknown_steps)))
+        sys.exit(msg)
+    if args.no_match_ttl < 0:
+        msg = 'No match TTL should not be negative'
+        sys.exit(msg)
+    if args.fuzzy_index is not None and not 0 < args.fuzzy_index <= 1:
+        msg = 'Fuzzy index score should be between 0 and 1'
+        sys.exit(msg)
+    if not 0 <= args.index_confidence <= 1:
+        msg = 'Index confidence should be between 0 and 1'
+        sys.exit(msg)
+
+
 def main():
-    # args = _parse_args()
-
-    # if not os.access(args.destination, os.W_OK):
-    #     msg = 'Cannot write to destination: {}'.format(args.destination)
-    #     sys.exit(msg)
-    #
-    # if os.getenv('AMAZON_ACCESS_KEY') is None:
-    #     msg = 'AMAZON_ACCESS_KEY should be set as a environment variable'
-    #     sys.exit(msg)
-    # if os.getenv('AMAZON_SECRET_KEY') is None:
-    #     msg = 'AMAZON_SECRET_KEY should be set as a environment variable'
-    #     sys.exit(msg)
-    # if os.getenv('AMAZON_ASSOC_KEY') is None:
-    #     msg = 'AMAZON_ASSOC_KEY should be set as a environment variable'
-    #     sys.exit(msg)
-    # if not os.path.isfile(args.source):
-    #     msg = 'Source should be a file'
-    #     sys.exit(msg)
-    #
-    # (filename, ext) = os.path.splitext(args.source)
-    # if ext != '.tsv':
-    #     print(os.path.splitext(args.source))
-    #     msg = 'Source should be tsv file format'
-    #     sys.exit(msg)
-    # if not os.path.isdir(args.destination):
-    #     msg = 'Destination should be a directory'
-    #     sys.exit(msg)
-
-
-
-    # book_status = BookQuery()
-    # output_path = book_status.generate_output(
-    #     args.source,
-    #     args.destination
-    # )
-
-    # print(output_path)
-
-    book_status = BookQuery()
-    output_path = book_status.generate_output(
-        "E:\Work\Real-Work\Wayback Machine\AmazonBookQuery_12_12_07_34\source_files\Amazontestquery.tsv",
-        "E:\Work\Real-Work\Wayback Machine\AmazonBookQuery_12_12_07_34\source_files"
+    args = _parse_args()
+
+    if not os.access(args.destination, os.W_OK):
+        msg = 'Cannot write to destination: {}'.format(args.destination)
+        sys.exit(msg)
+
+    # a credentials file replaces the keys of the environment
+    if not args.credentials:
+        _check_environment()
+    if not os.path.isfile(args.source):
+        msg = 'Source should be a file'
+        sys.exit(msg)
+
+    (filename, ext) = os.path.splitext(args.source)
+    if ext != '.tsv':
+        msg = 'Source should be tsv file format'
+        sys.exit(msg)
+    if not os.path.isdir(args.destination):
+        msg = 'Destination should be a directory'
+        sys.exit(msg)
+    _check_query_args(args)
+    if args.workers < 1:
+        msg = 'Workers should be a positive integer'
+        sys.exit(msg)
+    if args.dedupe_window < 1:
+        msg = 'Dedupe window should be a positive integer'
+        sys.exit(msg)
+    if args.since is not None and not os.path.isfile(args.since):
+        msg = 'Previous output should be a file'
+        sys.exit(msg)
+    if args.since_days is not None and (args.since is None or args.since_days <= 0):
+        msg = 'Since days should be positive and go with --since'
+        sys.exit(msg)
+    if args.since is not None and args.workers > 1:
+        msg = 'Previous output cannot be used with workers'
+        sys.exit(msg)
+    output_path = os.path.join(args.destination, os.path.basename(filename) + '_output.tsv')
+    if (args.since is not None and args.resume
+            and os.path.abspath(args.since) == os.path.abspath(output_path)):
+        msg = 'Previous output is being rewritten, copy it aside to resume'
+        sys.exit(msg)
+    if args.workers > 1 and args.prometheus_port:
+        msg = 'Prometheus port cannot be used with workers, use a Prometheus file per worker'
+        sys.exit(msg)
+
+    if args.prune_cache and not args.no_cache:
+        ResponseCache(args.cache, ttls=_cache_ttls(args),
+                      max_size=args.cache_size * 1024 * 1024).prune()
+
+    if args.workers > 1:
+        if args.credentials:
+            try:
+                credentials = load_credentials(args.credentials)
+            except ValueError as e:
+                sys.exit(str(e))
+            if len(credentials) < args.workers:
+                msg = 'Credentials file holds {} accounts for {} workers'.format(
+                    len(credentials), args.workers)
+                sys.exit(msg)
+            credentials = credentials[:args.workers]
+        else:
+            # every worker uses the environment keys, so they share one bucket
+            rate_state = args.rate_state or os.path.join(args.destination, '.amazonbookquery_rate')
+            credentials = [{'rate_state': rate_state}] * args.workers
+
+        output_path, summaries = run_sharded(
+            args.source, args.destination, partial(_run_shard, args), credentials)
+        metrics = Metrics()
+        for summary in summaries:
+            metrics.merge(summary)
+    else:
+        metrics = Metrics()
+        if args.prometheus_port:
+            metrics.serve(args.prometheus_port, args.prometheus_host)
+
+        book_status = BookQuery(prometheus_file=args.prometheus_file, metrics=metrics,
+                                **_query_options(args))
+        try:
+            with _profiled(args.profile, args.profile_sample):
+                output_path = book_status.generate_output(
+                    args.source,
+                    args.destination,
+                    concurrency=args.concurrency,
+                    resume=args.resume,
+                    echo=print if args.echo else None,
+                    dedupe=not args.no_dedupe,
+                    dedupe_window=args.dedupe_window,
+                    since=args.since,
+                    since_days=args.since_days
+                )
+        finally:
+            metrics.close()
+        if book_status.deduplicator is not None:
+            print('{} of {} queries saved by deduplication'.format(
+                book_status.deduplicator.saved, book_status.deduplicator.rows), file=sys.stderr)
+
+    if args.report:
+        _write_report(metrics, args.report)
+
+    print(output_path)
+
+
+def _parse_queue_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description='Share the queries of a source file among workers of one or several machines '
+                    'through a queue file')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    enqueue = commands.add_parser(
+        'enqueue', help='load the rows of a source tsv file into the queue')
+    enqueue.add_argument('-q', '--queue', help='queue file', required=True)
+    enqueue.add_argument('-s', '--source', help='source file path', required=True)
+
+    worker = commands.add_parser('worker', help='process queued rows until none is left')
+    worker.add_argument('-q', '--queue', help='queue file', required=True)
+    worker.add_argument(
+        '--batch',
+        help='rows claimed at once (default: 4 times the concurrency)',
+        type=int,
+    )
+    worker.add_argument(
+        '--lease',
+        help='seconds after which the rows of a worker that completes none of them are given to '
+             'another worker (default: 300)',
+        type=float,
+        default=300,
+    )
+    worker.add_argument(
+        '--row-attempts',
+        help='times a row failing with a transient error is queued (default: 3)',
+        type=int,
+        default=3,
+    )
+    worker.add_argument(
+        '--retry-delay',
+        help='seconds before a row queued again may be claimed, doubled on every further attempt '
+             '(default: 60)',
+        type=float,
+        default=60,
+    )
+    _add_query_arguments(worker)
+
+    export = commands.add_parser('export', help='write the output tsv file of the queue')
+    export.add_argument('-q', '--queue', help='queue file', required=True)
+    export.add_argument(
+        '-d',
+        '--destination',
+        help='destination directory path to save output file as tsv format',
+        required=True,
+    )
+    export.add_argument(
+        '--partial',
+        help='export the rows done so far instead of failing when some are not',
+        action='store_true',
     )
 
+    status = commands.add_parser('status', help='print the number of rows per state')
+    status.add_argument('-q', '--queue', help='queue file', required=True)
+
+    return parser.parse_args(args)
+
+
+def queue_main():
+    args = _parse_queue_args()
+
+    if args.command == 'enqueue':
+        if not os.path.isfile(args.source) or os.path.splitext(args.source)[1] != '.tsv':
+            msg = 'Source should be a tsv file'
+            sys.exit(msg)
+        queue = WorkQueue(args.queue)
+        try:
+            added = queue.enqueue(
+                os.path.basename(args.source), BookQuery()._get_data(args.source))
+        except ValueError as e:
+            sys.exit(str(e))
+        print('{} rows enqueued'.format(added))
+        return
+
+    if not os.path.isfile(args.queue):
+        msg = 'Queue should be a file'
+        sys.exit(msg)
+
+    if args.command == 'status':
+        for state, count in sorted(WorkQueue(args.queue).status().items()):
+            print('{}\t{}'.format(state, count))
+        return
+
+    if args.command == 'export':
+        if not os.path.isdir(args.destination) or not os.access(args.destination, os.W_OK):
+            msg = 'Cannot write to destination: {}'.format(args.destination)
+            sys.exit(msg)
+        try:
+            print(BookQuery().export_queue(
+                WorkQueue(args.queue), args.destination, partial=args.partial))
+        except ValueError as e:
+            sys.exit(str(e))
+        return
+
+    _check_environment()
+    _check_query_args(args)
+    if args.lease <= 0 or args.row_attempts < 1 or (args.batch is not None and args.batch < 1):
+        msg = 'Lease, row attempts and batch should be positive'
+        sys.exit(msg)
+    if args.retry_delay < 0:
+        msg = 'Retry delay should not be negative'
+        sys.exit(msg)
+
+    if args.prune_cache and not args.no_cache:
+        ResponseCache(args.cache, ttls=_cache_ttls(args),
+                      max_size=args.cache_size * 1024 * 1024).prune()
+
+    queue = WorkQueue(args.queue, lease=args.lease, max_attempts=args.row_attempts,
+                      retry_delay=args.retry_delay)
+    metrics = Metrics()
+    if args.prometheus_port:
+        metrics.serve(args.prometheus_port, args.prometheus_host)
+
+    book_status = BookQuery(prometheus_file=args.prometheus_file, metrics=metrics,
+                            **_query_options(args))
+    try:
+        with _profiled(args.profile, args.profile_sample):
+            processed = book_status.process_queue(
+                queue, worker_name(), batch_size=args.batch, concurrency=args.concurrency)
+    finally:
+        metrics.close()
+
+    if args.report:
+        _write_report(metrics, args.report)
+
+    print('{} rows done'.format(processed))
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+Durable queue of source rows shared by any number of worker processes.
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+__all__ = ['WorkQueue', 'worker_name']
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+
+
+def worker_name():
+    """
+    Returns a name telling apart the workers of every machine.
+    """
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class WorkQueue(object):
+    """
+    SQLite file holding the rows of one source file, in source order, with
+    their state and output row once done.
+
+    Workers :meth:`claim` batches of pending rows under a lease of
+    ``lease`` seconds, renewed whenever they :meth:`complete` one of them.
+    Rows whose lease expired, e.g. because their worker died, are claimed
+    again by the next worker asking. Rows completed with ``retry`` go back
+    to the queue until they were tried ``max_attempts`` times, and may be
+    claimed again after ``retry_delay`` seconds, doubled on every attempt.
+
+    Workers of several machines may share the file on a filesystem with
+    working locks.
+    """
+
+    def __init__(self, path, lease=300, max_attempts=3, retry_delay=60):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        self._lock = threading.Lock()
+        # transactions are begun explicitly, claims must lock the file
+        self._db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self._transaction():
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS meta ('
+                ' name TEXT PRIMARY KEY,'
+                ' value TEXT NOT NULL)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS rows ('
+                ' position INTEGER PRIMARY KEY,'
+                ' identifier TEXT NOT NULL UNIQUE,'
+                ' data TEXT NOT NULL,'
+                ' state TEXT NOT NULL,'
+                ' owner TEXT,'
+                ' expires REAL,'
+                ' attempts INTEGER NOT NULL,'
+                ' result TEXT,'
+                ' completed REAL,'
+                ' not_before REAL)')
+            # queues made before rows were retried later
+            columns = [column[1] for column in self._db.execute('PRAGMA table_info(rows)')]
+            if 'not_before' not in columns:
+                self._db.execute('ALTER TABLE rows ADD COLUMN not_before REAL')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS rows_state ON rows (state, position)')
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock of the file at once, so that
+        # two workers never claim the same rows
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    @property
+    def name(self):
+        """
+        Name of the source file the rows come from, ``None`` while empty.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE name = 'source'").fetchone()
+        return row[0] if row is not None else None
+
+    def enqueue(self, name, datas):
+        """
+        Adds the rows ``datas`` of the source file ``name``, skipping those
+        whose identifier is already queued. Returns the number added.
+        """
+        with self._transaction():
+            row = self._db.execute("SELECT value FROM meta WHERE name = 'source'").fetchone()
+            if row is None:
+                self._db.execute("INSERT INTO meta VALUES ('source', ?)", (name,))
+            elif row[0] != name:
+                raise ValueError('Queue holds the rows of {}, not of {}'.format(row[0], name))
+
+            before = self._db.total_changes
+            self._db.executemany(
+                'INSERT OR IGNORE INTO rows (identifier, data, state, attempts)'
+                ' VALUES (?, ?, ?, 0)',
+                ((data[0], json.dumps(data), PENDING) for data in datas))
+            return self._db.total_changes - before
+
+    def claim(self, owner, count):
+        """
+        Leases up to ``count`` rows to ``owner``, the first pending ones
+        due or those whose lease expired. Returns ``(position, data)``
+        pairs.
+        """
+        now = time.time()
+        with self._transaction():
+            rows = self._db.execute(
+                'SELECT position, data FROM rows'
+                ' WHERE (state = ? AND (not_before IS NULL OR not_before <= ?))'
+                ' OR (state = ? AND expires < ?)'
+                ' ORDER BY position LIMIT ?',
+                (PENDING, now, LEASED, now, count)).fetchall()
+            self._db.executemany(
+                'UPDATE rows SET state = ?, owner = ?, expires = ?, attempts = attempts + 1'
+                ' WHERE position = ?',
+                ((LEASED, owner, now + self.lease, position) for position, data in rows))
+
+        return [(position, json.loads(data)) for position, data in rows]
+
+    def complete(self, owner, position, row, retry=False):
+        """
+        Stores ``row``, the output of the row at ``position``, and renews
+        the other leases of ``owner``. With ``retry`` the row is queued
+        again instead, unless it had all its attempts. Returns whether the
+        row is done.
+        """
+        # as written to the output file
+        row = ['' if value is None else str(value) for value in row]
+        now = time.time()
+        with self._transaction():
+            # another worker may have been given the row after our lease
+            # expired, the first result stored wins
+            state, attempts = self._db.execute(
+                'SELECT state, attempts FROM rows WHERE position = ?', (position,)).fetchone()
+            if state == DONE:
+                return False
+
+            if retry and attempts < self.max_attempts:
+                self._db.execute(
+                    'UPDATE rows SET state = ?, owner = NULL, expires = NULL, not_before = ?'
+                    ' WHERE position = ?',
+                    (PENDING, now + self.retry_delay * 2 ** (attempts - 1), position))
+                done = False
+            else:
+                self._db.execute(
+                    'UPDATE rows SET state = ?, owner = NULL, expires = NULL, result = ?,'
+                    ' completed = ? WHERE position = ?',
+                    (DONE, json.dumps(row), now, position))
+                done = True
+
+            self._db.execute(
+                'UPDATE rows SET expires = ? WHERE owner = ? AND state = ?',
+                (now + self.lease, owner, LEASED))
+        return done
+
+    def wait_time(self):
+        """
+        Returns the seconds until a row that is not done may be claimed,
+        e.g. a retried row or one whose lease is about to expire, or
+        ``None`` when every row is done.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT MIN(CASE WHEN state = ? THEN COALESCE(not_before, 0) ELSE expires END)'
+                ' FROM rows WHERE state != ?', (PENDING, DONE)).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def release(self, owner):
+        """
+        Puts the rows leased to ``owner`` back in the queue, e.g. when it
+        is stopped.
+        """
+        with self._transaction():
+            self._db.execute(
+                'UPDATE rows SET state = ?, owner = NULL, expires = NULL, attempts = attempts - 1'
+                ' WHERE owner = ? AND state = ?',
+                (PENDING, owner, LEASED))
+
+    def status(self):
+        """
+        Returns the number of rows per state, leases that expired counted
+        as ``expired``.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT CASE WHEN state = ? AND expires < ? THEN ? ELSE state END AS s,'
+                ' COUNT(*) FROM rows GROUP BY s',
+                (LEASED, time.time(), 'expired')).fetchall()
+        ret = dict((state, 0) for state in (PENDING, LEASED, 'expired', DONE))
+        ret.update(rows)
+        return ret
+
+    def results(self):
+        """
+        Yields the output row of every row, in source order, ``None`` for
+        those not done yet.
+        """
+        position = 0
+        while True:
+            # read a chunk at a time, the queue may not fit in memory
+            with self._lock:
+                rows = self._db.execute(
+                    'SELECT position, state, result FROM rows WHERE position > ?'
+                    ' ORDER BY position LIMIT 1000', (position,)).fetchall()
+            if not rows:
+                break
+            for position, state, result in rows:
+                yield json.loads(result) if state == DONE else None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Runs amazon-book-query end to end against the fake server of
+fake_amazon.py, once per execution mode, and reports for each the rows
+per second, the p50/p99 row latency, the API calls and detail pages per
+row and the peak RSS.
+
+Every mode runs in its own process on the same generated source file,
+without cache and with a rate limit high enough not to be the bottleneck
+unless ``--rate`` says otherwise.
+
+    $ python benchmarks/bench_e2e.py [--rows N] [--latency SECONDS] [--modes serial,concurrent]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+from fake_amazon import FakeAmazon, SECRET_KEY  # noqa: E402
+
+# name -> amazon-book-query options
+MODES = (
+    ('serial', []),
+    ('concurrent', ['-c', '16']),
+    ('batched', ['-c', '16', '--lookup-batch', '10']),
+    ('single-call', ['-c', '16', '--single-call']),
+    ('lxml-stream', ['-c', '16', '--single-call', '--scrape-engine', 'lxml', '--stream-pages',
+                     '--parse-engine', 'etree']),
+    ('workers', ['-w', '2', '-c', '8', '--single-call', '--scrape-engine', 'lxml',
+                 '--parse-engine', 'etree']),
+)
+
+RUN = 'from amazonbookquery.utils import main; main()'
+
+WORDS = ('river', 'night', 'garden', 'letters', 'empire', 'silent', 'winter', 'house', 'stone',
+         'history', 'journey', 'light', 'secret', 'war', 'children', 'ocean', 'city', 'memory')
+
+
+def write_source(path, rows, duplicates, seed=0):
+    """
+    Writes a source tsv of ``rows`` books, a ``duplicates`` fraction of
+    which repeat an earlier title and author.
+    """
+    rand = random.Random(seed)
+    books = []
+    with open(path, 'w', encoding='utf-8') as fd:
+        fd.write('identifier\ttitle\tcreator\tvolume\tdetails\n')
+        for i in range(rows):
+            if books and rand.random() < duplicates:
+                title, creator = rand.choice(books)
+            else:
+                title = ' '.join(rand.choice(WORDS) for _ in range(3)).title() + ' %d' % i
+                creator = 'Author%d, %s' % (
+                    rand.randrange(1000), rand.choice(('Ann', 'Bob', 'Eve')))
+                books.append((title, creator))
+            fd.write('bench%d\t%s\t%s\t\t\n' % (i, title, creator))
+
+
+def run_mode(options, source, directory, host, args):
+    report = os.path.join(directory, 'report.json')
+    command = [
+        sys.executable, '-c', RUN, '-s', source, '-d', directory, '--host', host,
+        # every mode starts cold, without the books found by the previous ones
+        '--no-cache', '--no-asin-index',
+        '--rate', str(args.rate), '--burst', str(max(1, int(args.rate / 10))),
+        '--backoff', '0.05', '--cool-down', '0.2', '--report', report,
+    ] + options
+    env = dict(os.environ, AMAZON_ACCESS_KEY='fake-access-key', AMAZON_SECRET_KEY=SECRET_KEY,
+               AMAZON_ASSOC_KEY='fake-tag', PYTHONPATH=os.path.join(BENCH_DIR, '..'))
+
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    # the resource usage of this child alone, workers included
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = status
+    if status:
+        sys.exit('{} failed:\n{}'.format(' '.join(options), stderr.decode(errors='replace')))
+
+    with open(report, encoding='utf-8') as fd:
+        summary = json.load(fd)
+
+    row = summary['stages']['row']
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    rss = usage.ru_maxrss / 1024.0 if sys.platform != 'darwin' else usage.ru_maxrss / 1024.0 ** 2
+    return {
+        'rows': row['count'],
+        'rows_per_second': row['count'] / summary['elapsed'],
+        'p50': row['p50'],
+        'p99': row['p99'],
+        'api_calls': summary['events'].get('api_requests', 0),
+        'pages': summary['events'].get('scrape_requests', 0),
+        'errors': summary['errors'],
+        'peak_rss_mb': rss,
+    }
+
+
+def server_stats(server):
+    with urllib.request.urlopen('http://{}/stats'.format(server.host)) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark amazon-book-query end to end')
+    parser.add_argument('--rows', type=int, default=500,
+                        help='rows of the source file (default: 500)')
+    parser.add_argument('--duplicates', type=float, default=0.1,
+                        help='fraction of rows repeating an earlier book (default: 0.1)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds the server takes to answer (default: 0.02)')
+    parser.add_argument('--jitter', type=float, default=0.01,
+                        help='random seconds added to the latency (default: 0.01)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--bad-gateway-rate', type=float, default=0.0)
+    parser.add_argument('--captcha-rate', type=float, default=0.0)
+    parser.add_argument('--no-match-rate', type=float, default=0.05)
+    parser.add_argument('--rate', type=float, default=10000,
+                        help='client requests per second (default: 10000)')
+    parser.add_argument('--modes', default=','.join(name for name, options in MODES),
+                        help='comma separated modes to run (default: all)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    modes = dict(MODES)
+    names = args.modes.split(',')
+    for name in names:
+        if name not in modes:
+            parser.error('unknown mode {}, choose from {}'.format(name, ', '.join(modes)))
+
+    server = FakeAmazon(
+        latency=args.latency, jitter=args.jitter, throttle_rate=args.throttle_rate,
+        bad_gateway_rate=args.bad_gateway_rate, captcha_rate=args.captcha_rate,
+        no_match_rate=args.no_match_rate).start()
+    workdir = tempfile.mkdtemp(prefix='bench_e2e_')
+    try:
+        source = os.path.join(workdir, 'bench.tsv')
+        write_source(source, args.rows, args.duplicates)
+
+        results = {}
+        print('{:>12} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+            'mode', 'rows/s', 'p50 ms', 'p99 ms', 'calls/row', 'pages/row', 'RSS MB'))
+        for name in names:
+            directory = os.path.join(workdir, name)
+            os.makedirs(directory)
+            result = run_mode(modes[name], source, directory, server.host, args)
+            results[name] = result
+            print('{:>12} {:9.1f} {:9.1f} {:9.1f} {:9.2f} {:9.2f} {:9.1f}'.format(
+                name, result['rows_per_second'], result['p50'] * 1000, result['p99'] * 1000,
+                result['api_calls'] / float(result['rows']),
+                result['pages'] / float(result['rows']), result['peak_rss_mb']))
+            if result['errors']:
+                print('{:>12} errors: {}'.format('', result['errors']))
+
+        print('server: {}'.format(server_stats(server)))
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as fd:
+                json.dump(results, fd, indent=2, sort_keys=True)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
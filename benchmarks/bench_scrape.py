@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Compares the scrape engines on the detail pages in fixtures/pages.
+
+Every engine must produce the same result as :class:`Scrapy` on every
+page, then each one is timed loading and parsing the pages, padded with
+filler to the size of a real detail page.
+
+    $ python benchmarks/bench_scrape.py [--padding KB] [--seconds N]
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from amazonbookquery.scrapy import SCRAPE_ENGINES, Scrapy  # noqa: E402
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'pages')
+
+FILLER = (
+    '<div class="a-section review aok-relative"><div class="a-row">'
+    '<a class="a-link-normal" title="4.0 out of 5 stars" href="#">'
+    '<i class="a-icon a-icon-star a-star-4">'
+    '<span class="a-icon-alt">4.0 out of 5 stars</span></i></a>'
+    '<span class="a-size-base review-text">A thoughtful read, recommended to anyone who liked '
+    'the author\'s earlier books. Shipping was quick and the copy arrived in good condition.'
+    '</span></div></div>\n'
+)
+
+
+def load_pages(padding=0):
+    pages = {}
+    for path in sorted(glob.glob(os.path.join(PAGES_DIR, '*.html'))):
+        with open(path, encoding='utf-8') as fd:
+            text = fd.read()
+        if padding:
+            filler = FILLER * (padding * 1024 // len(FILLER) + 1)
+            text = text.replace('</body>', filler + '</body>')
+        pages[os.path.basename(path)] = text
+    return pages
+
+
+def scrape_text(engine, text):
+    """
+    Runs the part of :meth:`Scrapy.scrape` that follows the download.
+    """
+    content = engine._load(text)
+    if engine._is_bad_gateway(content):
+        return 'bad gateway'
+    if engine._has_captcha(content):
+        return 'captcha'
+    return engine.parse(content)
+
+
+def check(pages):
+    reference = Scrapy()
+    for name, engine_class in sorted(SCRAPE_ENGINES.items()):
+        engine = engine_class()
+        for page, text in sorted(pages.items()):
+            expected = scrape_text(reference, text)
+            result = scrape_text(engine, text)
+            if result != expected:
+                sys.exit('{} differs on {}:\n  {}\n  {}'.format(name, page, expected, result))
+
+
+def bench(pages, seconds):
+    results = {}
+    for name, engine_class in sorted(SCRAPE_ENGINES.items()):
+        engine = engine_class()
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            for text in pages.values():
+                scrape_text(engine, text)
+            count += len(pages)
+        results[name] = count / (time.perf_counter() - start)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the scrape engines')
+    parser.add_argument('--padding', type=int, default=300,
+                        help='filler added to every page in kilobytes (default: 300)')
+    parser.add_argument('--seconds', type=float, default=5,
+                        help='time spent on every engine (default: 5)')
+    args = parser.parse_args()
+
+    check(load_pages())
+    pages = load_pages(args.padding)
+    check(pages)
+    print('all engines agree on {} pages'.format(len(pages)))
+
+    results = bench(pages, args.seconds)
+    for name, rate in sorted(results.items()):
+        print('{:>6}: {:8.1f} pages/s ({:.1f}x)'.format(name, rate, rate / results['bs4']))
+
+
+if __name__ == '__main__':
+    main()
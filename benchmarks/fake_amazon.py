@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the Product Advertising API and the detail pages,
+for benchmarks and tests that must not depend on Amazon.
+
+Signed ``/onca/xml`` ItemSearch and ItemLookup requests are checked the
+way Amazon does and answered from the XML templates in fixtures/api;
+``/dp/<ASIN>`` serves one of the recorded pages in fixtures/pages. Every
+title searched for gets an ASIN derived from it, so any source file can
+be run against the server. Latency, throttling, 502s and captchas can be
+injected at given rates.
+
+    $ python benchmarks/fake_amazon.py --port 8080 --latency 0.05 --throttle-rate 0.01
+
+Point :class:`Query` at it with ``host='127.0.0.1:8080'`` and the secret
+key of the server.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from base64 import b64encode
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from string import Template
+from urllib.parse import parse_qsl, quote
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# detail pages served for found items, picked by ASIN
+OFFER_PAGES = ('formats_and_olp.html', 'olp_only.html', 'nested_olp.html', 'no_offers.html')
+
+SECRET_KEY = 'fake-secret-key'
+
+# requests signed longer ago than that are refused, as Amazon does
+MAX_CLOCK_SKEW = 15 * 60
+
+
+def _load_templates():
+    templates = {}
+    for name in ('item', 'offers', 'item_search', 'item_lookup', 'error'):
+        with open(os.path.join(FIXTURES_DIR, 'api', name + '.xml'), encoding='utf-8') as fd:
+            templates[name] = Template(fd.read().strip())
+    return templates
+
+
+def _load_pages():
+    pages = {}
+    for name in OFFER_PAGES + ('captcha.html', 'bad_gateway.html'):
+        with open(os.path.join(FIXTURES_DIR, 'pages', name), encoding='utf-8') as fd:
+            pages[name] = fd.read().encode('utf-8')
+    return pages
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _digest(text):
+    return int(hashlib.sha1(text.encode('utf-8')).hexdigest(), 16)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeAmazon(object):
+    """
+    The server, run from a daemon thread between :meth:`start` and
+    :meth:`stop`. Rates are fractions of the requests concerned; which
+    requests fail is random but reproducible through ``seed``.
+    ``no_match_rate`` of the titles find nothing, the same ones every time.
+    """
+
+    def __init__(self, port=0, secret_key=SECRET_KEY, latency=0.0, jitter=0.0, throttle_rate=0.0,
+                 bad_gateway_rate=0.0, captcha_rate=0.0, no_match_rate=0.0, seed=0):
+        self.port = port
+        self.secret_key = secret_key
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.bad_gateway_rate = bad_gateway_rate
+        self.captcha_rate = captcha_rate
+        self.no_match_rate = no_match_rate
+
+        self.templates = _load_templates()
+        self.pages = _load_pages()
+
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        # ASIN -> (title, author) of everything found so far
+        self._catalog = {}
+        self.stats = {}
+        self._server = None
+
+    @property
+    def host(self):
+        return '127.0.0.1:%d' % self.port
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, like Amazon
+            protocol_version = 'HTTP/1.1'
+            # the headers and the body are written separately, Nagle's
+            # algorithm would hold the body back for the delayed ack
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self.port = self._server.server_address[1]
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def _roll(self, rate):
+        if not rate:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def _wait(self):
+        delay = self.latency
+        if self.jitter:
+            with self._lock:
+                delay += self._random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _handle(self, request):
+        path, _, query = request.path.partition('?')
+        self._wait()
+        if path == '/onca/xml':
+            status, body, content_type = self._api(request, query)
+        elif path.startswith('/dp/'):
+            status, body, content_type = self._page(path[len('/dp/'):])
+        elif path == '/stats':
+            with self._lock:
+                body = json.dumps(self.stats).encode('utf-8')
+            status, content_type = 200, 'application/json'
+        else:
+            status, body, content_type = 404, b'', 'text/plain'
+
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    # API
+
+    def _error(self, status, operation, code, message):
+        body = self.templates['error'].substitute(
+            operation=operation + 'ErrorResponse', code=code, message=_escape(message),
+            request_id=uuid.uuid4())
+        return status, body.encode('utf-8'), 'text/xml;charset=UTF-8'
+
+    def _verify(self, request, query):
+        """
+        Returns the query parameters when the signature and the timestamp
+        of the request are valid, ``None`` otherwise.
+        """
+        args, _, signature = query.rpartition('&Signature=')
+        msg = 'GET\n%s\n/onca/xml\n%s' % (request.headers.get('Host', ''), args)
+        digest = hmac.new(self.secret_key.encode(), msg.encode(), hashlib.sha256).digest()
+        if not hmac.compare_digest(quote(b64encode(digest)), signature):
+            return None
+
+        params = dict(parse_qsl(args))
+        try:
+            signed = time.mktime(time.strptime(params['Timestamp'], '%Y-%m-%dT%H:%M:%SZ'))
+        except (KeyError, ValueError):
+            return None
+        if abs(signed - time.mktime(time.gmtime())) > MAX_CLOCK_SKEW:
+            return None
+
+        return params
+
+    def _api(self, request, query):
+        params = self._verify(request, query)
+        if params is None:
+            self._count('signature_errors')
+            return self._error(403, 'ItemSearch', 'SignatureDoesNotMatch',
+                               'The request signature we calculated does not match the signature '
+                               'you provided.')
+
+        operation = params.get('Operation', '')
+        if self._roll(self.throttle_rate):
+            self._count('throttled')
+            return self._error(503, operation, 'RequestThrottled',
+                               'AWS Access Key ID: %s. You are submitting requests too quickly. '
+                               'Please retry your requests at a slower rate.'
+                               % params.get('AWSAccessKeyId'))
+
+        self._count(operation)
+        if operation == 'ItemSearch':
+            body = self._item_search(params)
+        elif operation == 'ItemLookup':
+            body = self._item_lookup(params)
+        else:
+            return self._error(400, operation, 'AWS.InvalidOperationParameter',
+                               'The Operation parameter is invalid.')
+        return 200, body.encode('utf-8'), 'text/xml;charset=UTF-8'
+
+    def _item(self, asin, full):
+        title, author = self._catalog[asin]
+        url = 'http://%s/dp/%s' % (self.host, asin)
+        offers = ''
+        if full:
+            n = _digest(asin)
+            offers = self.templates['offers'].substitute(
+                lowest_new=500 + n % 3000, lowest_used=100 + n % 1500,
+                total_new=n % 40, total_used=n % 25, detail_page_url=url)
+        return self.templates['item'].substitute(
+            asin=asin, detail_page_url=url, title=_escape(title), author=_escape(author),
+            offers=offers)
+
+    def _item_search(self, params):
+        title = params.get('Title', params.get('Keywords', ''))
+        author = params.get('Author', '')
+        errors = items = ''
+        total = 0
+
+        if _digest('match:' + title.lower()) % 10000 < self.no_match_rate * 10000:
+            errors = ('<Errors><Error><Code>AWS.ECommerceService.NoExactMatches</Code>'
+                      '<Message>We did not find any matches for your request.</Message>'
+                      '</Error></Errors>')
+        else:
+            asin = 'B%09X' % (_digest(title.lower()) % 0xFFFFFFFFF)
+            with self._lock:
+                self._catalog.setdefault(asin, (title, author))
+            # the groups of a lookup get the whole item, as for --single-call
+            full = 'ItemAttributes' in params.get('ResponseGroup', '')
+            items = self._item(asin, full)
+            total = 1
+
+        return self.templates['item_search'].substitute(
+            request_id=uuid.uuid4(), query_title=_escape(title), query_author=_escape(author),
+            errors=errors, total=total, items=items,
+            more_url='http://%s/search?Title=%s' % (self.host, quote(title)))
+
+    def _item_lookup(self, params):
+        item_ids = params.get('ItemId', '').split(',')
+        errors = []
+        items = []
+        for asin in item_ids:
+            if asin in self._catalog:
+                items.append(self._item(asin, True))
+            else:
+                errors.append(
+                    '<Error><Code>AWS.InvalidParameterValue</Code>'
+                    '<Message>%s is not a valid value for ItemId. '
+                    'Please change this value and retry your request.</Message></Error>'
+                    % _escape(asin))
+
+        return self.templates['item_lookup'].substitute(
+            request_id=uuid.uuid4(), item_ids=_escape(','.join(item_ids)),
+            errors='<Errors>%s</Errors>' % ''.join(errors) if errors else '',
+            items=''.join(items))
+
+    # detail pages
+
+    def _page(self, asin):
+        self._count('pages')
+        if self._roll(self.bad_gateway_rate):
+            self._count('bad_gateways')
+            return 502, self.pages['bad_gateway.html'], 'text/html'
+        if self._roll(self.captcha_rate):
+            self._count('captchas')
+            return 200, self.pages['captcha.html'], 'text/html; charset=utf-8'
+
+        page = OFFER_PAGES[_digest(asin) % len(OFFER_PAGES)]
+        return 200, self.pages[page], 'text/html; charset=utf-8'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake Amazon API and detail pages')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='0 picks a free port (default: 8080)')
+    parser.add_argument('--secret-key', default=SECRET_KEY,
+                        help='key the requests must be signed with (default: %s)' % SECRET_KEY)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every answer')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random seconds added on top')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='fraction of API calls answered with RequestThrottled')
+    parser.add_argument('--bad-gateway-rate', type=float, default=0.0,
+                        help='fraction of detail pages answered with a 502')
+    parser.add_argument('--captcha-rate', type=float, default=0.0,
+                        help='fraction of detail pages answered with a captcha')
+    parser.add_argument('--no-match-rate', type=float, default=0.0,
+                        help='fraction of titles with no search result')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeAmazon(
+        port=args.port, secret_key=args.secret_key, latency=args.latency, jitter=args.jitter,
+        throttle_rate=args.throttle_rate, bad_gateway_rate=args.bad_gateway_rate,
+        captcha_rate=args.captcha_rate, no_match_rate=args.no_match_rate, seed=args.seed)
+    server.start()
+    print('serving on http://{}/'.format(server.host), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,7 +14,8 @@ setup(
     install_requires=['requests'],
     entry_points = {
         'console_scripts': [
-            'amazon-book-query=amazonbookquery.utils:main'
+            'amazon-book-query=amazonbookquery.utils:main',
+            'amazon-book-queue=amazonbookquery.utils:queue_main'
         ]
     },
     setup_requires = ['pytest-runner'],
@@ -25,7 +26,6 @@ setup(
         'License :: OSI Approved :: BSD License',
         'Natural Language :: English',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
     ],
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+
+from amazonbookquery.ratelimit import TokenBucket
+from amazonbookquery.utils import BookQuery
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from bench_e2e import write_source  # noqa: E402
+from fake_amazon import FakeAmazon, SECRET_KEY  # noqa: E402
+
+# rows of the source file of the end to end tests
+ROWS = 40
+
+
+@pytest.fixture(scope='session')
+def server():
+    server = FakeAmazon().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def source(tmpdir):
+    path = str(tmpdir.join('source.tsv'))
+    write_source(path, ROWS, 0.2)
+    return path
+
+
+@pytest.fixture
+def book_query(server):
+    """
+    Returns a function making a :class:`BookQuery` of the fake server,
+    given the query options.
+    """
+    def make(**options):
+        options.setdefault('rate_limiter', TokenBucket(1000, capacity=100))
+        return BookQuery(host=server.host, access_key='fake-access-key', secret_key=SECRET_KEY,
+                         associate_tag='fake-tag', **options)
+    return make
+
+
+@pytest.fixture
+def reference(book_query, source, tmpdir):
+    """
+    The output of a plain run over ``source``.
+    """
+    with open(book_query().generate_output(source, str(tmpdir.mkdir('reference')))) as fd:
+        return fd.read()
@@ -0,0 +1,116 @@
+import os
+import random
+import threading
+
+from amazonbookquery.asinindex import AsinIndex, similarity
+from amazonbookquery.normalize import query_key
+
+
+def test_readers_end_with_their_threads(tmpdir):
+    index = AsinIndex(str(tmpdir.join('asins.sqlite')))
+    index.record('Dune', 'Frank Herbert', '0441013597', 0.9)
+
+    def open_files():
+        return len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else 0
+
+    def get():
+        assert index.get('Dune', 'Frank Herbert') == ('0441013597', 1.0)
+
+    before = open_files()
+    for i in range(300):
+        # as many threads as the thread pools of a long run ever had
+        thread = threading.Thread(target=get)
+        thread.start()
+        thread.join()
+    assert len(index._readers) <= 1
+    assert open_files() <= before + 2
+
+    get()
+    index.close()
+
+
+def make_index(tmpdir, **kwargs):
+    index = AsinIndex(str(tmpdir.join('asins.sqlite')), **kwargs)
+    index.record('The Hobbit', 'Tolkien, J.R.R.', '054792822X', 1.0)
+    index.record('Dune', 'Frank Herbert', '0441013597', 0.9)
+    index.record('Dune Messiah', 'Frank Herbert', '0593098234', 1.0)
+    return index
+
+
+def test_exact_hits(tmpdir):
+    index = make_index(tmpdir)
+    # the key ignores case and punctuation
+    assert index.get('the hobbit', 'Tolkien J R R') == ('054792822X', 1.0)
+    assert index.get('The Hobit', 'Tolkien, J.R.R.') is None
+
+
+def test_exact_hits_need_confidence(tmpdir):
+    index = make_index(tmpdir, min_confidence=0.95)
+    assert index.get('Dune', 'Frank Herbert') is None
+    index.record('Dune', 'Frank Herbert', '0441013597', 0.95)
+    assert index.get('Dune', 'Frank Herbert') == ('0441013597', 1.0)
+
+
+def test_fuzzy_hits(tmpdir):
+    index = make_index(tmpdir, fuzzy=0.8)
+    asin, score = index.get('The Hobit', 'Tolkien, J.R.R.')
+    assert asin == '054792822X'
+    assert score == similarity(query_key('The Hobit', 'Tolkien, J.R.R.'),
+                               query_key('The Hobbit', 'Tolkien, J.R.R.'))
+    # too far from anything recorded
+    assert index.get('Children of Dune', 'Frank Herbert') is None
+
+
+def test_fuzzy_score_counts_confidence(tmpdir):
+    index = make_index(tmpdir, fuzzy=0.8)
+    index.record('The Hobbit', 'Tolkien, J.R.R.', '054792822X', 0.85)
+    # 0.88 similar, times 0.85
+    assert index.get('The Hobit', 'Tolkien, J.R.R.') is None
+
+
+def test_fuzzy_takes_the_best_match(tmpdir):
+    index = make_index(tmpdir, fuzzy=0.5)
+    assert index.get('Dune Messia', 'Frank Herbert')[0] == '0593098234'
+    assert index.get('Dune.', 'Frank Herbert')[0] == '0441013597'
+
+
+def test_fuzzy_finds_what_comparing_every_key_finds(tmpdir):
+    rand = random.Random(0)
+    words = ['the', 'of', 'war', 'peace', 'dune', 'rings', 'lord', 'hobbit', 'night', 'day',
+             'history', 'guide', 'sea', 'old', 'man', 'woman', 'garden', 'city', 'glass']
+    books = [(' '.join(rand.sample(words, 3)), rand.choice(words)) for i in range(300)]
+    index = AsinIndex(str(tmpdir.join('asins.sqlite')), fuzzy=0.7)
+    for i, (title, author) in enumerate(books):
+        index.record(title, author, 'A%09d' % i, 1.0)
+    keys = dict((query_key(title, author), 'A%09d' % i) for i, (title, author) in enumerate(books))
+
+    for title, author in rand.sample(books, 50):
+        title = title[:-1]
+        key = query_key(title, author)
+        scores = sorted(((similarity(key, other), asin) for other, asin in keys.items()
+                         if other != key), reverse=True)
+        hit = index.get(title, author)
+        if key in keys:
+            assert hit == (keys[key], 1.0)
+        elif scores[0][0] >= 0.7:
+            assert hit is not None and hit[1] == scores[0][0]
+        else:
+            assert hit is None
+
+
+def test_discarded_asins_are_forgotten(tmpdir):
+    index = make_index(tmpdir, fuzzy=0.8)
+    index.discard('054792822X')
+    assert index.get('The Hobbit', 'Tolkien, J.R.R.') is None
+    assert index.get('The Hobit', 'Tolkien, J.R.R.') is None
+    assert len(index) == 2
+
+
+def test_trigram_counts_of_older_indexes_are_filled(tmpdir):
+    index = make_index(tmpdir)
+    with index._db:
+        index._db.execute('DELETE FROM gram_counts')
+    index.close()
+
+    index = AsinIndex(str(tmpdir.join('asins.sqlite')), fuzzy=0.8)
+    assert index.get('The Hobit', 'Tolkien, J.R.R.')[0] == '054792822X'
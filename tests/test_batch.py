@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+from amazonbookquery.batch import LookupBatcher
+from amazonbookquery.errors import InvalidParameterValue, NetworkError
+
+
+def recording(results=None):
+    """
+    Returns a lookup function answering every ASIN with its lower case,
+    or with ``results`` when given, and the list of its calls.
+    """
+    calls = []
+
+    def lookup(asins):
+        calls.append(asins)
+        if results is not None:
+            return results
+        return dict((asin, asin.lower()) for asin in asins)
+    return lookup, calls
+
+
+def test_full_batch_is_looked_up_at_once():
+    lookup, calls = recording()
+    batcher = LookupBatcher(lookup, batch_size=3, max_wait=10)
+    futures = [batcher.submit(asin) for asin in ('A', 'B', 'C')]
+    assert calls == [['A', 'B', 'C']]
+    assert [future.result(0) for future in futures] == ['a', 'b', 'c']
+
+
+def test_partial_batch_is_looked_up_after_max_wait():
+    lookup, calls = recording()
+    batcher = LookupBatcher(lookup, batch_size=10, max_wait=0.1)
+    start = time.time()
+    futures = [batcher.submit(asin) for asin in ('A', 'B')]
+    assert calls == []
+    assert [future.result(1) for future in futures] == ['a', 'b']
+    assert time.time() - start >= 0.08
+    assert calls == [['A', 'B']]
+
+
+def test_flush():
+    lookup, calls = recording()
+    batcher = LookupBatcher(lookup, batch_size=10, max_wait=10)
+    future = batcher.submit('A')
+    batcher.flush()
+    assert future.result(0) == 'a'
+    batcher.flush()
+    assert calls == [['A']]
+
+
+def test_same_asin_is_looked_up_once():
+    lookup, calls = recording()
+    batcher = LookupBatcher(lookup, batch_size=3, max_wait=10)
+    first = batcher.submit('A')
+    assert batcher.submit('A') is first
+    batcher.submit('B')
+    batcher.submit('C')
+    assert calls == [['A', 'B', 'C']]
+
+
+def test_errors_of_an_asin_stay_with_it():
+    error = InvalidParameterValue('ItemId', 'B', code='AWS.InvalidParameterValue', msg='gone')
+    lookup, calls = recording({'A': 'a', 'B': error})
+    batcher = LookupBatcher(lookup, batch_size=3, max_wait=10)
+    futures = [batcher.submit(asin) for asin in ('A', 'B', 'C')]
+
+    assert futures[0].result(0) == 'a'
+    assert futures[1].exception(0) is error
+    # missing from the answer
+    with pytest.raises(InvalidParameterValue) as info:
+        futures[2].result(0)
+    assert info.value.args == ('ItemId', 'C')
+
+
+def test_failed_lookup_fails_the_whole_batch():
+    error = NetworkError(code='NetworkError', msg='reset')
+
+    def lookup(asins):
+        raise error
+
+    batcher = LookupBatcher(lookup, batch_size=2, max_wait=10)
+    futures = [batcher.submit(asin) for asin in ('A', 'B')]
+    assert [future.exception(0) for future in futures] == [error, error]
+
+
+def test_batch_size_is_capped():
+    assert LookupBatcher(None, batch_size=50).batch_size == LookupBatcher.MAX_BATCH_SIZE
+
+
+def test_batched_run_matches_a_run(server, book_query, source, tmpdir):
+    before = server.stats.get('ItemLookup', 0)
+    query = book_query(offers_source='api', lookup_batch_size=5)
+    output = query.generate_output(source, str(tmpdir.mkdir('batched')), concurrency=10)
+    batched = server.stats.get('ItemLookup', 0) - before
+
+    before = server.stats.get('ItemLookup', 0)
+    expected = book_query(offers_source='api').generate_output(
+        source, str(tmpdir.mkdir('single')), concurrency=10)
+    single = server.stats.get('ItemLookup', 0) - before
+
+    with open(output) as fd, open(expected) as expected_fd:
+        assert fd.read() == expected_fd.read()
+    assert batched < single
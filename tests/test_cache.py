@@ -0,0 +1,110 @@
+import os
+import sqlite3
+import time
+
+from amazonbookquery.cache import ResponseCache
+
+
+def make_cache(tmpdir, **options):
+    return ResponseCache(str(tmpdir.join('cache.sqlite')), **options)
+
+
+def accessed(cache, key):
+    with sqlite3.connect(cache.path) as db:
+        return db.execute('SELECT accessed FROM responses WHERE key = ?', (key,)).fetchone()[0]
+
+
+def test_bodies_are_stored(tmpdir):
+    cache = make_cache(tmpdir)
+    cache.set('ItemLookup', 'key', b'<body/>')
+    assert cache.get('ItemLookup', 'key') == b'<body/>'
+    assert cache.get('ItemLookup', 'other') is None
+    cache.close()
+
+    cache = make_cache(tmpdir)
+    assert cache.get('ItemLookup', 'key') == b'<body/>'
+
+
+def test_entries_expire_after_the_ttl_of_their_operation(tmpdir):
+    cache = make_cache(tmpdir, ttls={'ItemLookup': 0.1})
+    cache.set('ItemLookup', 'lookup', b'lookup')
+    cache.set('ItemSearch', 'search', b'search')
+    time.sleep(0.15)
+    assert cache.get('ItemLookup', 'lookup') is None
+    assert cache.get('ItemSearch', 'search') == b'search'
+
+    assert cache.prune() == 1
+    assert cache.get('ItemSearch', 'search') == b'search'
+
+
+def test_no_match_keeps_its_own_ttl(tmpdir):
+    cache = make_cache(tmpdir, ttls={'NoMatch': 0.1})
+    # stored in place of the search that found nothing
+    cache.set('NoMatch', 'search', b'no match')
+    assert cache.get('ItemSearch', 'search') == b'no match'
+    time.sleep(0.15)
+    assert cache.get('ItemSearch', 'search') is None
+
+
+def test_refresh_replaces_entries(tmpdir):
+    make_cache(tmpdir).set('ItemLookup', 'key', b'old')
+    cache = make_cache(tmpdir, refresh=True)
+    assert cache.get('ItemLookup', 'key') is None
+    cache.set('ItemLookup', 'key', b'new')
+    cache.close()
+    assert make_cache(tmpdir).get('ItemLookup', 'key') == b'new'
+
+
+def test_replaced_entries_are_counted_once(tmpdir):
+    cache = make_cache(tmpdir)
+    for _ in range(5):
+        cache.set('ItemLookup', 'key', os.urandom(1000))
+    assert cache._size == cache._total_size()
+
+
+def test_least_recently_used_entries_are_evicted(tmpdir):
+    cache = make_cache(tmpdir, max_size=3500)
+    for key in 'abc':
+        cache.set('ItemLookup', key, os.urandom(1000))
+    assert cache.get('ItemLookup', 'a') is not None
+    cache.set('ItemLookup', 'd', os.urandom(1000))
+
+    assert cache.get('ItemLookup', 'b') is None
+    for key in 'acd':
+        assert cache.get('ItemLookup', key) is not None
+    assert cache._size <= 3500
+
+
+def test_access_times_are_written_in_batches(tmpdir):
+    cache = make_cache(tmpdir)
+    cache.ACCESS_BATCH = 3
+    for key in 'abc':
+        cache.set('ItemLookup', key, b'body')
+    stored = accessed(cache, 'a')
+
+    cache.get('ItemLookup', 'a')
+    cache.get('ItemLookup', 'b')
+    assert accessed(cache, 'a') == stored
+    cache.get('ItemLookup', 'c')
+    assert accessed(cache, 'a') > stored
+
+    cache.get('ItemLookup', 'a')
+    stored = accessed(cache, 'a')
+    cache.close()
+    assert accessed(cache, 'a') > stored
+
+
+def test_readers_do_not_wait_for_writers(tmpdir):
+    cache = make_cache(tmpdir)
+    with sqlite3.connect(cache.path) as db:
+        assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_key_leaves_credentials_out(tmpdir):
+    cache = make_cache(tmpdir)
+    params = {'Operation': 'ItemLookup', 'ItemId': '0441013597'}
+    key = cache.key('ItemLookup', params)
+    assert cache.key('ItemLookup', dict(params, AWSAccessKeyId='one', AssociateTag='tag')) == key
+    assert cache.key('ItemLookup', dict(params, AWSAccessKeyId='two', Signature='x')) == key
+    assert cache.key('ItemLookup', dict(params, ItemId='0593098234')) != key
+    assert cache.key('ItemSearch', params) != key
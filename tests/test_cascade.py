@@ -0,0 +1,83 @@
+import csv
+
+import pytest
+
+from amazonbookquery.cache import ResponseCache
+from amazonbookquery.query import Query
+from amazonbookquery.ratelimit import TokenBucket
+from amazonbookquery.utils import BookQuery
+
+from fake_amazon import FakeAmazon, SECRET_KEY
+
+
+@pytest.fixture(scope='module')
+def picky_server():
+    """
+    A fake server finding the books of about half of the titles.
+    """
+    server = FakeAmazon(no_match_rate=0.5).start()
+    yield server
+    server.stop()
+
+
+def run(server, source, directory, **options):
+    """
+    Runs a query of ``source`` against ``server`` and returns its metrics,
+    the ItemSearch requests it made and the rows that found no book.
+    """
+    searches = server.stats.get('ItemSearch', 0)
+    query = BookQuery(host=server.host, access_key='fake-access-key', secret_key=SECRET_KEY,
+                      associate_tag='fake-tag', rate_limiter=TokenBucket(1000, capacity=100),
+                      **options)
+    output = query.generate_output(source, str(directory))
+    with open(output, encoding='utf-8', newline='') as fd:
+        rows = list(csv.reader(fd, delimiter='\t'))[1:]
+    missed = [row for row in rows if row[-1].startswith('AWS.ECommerceService.NoExactMatches')]
+    return query.metrics.summary()['events'], server.stats.get('ItemSearch', 0) - searches, missed
+
+
+def test_searches_that_found_nothing_are_cached(picky_server, source, tmpdir):
+    cache_path = str(tmpdir.join('cache.sqlite'))
+    events, searches, missed = run(picky_server, source, tmpdir.mkdir('first'),
+                                   cache=ResponseCache(cache_path))
+    assert missed and searches > 0
+
+    events, searches, missed_again = run(picky_server, source, tmpdir.mkdir('second'),
+                                         cache=ResponseCache(cache_path))
+    assert searches == 0
+    assert missed_again == missed
+
+
+def test_no_match_ttl(picky_server, source, tmpdir):
+    cache_path = str(tmpdir.join('cache.sqlite'))
+    events, searches, missed = run(picky_server, source, tmpdir.mkdir('first'),
+                                   cache=ResponseCache(cache_path))
+
+    events, searches, missed_again = run(
+        picky_server, source, tmpdir.mkdir('second'),
+        cache=ResponseCache(cache_path, ttls={Query.NO_MATCH: 0}))
+    # only the searches that found nothing are made again
+    assert searches == len(set((row[1], row[3]) for row in missed))
+    assert missed_again == missed
+
+
+def test_cascade_relaxes_the_search(picky_server, source, tmpdir):
+    events, searches, strict = run(picky_server, source, tmpdir.mkdir('strict'))
+    events, cascade_searches, relaxed = run(picky_server, source, tmpdir.mkdir('relaxed'),
+                                            search_cascade=Query.SEARCH_STEPS)
+
+    assert set(row[0] for row in relaxed) < set(row[0] for row in strict)
+    # counted once per distinct query
+    assert events['relaxed_matches'] == (len(set((row[1], row[3]) for row in strict))
+                                         - len(set((row[1], row[3]) for row in relaxed)))
+
+
+def test_each_step_searches_what_the_previous_missed(picky_server, source, tmpdir):
+    events, searches, strict = run(picky_server, source, tmpdir.mkdir('strict'))
+    events, cascade_searches, missed = run(picky_server, source, tmpdir.mkdir('cascade'),
+                                           search_cascade=('title-author', 'title'))
+
+    # the server only looks at titles, the title search finds nothing more
+    assert missed == strict
+    assert 'relaxed_matches' not in events
+    assert cascade_searches == searches + len(set((row[1], row[3]) for row in missed))
@@ -0,0 +1,114 @@
+import pytest
+
+from amazonbookquery.journal import Journal
+from amazonbookquery.rowstore import RowStore
+from amazonbookquery.utils import BookQuery
+
+from conftest import ROWS
+
+RECORDS = [['id%d' % i, 'Title %d' % i, 'a\ttab', '\u00e9t\u00e9'] for i in range(3)]
+
+
+def write(path, rows):
+    journal = Journal(path)
+    journal.open()
+    for row in rows:
+        journal.record(row[0], row)
+    journal.close()
+
+
+def test_records_are_loaded(tmpdir):
+    path = str(tmpdir.join('output.tsv.journal'))
+    write(path, RECORDS)
+    records = Journal(path).load()
+    assert [records[row[0]][1] for row in RECORDS] == RECORDS
+
+
+def test_record_cut_short_is_ignored(tmpdir):
+    path = str(tmpdir.join('output.tsv.journal'))
+    write(path, RECORDS)
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    with open(path, 'wb') as fd:
+        # a crash in the middle of the last record
+        fd.write(data[:-8])
+
+    assert sorted(Journal(path).load()) == ['id0', 'id1']
+
+
+def test_resume_appends_after_a_cut_record(tmpdir):
+    path = str(tmpdir.join('output.tsv.journal'))
+    write(path, RECORDS)
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    with open(path, 'wb') as fd:
+        fd.write(data[:-8])
+
+    journal = Journal(path)
+    journal.open(resume=True)
+    journal.record(RECORDS[2][0], RECORDS[2], completed=12.5)
+    journal.close()
+
+    records = Journal(path).load()
+    assert [records[row[0]][1] for row in RECORDS] == RECORDS
+    assert records['id2'][0] == 12.5
+
+
+def test_records_of_a_resumed_run(tmpdir):
+    path = str(tmpdir.join('output.tsv.journal'))
+    write(path, RECORDS[:2])
+
+    journal = Journal(path)
+    journal.open(resume=True)
+    journal.record(RECORDS[2][0], RECORDS[2])
+    journal.record(RECORDS[0][0], RECORDS[0][:2])
+    journal.close()
+
+    records = list(journal.records(journal.resumed_at))
+    assert [(identifier, row) for identifier, completed, row in records] == [
+        ('id2', RECORDS[2]), ('id0', RECORDS[0][:2])]
+
+
+def test_row_store_keeps_the_last_row(tmpdir):
+    path = str(tmpdir.join('output.tsv.journal'))
+    write(path, RECORDS)
+    write_again = Journal(path)
+    write_again.open(resume=True)
+    write_again.record('id1', ['id1', 'changed'], completed=12.5)
+    write_again.close()
+
+    with RowStore(Journal(path).records()) as done:
+        assert len(done) == 3
+        assert 'id1' in done and 'id3' not in done
+        assert done.get('id0')[1] == RECORDS[0]
+        assert done.get('id1') == (12.5, ['id1', 'changed'])
+        assert done.get('id3', 'missing') == 'missing'
+
+
+def test_open_without_resume_starts_over(tmpdir):
+    path = str(tmpdir.join('output.tsv.journal'))
+    write(path, RECORDS)
+    write(path, RECORDS[:1])
+    assert list(Journal(path).load()) == ['id0']
+
+
+def test_resume_after_a_crash(book_query, source, reference, tmpdir, monkeypatch):
+    directory = str(tmpdir.mkdir('output'))
+
+    process_row = BookQuery._process_row
+    calls = []
+
+    def crashing(self, query, data):
+        calls.append(data[0])
+        if len(calls) == ROWS // 2:
+            raise KeyboardInterrupt
+        return process_row(self, query, data)
+
+    monkeypatch.setattr(BookQuery, '_process_row', crashing)
+    with pytest.raises(KeyboardInterrupt):
+        book_query().generate_output(source, directory, concurrency=4)
+    monkeypatch.setattr(BookQuery, '_process_row', process_row)
+
+    output_path = book_query().generate_output(source, directory, resume=True)
+    with open(output_path) as fd:
+        assert fd.read() == reference
@@ -0,0 +1,97 @@
+import glob
+import os
+from io import BytesIO
+
+import pytest
+
+from amazonbookquery.errors import AWSError
+from amazonbookquery.parser import PARSE_ENGINES, EtreeParser, Parser, split_item_lookups
+from amazonbookquery.result import BookResult
+
+RESPONSES_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks', 'fixtures', 'responses')
+
+RESPONSES = sorted(os.path.basename(path)
+                   for path in glob.glob(os.path.join(RESPONSES_DIR, '*.xml')))
+
+METHODS = ('parse_item_search', 'parse_item_search_item', 'parse_item_lookup',
+           'parse_item_lookups')
+
+
+def read(name):
+    with open(os.path.join(RESPONSES_DIR, name), 'rb') as fd:
+        return fd.read()
+
+
+def outcome(parse, data):
+    """
+    Returns what ``parse`` returns for ``data``, or describes the error it
+    raises.
+    """
+    def describe(error):
+        return type(error), error.code, error.msg, error.snippet
+
+    try:
+        result = parse(BytesIO(data))
+    except AWSError as e:
+        return describe(e)
+    except AttributeError:
+        # an item without a field objectify looks up
+        return AttributeError
+    if isinstance(result, dict):
+        return dict((key, describe(value) if isinstance(value, AWSError) else value)
+                    for key, value in result.items())
+    return result
+
+
+@pytest.mark.parametrize('method', METHODS)
+@pytest.mark.parametrize('response', RESPONSES)
+def test_etree_parser_matches_objectify(response, method):
+    data = read(response)
+    assert outcome(getattr(EtreeParser(), method), data) == \
+        outcome(getattr(Parser(), method), data)
+
+
+@pytest.mark.parametrize('engine', sorted(PARSE_ENGINES))
+def test_item_lookup(engine):
+    result = PARSE_ENGINES[engine]().parse_item_lookup(BytesIO(read('item_lookup.xml')))
+    assert result == BookResult(
+        detail_page_url='https://www.amazon.com/dp/1163201189',
+        author='Frederick Eikerenkoetter', title='Your Mind Can Heal You',
+        sold_by_amazon=True, sold_by_amazon_as_new=True,
+        total_new=1, total_used=7, total_collectible=0,
+        lowest_new_price=12.99, lowest_used_price=4.5, lowest_collectible_price='')
+
+
+@pytest.mark.parametrize('engine', sorted(PARSE_ENGINES))
+def test_errors(engine):
+    parser = PARSE_ENGINES[engine]()
+    with pytest.raises(AWSError) as info:
+        parser.parse_item_search(BytesIO(read('no_match.xml')))
+    assert info.value.code == 'AWS.ECommerceService.NoExactMatches'
+
+    with pytest.raises(AWSError) as info:
+        parser.parse_item_lookup(BytesIO(read('error_throttled.xml')))
+    assert info.value.code == 'RequestThrottled'
+
+
+@pytest.mark.parametrize('engine', sorted(PARSE_ENGINES))
+def test_rejected_item_ids_keep_their_error(engine):
+    results = PARSE_ENGINES[engine]().parse_item_lookups(
+        BytesIO(read('item_lookup_partial_errors.xml')))
+    assert len(results) == 12
+    assert isinstance(results['B000BOGUS1'], AWSError)
+    assert isinstance(results['B000BOGUS2'], AWSError)
+    assert isinstance(results['0307387800'], BookResult)
+
+
+def test_split_lookups_parse_as_the_batch():
+    parser = EtreeParser()
+    data = read('item_lookup_partial_errors.xml')
+    results = parser.parse_item_lookups(BytesIO(data))
+
+    bodies = split_item_lookups(BytesIO(data))
+    assert sorted(bodies) == sorted(asin for asin, result in results.items()
+                                    if isinstance(result, BookResult))
+    for asin, body in bodies.items():
+        assert Parser().parse_item_lookup(BytesIO(body)) == results[asin]
@@ -0,0 +1,71 @@
+import random
+import threading
+import time
+
+from amazonbookquery.pipeline import AsyncPipeline
+
+
+def test_results_are_emitted_in_input_order():
+    rand = random.Random(0)
+    delays = [rand.random() / 100 for _ in range(100)]
+
+    def process(index):
+        time.sleep(delays[index])
+        return index
+
+    emitted = []
+    AsyncPipeline(process, 8).run(range(100), emitted.append)
+    assert emitted == list(range(100))
+
+
+def test_window_bounds_rows_in_flight():
+    lock = threading.Lock()
+    started = []
+    emitted = []
+
+    def process(index):
+        with lock:
+            started.append(index)
+        # the first row is the slowest, the others wait in the buffer
+        time.sleep(0.2 if index == 0 else 0.001)
+        return index
+
+    def emit(index):
+        emitted.append((index, len(started)))
+
+    AsyncPipeline(process, 4, window=6).run(range(20), emit)
+    assert [index for index, count in emitted] == list(range(20))
+    # no more than the window had started when the first row came out
+    assert emitted[0][1] <= 6
+
+
+def test_errors_are_raised():
+    def process(index):
+        if index == 3:
+            raise ValueError(index)
+        return index
+
+    emitted = []
+    try:
+        AsyncPipeline(process, 2).run(range(10), emitted.append)
+    except ValueError as e:
+        assert e.args == (3,)
+    else:
+        assert False, 'ValueError not raised'
+    assert emitted[:3] == [0, 1, 2]
+
+
+def test_open_pipeline_keeps_its_threads():
+    threads = set()
+
+    def process(index):
+        threads.add(threading.get_ident())
+        time.sleep(0.001)
+        return index
+
+    emitted = []
+    with AsyncPipeline(process, 4) as pipeline:
+        for start in range(0, 100, 5):
+            pipeline.run(range(start, start + 5), emitted.append)
+    assert emitted == list(range(100))
+    assert len(threads) <= 4
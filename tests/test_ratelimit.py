@@ -0,0 +1,109 @@
+import threading
+import time
+
+from amazonbookquery.ratelimit import FileTokenBucket, TokenBucket
+
+
+def test_bucket_lets_a_burst_through():
+    bucket = TokenBucket(100, capacity=5)
+    assert [bucket.acquire() for _ in range(5)] == [0] * 5
+
+    start = time.time()
+    waited = sum(bucket.acquire() for _ in range(10))
+    assert 0.08 <= time.time() - start < 0.3
+    assert waited > 0
+
+
+def test_bucket_is_shared_by_threads():
+    bucket = TokenBucket(200, capacity=1)
+    start = time.time()
+    threads = [threading.Thread(target=lambda: [bucket.acquire() for _ in range(10)])
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.time() - start >= 39 / 200.0
+
+
+def test_throttle_decreases_the_rate_once_per_interval():
+    bucket = TokenBucket(100, capacity=10)
+    bucket.throttled()
+    assert bucket.rate == 50
+    # answers to requests sent before the decrease
+    bucket.throttled()
+    assert bucket.rate == 50
+
+    # the bucket fills up in 10 / 50 seconds at the decreased rate
+    time.sleep(0.25)
+    bucket.throttled()
+    assert bucket.rate == 25
+
+
+def test_throttle_empties_the_bucket():
+    bucket = TokenBucket(20, capacity=5)
+    bucket.throttled()
+    start = time.time()
+    bucket.acquire()
+    assert time.time() - start >= 0.08
+
+
+def test_rate_stays_above_min_rate():
+    bucket = TokenBucket(100, capacity=1, min_rate=30)
+    for _ in range(3):
+        bucket.throttled()
+        time.sleep(1 / 30.0)
+    assert bucket.rate == 30
+
+
+def test_successes_increase_the_rate_up_to_max_rate():
+    bucket = TokenBucket(100, capacity=1, success_threshold=3)
+    bucket.throttled()
+    assert bucket.rate == 50
+
+    for _ in range(2):
+        bucket.succeeded()
+    # a throttle starts the count over
+    time.sleep(1 / 50.0)
+    bucket.throttled()
+    for _ in range(2):
+        bucket.succeeded()
+    assert bucket.rate == 25
+
+    bucket.succeeded()
+    assert bucket.rate == 35
+    for _ in range(30):
+        bucket.succeeded()
+    assert bucket.rate == 100
+
+
+def test_file_bucket_is_shared(tmpdir):
+    path = str(tmpdir.join('rate.json'))
+    first = FileTokenBucket(path, 10, capacity=2)
+    second = FileTokenBucket(path, 10, capacity=2)
+
+    assert first.acquire() == 0
+    assert second.acquire() == 0
+    start = time.time()
+    first.acquire()
+    assert time.time() - start >= 0.05
+
+    second.throttled()
+    assert first.rate == 5
+    # a late starter keeps the shared rate
+    assert FileTokenBucket(path, 10, capacity=2).rate == 5
+
+
+def test_file_bucket_applies_its_own_limits(tmpdir):
+    path = str(tmpdir.join('rate.json'))
+    FileTokenBucket(path, 10)
+    assert FileTokenBucket(path, 2).rate == 2
+    assert FileTokenBucket(path, 100, min_rate=50).rate == 50
+
+
+def test_unreadable_file_starts_a_new_bucket(tmpdir):
+    path = tmpdir.join('rate.json')
+    path.write('{"rate"')
+    bucket = FileTokenBucket(str(path), 10)
+    assert bucket.rate == 10
+    assert bucket.acquire() == 0
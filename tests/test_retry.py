@@ -0,0 +1,151 @@
+import csv
+import threading
+import time
+
+import pytest
+
+from amazonbookquery.errors import (
+    CircuitOpen, HTTPStatusError, InternalError, NetworkError, NoExactMatchesFound,
+    RetriesExhausted, TooManyRequests)
+from amazonbookquery.ratelimit import TokenBucket
+from amazonbookquery.retry import COOL_DOWN, FAIL, RETRY, CircuitBreaker, RetryPolicy
+from amazonbookquery.utils import BookQuery
+
+from fake_amazon import FakeAmazon, SECRET_KEY
+
+
+def failing(*errors):
+    """
+    Returns a function raising ``errors`` in turn, then returning 'result',
+    and the list of its calls.
+    """
+    calls = []
+
+    def function():
+        calls.append(None)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return 'result'
+    return function, calls
+
+
+def test_errors_are_retried():
+    policy = RetryPolicy(base_delay=0.001, cool_down=0)
+    function, calls = failing(InternalError(code='InternalError', msg='try again'),
+                              TooManyRequests(code='RequestThrottled', msg='slower'))
+    assert policy.call('host', function) == 'result'
+    assert len(calls) == 3
+
+
+def test_retries_are_bounded():
+    policy = RetryPolicy(max_attempts=3, base_delay=0.001)
+    error = NetworkError(code='NetworkError', msg='reset')
+    function, calls = failing(*[error] * 5)
+    with pytest.raises(RetriesExhausted) as info:
+        policy.call('host', function)
+    assert len(calls) == 3
+    assert info.value.error is error
+    assert str(info.value) == 'RetriesExhausted: NetworkError: reset after 3 attempts'
+
+
+def test_answers_are_not_retried():
+    policy = RetryPolicy(breaker=CircuitBreaker(threshold=1, max_wait=0))
+    function, calls = failing(*[NoExactMatchesFound(code='NoExactMatches', msg='none')] * 2)
+    for _ in range(2):
+        with pytest.raises(NoExactMatchesFound):
+            policy.call('host', function)
+    # the host answered, its circuit stays closed
+    assert policy.call('host', function) == 'result'
+
+
+def test_classify():
+    policy = RetryPolicy()
+    assert policy.classify(HTTPStatusError(status=503)) == COOL_DOWN
+    assert policy.classify(HTTPStatusError(status=502)) == RETRY
+    assert policy.classify(HTTPStatusError(status=404)) == FAIL
+    assert policy.classify(TooManyRequests()) == COOL_DOWN
+    assert policy.classify(NoExactMatchesFound()) == FAIL
+
+
+def test_delay():
+    policy = RetryPolicy(base_delay=1, max_delay=8, cool_down=30)
+    for attempt, delay in ((1, 1), (3, 4), (10, 8)):
+        assert delay / 2.0 <= policy.delay(attempt, RETRY) <= delay
+    assert 15 <= policy.delay(1, COOL_DOWN) <= 30
+
+
+def test_open_circuit_waits_for_a_trial():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=0.2)
+    breaker.failure('host')
+    breaker.before('host')
+    breaker.failure('host')
+
+    start = time.time()
+    breaker.before('host')
+    assert time.time() - start >= 0.15
+
+    # the others wait for the outcome of the trial
+    waited = []
+    thread = threading.Thread(target=lambda: waited.append(breaker.before('host')))
+    thread.start()
+    thread.join(0.1)
+    assert thread.is_alive()
+    breaker.success('host')
+    thread.join(1)
+    assert waited == [None]
+    # other hosts are not concerned
+    breaker.before('other')
+
+
+def test_failed_trial_opens_the_circuit_again():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.2)
+    breaker.failure('host')
+    time.sleep(0.2)
+    breaker.before('host')
+    breaker.failure('host')
+
+    start = time.time()
+    breaker.before('host')
+    assert time.time() - start >= 0.15
+
+
+def test_host_down_for_long_fails_fast():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.3, max_wait=0.1)
+    breaker.failure('host')
+
+    start = time.time()
+    with pytest.raises(CircuitOpen) as info:
+        breaker.before('host')
+    assert 0.05 <= time.time() - start < 0.3
+    assert str(info.value) == (
+        'CircuitOpen: requests to host are suspended after 1 consecutive failures')
+
+    # trials still tell when the host is back
+    time.sleep(0.3)
+    breaker.before('host')
+    with pytest.raises(CircuitOpen):
+        breaker.before('host')
+    breaker.success('host')
+    breaker.before('host')
+
+
+def test_throttled_rows_are_recorded_without_the_access_key(source, tmpdir):
+    server = FakeAmazon(throttle_rate=1.0).start()
+    try:
+        query = BookQuery(
+            host=server.host, access_key='fake-access-key', secret_key=SECRET_KEY,
+            associate_tag='fake-tag', rate_limiter=TokenBucket(1000, capacity=100),
+            retry_policy=RetryPolicy(max_attempts=2, base_delay=0.001, cool_down=0,
+                                     breaker=CircuitBreaker(threshold=4, max_wait=0)))
+        output = query.generate_output(source, str(tmpdir))
+    finally:
+        server.stop()
+
+    with open(output, encoding='utf-8', newline='') as fd:
+        rows = list(csv.reader(fd, delimiter='\t'))[1:]
+    errors = [row[-1] for row in rows]
+    assert errors[0] == (
+        'RetriesExhausted: RequestThrottled: You are submitting requests too quickly. '
+        'Please retry your requests at a slower rate. after 2 attempts')
+    assert errors[-1].startswith('CircuitOpen: ')
+    assert not any('fake-access-key' in error for error in errors)
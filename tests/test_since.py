@@ -0,0 +1,104 @@
+import csv
+
+from amazonbookquery.journal import Journal
+from amazonbookquery.utils import BookQuery
+
+from conftest import ROWS
+
+
+def read(path):
+    with open(path, encoding='utf-8', newline='') as fd:
+        return list(csv.reader(fd, delimiter='\t'))
+
+
+def write(path, rows):
+    with open(path, 'w', encoding='utf-8', newline='') as fd:
+        csv.writer(fd, delimiter='\t').writerows(rows)
+
+
+def edit(path, identifier, **columns):
+    """
+    Sets ``columns`` of the row of ``identifier`` in the output at ``path``
+    and returns that row as it was.
+    """
+    rows = read(path)
+    for row in rows:
+        if row[0] == identifier:
+            before = list(row)
+            for column, value in columns.items():
+                row[BookQuery.HEADER.index(column)] = value
+    write(path, rows)
+    return before
+
+
+def requests(server, before):
+    return dict((name, n - before.get(name, 0)) for name, n in server.stats.items()
+                if n != before.get(name, 0))
+
+
+def test_refresh_does_not_search(server, book_query, source, reference, tmpdir):
+    previous = book_query().generate_output(source, str(tmpdir.mkdir('previous')))
+
+    before = dict(server.stats)
+    query = book_query()
+    output = query.generate_output(source, str(tmpdir.mkdir('output')), since=previous)
+
+    # one detail page per book, and nothing else
+    assert list(requests(server, before)) == ['pages']
+    assert query.metrics.summary()['events']['rows_refreshed'] == ROWS
+    with open(output) as fd:
+        assert fd.read() == reference
+    assert read(output[:-4] + '_changes.tsv') == [BookQuery.CHANGES_HEADER]
+
+
+def test_recent_rows_are_kept(server, book_query, source, reference, tmpdir):
+    previous = book_query().generate_output(source, str(tmpdir.mkdir('previous')))
+
+    before = dict(server.stats)
+    query = book_query()
+    output = query.generate_output(source, str(tmpdir.mkdir('output')), since=previous,
+                                   since_days=1)
+
+    assert requests(server, before) == {}
+    assert query.metrics.summary()['events']['rows_kept'] == ROWS
+    with open(output) as fd:
+        assert fd.read() == reference
+    # they keep the time they completed
+    assert Journal(output + '.journal').load() == Journal(previous + '.journal').load()
+
+
+def test_scraped_offers_changes(book_query, source, tmpdir):
+    previous = book_query().generate_output(source, str(tmpdir.mkdir('previous')))
+    row = edit(previous, 'bench1', TotalNew='999', SoldByAmzn='changed')
+
+    output = book_query().generate_output(source, str(tmpdir.mkdir('output')), since=previous)
+
+    # a refresh from the detail page alone leaves who sells the book as it was
+    assert read(output[:-4] + '_changes.tsv')[1:] == [
+        ['bench1', row[1], 'TotalNew', '999', row[BookQuery.HEADER.index('TotalNew')]]]
+
+
+def test_looked_up_offers_changes(book_query, source, tmpdir):
+    previous = book_query(offers_source='api').generate_output(
+        source, str(tmpdir.mkdir('previous')))
+    row = edit(previous, 'bench1', TotalNew='999', SoldByAmzn='changed')
+
+    output = book_query(offers_source='api').generate_output(
+        source, str(tmpdir.mkdir('output')), since=previous)
+
+    assert read(output[:-4] + '_changes.tsv')[1:] == [
+        ['bench1', row[1], 'TotalNew', '999', row[BookQuery.HEADER.index('TotalNew')]],
+        ['bench1', row[1], 'SoldByAmzn', 'changed', row[BookQuery.HEADER.index('SoldByAmzn')]]]
+
+
+def test_rows_of_another_book_are_queried(server, book_query, source, reference, tmpdir):
+    previous = book_query().generate_output(source, str(tmpdir.mkdir('previous')))
+    edit(previous, 'bench3', title='Another Book')
+
+    before = dict(server.stats)
+    output = book_query().generate_output(source, str(tmpdir.mkdir('output')), since=previous)
+
+    assert requests(server, before)['ItemSearch'] == 1
+    with open(output) as fd:
+        assert fd.read() == reference
+    assert read(output[:-4] + '_changes.tsv') == [BookQuery.CHANGES_HEADER]
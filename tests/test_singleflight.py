@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+from amazonbookquery.dedupe import QueryDeduplicator
+from amazonbookquery.singleflight import SingleFlight
+
+
+def test_callers_share_a_flight():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def function():
+        calls.append(None)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do('key', function)))
+               for _ in range(8)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == ['result'] * 8
+    assert flights.do('key', lambda: 'other') == 'result'
+
+
+def test_errors_are_shared_until_forgotten():
+    flights = SingleFlight()
+
+    def fail():
+        raise ValueError('boom')
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            flights.do('key', fail)
+    with pytest.raises(ValueError):
+        flights.do('key', lambda: 'result')
+
+    flights.forget('key')
+    assert flights.do('key', lambda: 'result') == 'result'
+
+
+def test_interrupts_are_not_kept():
+    flights = SingleFlight()
+
+    def interrupt():
+        raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        flights.do('key', interrupt)
+    assert 'key' not in flights
+
+
+def test_window_keeps_the_keys_asked_for_last():
+    flights = SingleFlight(window=3)
+    for key in range(3):
+        flights.do(key, lambda: key)
+    # asking for a key again keeps it
+    flights.do(0, lambda: None)
+    flights.do(3, lambda: 3)
+
+    assert len(flights) == 3
+    assert 1 not in flights
+    assert flights.do(0, lambda: None) == 0
+    assert flights.do(1, lambda: 'again') == 'again'
+
+
+def test_memory_is_bounded_by_the_window():
+    flights = SingleFlight(window=100)
+    for key in range(10000):
+        flights.do(key, lambda: {'ASIN': key})
+    assert len(flights) == 100
+
+
+def test_deduplicator_counts_saved_queries():
+    dedupe = QueryDeduplicator(window=2)
+    for key in ['a', 'b', 'a', 'c', 'a', 'b']:
+        assert dedupe.execute(key, lambda: {'key': key}) == {'key': key}
+    # 'b' was dropped once 'c' was asked for after 'a'
+    assert dedupe.unique == 4
+    assert dedupe.saved == 2
@@ -0,0 +1,124 @@
+import os
+import threading
+import time
+
+from amazonbookquery.utils import BookQuery
+from amazonbookquery.workqueue import WorkQueue
+
+from conftest import ROWS
+
+DATAS = [['id%d' % i, 'Title %d' % i, 'Doe, John', '', ''] for i in range(5)]
+
+
+def make_queue(tmpdir, **kwargs):
+    queue = WorkQueue(str(tmpdir.join('queue.sqlite')), **kwargs)
+    queue.enqueue('source.tsv', DATAS)
+    return queue
+
+
+def test_enqueue_skips_queued_identifiers(tmpdir):
+    queue = make_queue(tmpdir)
+    assert queue.enqueue('source.tsv', DATAS[3:] + [['id5', 'Title 5', '', '', '']]) == 1
+    assert queue.status()['pending'] == 6
+
+
+def test_claims_do_not_overlap(tmpdir):
+    queue = make_queue(tmpdir)
+    first = queue.claim('a', 3)
+    second = queue.claim('b', 3)
+    assert [data for position, data in first + second] == DATAS
+
+
+def test_expired_lease_is_claimed_again(tmpdir):
+    queue = make_queue(tmpdir, lease=0.2)
+    claimed = queue.claim('dead', 2)
+    assert queue.status()['leased'] == 2
+
+    time.sleep(0.3)
+    assert queue.status()['expired'] == 2
+    # the rows of the dead worker come first, in source order
+    assert queue.claim('alive', 10)[:2] == claimed
+    assert queue.status()['leased'] == 5
+
+
+def test_first_result_stored_wins(tmpdir):
+    queue = make_queue(tmpdir, lease=0.1)
+    (position, data), = queue.claim('slow', 1)
+    time.sleep(0.2)
+    assert queue.claim('fast', 1) == [(position, data)]
+
+    assert queue.complete('fast', position, data + ['fast'])
+    assert not queue.complete('slow', position, data + ['slow'])
+    assert next(queue.results()) == data + ['fast']
+
+
+def test_completing_renews_the_other_leases(tmpdir):
+    queue = make_queue(tmpdir, lease=0.3)
+    claimed = queue.claim('worker', 2)
+    time.sleep(0.2)
+    queue.complete('worker', claimed[0][0], claimed[0][1])
+    time.sleep(0.2)
+    assert queue.status() == {'pending': 3, 'leased': 1, 'expired': 0, 'done': 1}
+
+
+def test_retried_row_waits_before_it_is_claimed_again(tmpdir):
+    queue = make_queue(tmpdir, max_attempts=2, retry_delay=0.2)
+    (position, data), = queue.claim('worker', 1)
+    assert not queue.complete('worker', position, data + ['RetriesExhausted: x'], retry=True)
+
+    assert position not in [p for p, d in queue.claim('worker', 10)]
+    assert 0 < queue.wait_time() <= 0.2
+    time.sleep(0.25)
+    assert queue.claim('worker', 10) == [(position, data)]
+
+    # its attempts are used up, the error is its output
+    assert queue.complete('worker', position, data + ['RetriesExhausted: x'], retry=True)
+    assert next(queue.results()) == data + ['RetriesExhausted: x']
+
+
+def test_release_hands_rows_back(tmpdir):
+    queue = make_queue(tmpdir)
+    queue.claim('stopped', 2)
+    queue.release('stopped')
+    assert queue.status()['pending'] == 5
+    assert queue.wait_time() == 0
+
+
+def test_results_in_source_order(tmpdir):
+    queue = make_queue(tmpdir)
+    for position, data in reversed(queue.claim('worker', 10)):
+        queue.complete('worker', position, data + [None])
+    assert queue.wait_time() is None
+    assert list(queue.results()) == [data + [''] for data in DATAS]
+
+
+def test_queue_workers_match_a_run(book_query, source, reference, tmpdir):
+    path = str(tmpdir.join('queue.sqlite'))
+    queue = WorkQueue(path, lease=0.1)
+    queue.enqueue(os.path.basename(source), BookQuery()._get_data(source))
+
+    # a worker dies with rows leased, another one takes them over
+    queue.claim('dead', 5)
+    time.sleep(0.2)
+    queue = WorkQueue(path)
+    assert book_query().process_queue(queue, 'alive', concurrency=4) == ROWS
+
+    directory = str(tmpdir.mkdir('export'))
+    with open(book_query().export_queue(queue, directory)) as fd:
+        assert fd.read() == reference
+
+
+def test_worker_batches_share_their_threads(book_query, source, reference, tmpdir, monkeypatch):
+    queue = WorkQueue(str(tmpdir.join('queue.sqlite')))
+    queue.enqueue(os.path.basename(source), BookQuery()._get_data(source))
+
+    process_row = BookQuery._process_row
+    threads = set()
+
+    def recording(self, query, data):
+        threads.add(threading.get_ident())
+        return process_row(self, query, data)
+
+    monkeypatch.setattr(BookQuery, '_process_row', recording)
+    assert book_query().process_queue(queue, 'worker', batch_size=2, concurrency=4) == ROWS
+    assert len(threads) <= 4